@@ -0,0 +1,106 @@
+"""
+Scaling benchmark of the resolution of abbreviated scientific names (e.g. Q. robur)
+to their long form (e.g. Quercus robur) in documents with many entities, such as
+species checklists.
+
+Usage: python eval/bench_abbreviation.py
+
+The documents list distinct binomial names, then their abbreviations. The original
+implementation, which compares each abbreviated name with all the entities, is only
+timed on the smaller documents.
+"""
+
+import re
+import timeit
+import string
+import itertools
+import spacy
+from taxonerd.abbreviation import TaxonomicAbbreviationDetector
+
+REFERENCE_MAX_ENTITIES = 2000
+
+
+def reference_long_forms(doc):
+    # The original implementation, quadratic in the number of entities
+    def is_abbreviated_scientific_name(span, abb_name_pattern):
+        return len(span) > 1 and abb_name_pattern.fullmatch(span[0].text)
+
+    def is_long_form_of_abbreviated_name(span, abb):
+        if (
+            (span.text != abb.text)
+            and (len(span) == len(abb))
+            and (span[0].text[0] == abb[0].text[0])
+            and span.end < abb.start
+        ):
+            for i in range(1, len(span)):
+                if span[i].text != abb[i].text:
+                    return False
+            return True
+        return False
+
+    abb_name_pattern = re.compile(r"[A-Z]{1}\.")
+    short_to_long_map = {}
+    for short_candidate in doc.ents:
+        if short_candidate.text not in short_to_long_map and (
+            is_abbreviated_scientific_name(short_candidate, abb_name_pattern)
+        ):
+            long_forms = set(
+                span
+                for span in doc.ents
+                if is_long_form_of_abbreviated_name(span, short_candidate)
+            )
+            short_to_long_map[short_candidate.text] = (
+                next(iter(long_forms)) if long_forms else None
+            )
+    return short_to_long_map
+
+
+def checklist(nlp, n_entities):
+    """A document with n_entities / 2 binomial names followed by their abbreviations"""
+    words = (
+        "".join(letters)
+        for letters in itertools.product(string.ascii_lowercase, repeat=4)
+    )
+    names = [(next(words).capitalize(), next(words)) for _ in range(n_entities // 2)]
+    texts = ["{} {}".format(genus, species) for genus, species in names]
+    texts += ["{}. {}".format(genus[0], species) for genus, species in names]
+    doc = nlp(", ".join(texts))
+    ents, start = [], 0
+    for text in texts:
+        ents.append(doc.char_span(start, start + len(text), "LIVB"))
+        start += len(text) + 2
+    doc.set_ents(ents)
+    return doc
+
+
+def main():
+    nlp = spacy.blank("en")
+    detector = TaxonomicAbbreviationDetector(nlp)
+    print("entities\toriginal (ms)\tindexed (ms)\tspeedup")
+    for n_entities in [10, 100, 1000, 10000]:
+        doc = checklist(nlp, n_entities)
+        assert len(doc.ents) == n_entities
+        number = max(1, 1000 // n_entities)
+        indexed_time = timeit.timeit(
+            lambda: detector.find_abbreviated_scientific_names(doc), number=number
+        )
+        abbreviations = [ent for ent in doc.ents if "." in ent.text]
+        assert all(ent._.long_form is not None for ent in abbreviations)
+        if n_entities > REFERENCE_MAX_ENTITIES:
+            print("{}\t-\t{:.3f}\t-".format(n_entities, 1000 * indexed_time / number))
+            continue
+        reference = reference_long_forms(doc)
+        assert all(ent._.long_form == reference[ent.text] for ent in abbreviations)
+        reference_time = timeit.timeit(lambda: reference_long_forms(doc), number=number)
+        print(
+            "{}\t{:.3f}\t{:.3f}\t{:.1f}x".format(
+                n_entities,
+                1000 * reference_time / number,
+                1000 * indexed_time / number,
+                reference_time / indexed_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Microbenchmark of the text cleaner applied to the text extracted from documents.
+
+Usage: python eval/bench_clean_text.py [TEXT_FILE...]
+
+Without argument, the text files of the test corpus are used. Each text is repeated
+to build documents of increasing size.
+"""
+
+import re
+import sys
+import glob
+import timeit
+from taxonerd.extractor import clean_text
+
+
+def reference_clean_text(text):
+    # The original, multi-pass implementation
+    text = text.encode("ascii", "ignore").decode()
+    text = re.sub("\t+", " ", text)
+    text = re.sub("-\n", "", text)
+    text = re.sub("(?<!\n)\n(?!\n)", " ", text)
+    text = re.sub(" +", " ", text)
+    text = text.strip(" \n")
+    text = re.sub(r"^([^\w\s\(\)]\s*)*", "", text)
+    return text
+
+
+def main():
+    filenames = sys.argv[1:] or glob.glob("tests/test_data/test_txt/*.txt")
+    text = "\n\n".join(open(filename).read() for filename in filenames)
+
+    print("size (kB)\tmulti-pass (ms)\tclean_text (ms)\tspeedup")
+    for repeat in [1, 10, 100, 1000]:
+        document = "\n\n".join([text] * repeat)
+        assert clean_text(document) == reference_clean_text(document)
+        number = max(1, 1000 // repeat)
+        reference_time = timeit.timeit(
+            lambda: reference_clean_text(document), number=number
+        )
+        fused_time = timeit.timeit(lambda: clean_text(document), number=number)
+        print(
+            "{}\t{:.3f}\t{:.3f}\t{:.1f}x".format(
+                len(document) // 1000,
+                1000 * reference_time / number,
+                1000 * fused_time / number,
+                reference_time / fused_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
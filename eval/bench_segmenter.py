@@ -0,0 +1,74 @@
+"""
+Benchmark of the sentence segmenters used to assign sentence ids to the entities.
+
+Usage: python eval/bench_segmenter.py [TEXT_FILE...]
+
+Without argument, the text files of the test corpus are used, and repeated to build a
+longer document. As no NER model is needed, the capitalized pairs of words stand for
+the entities. The accuracy of a segmenter is the share of consecutive entity pairs for
+which it agrees with pysbd on whether both entities are in the same sentence.
+"""
+
+import re
+import sys
+import glob
+import time
+import spacy
+from spacy.tokens import Span
+from scispacy.custom_sentence_segmenter import pysbd_sentencizer
+from taxonerd.segmentation import (
+    SEGMENTERS,
+    SENTENCIZERS,
+    set_sentence_ids,
+    set_sentence_ids_lazily,
+)
+
+REPEAT = 20
+ENTITY = re.compile(r"[A-Z][a-z]+ [a-z]+")
+
+
+def annotate(nlp, text, segmenter):
+    doc = nlp(text)
+    ents = [doc.char_span(*match.span(), "LIVB") for match in ENTITY.finditer(text)]
+    ents = [span for span in ents if span is not None]
+    doc.set_ents(ents)
+    if segmenter == "lazy":
+        set_sentence_ids_lazily(doc, ents)
+    else:
+        set_sentence_ids(doc, ents)
+    return [ent._.sent_id for ent in ents]
+
+
+def same_sentence(ids):
+    return [a == b for a, b in zip(ids, ids[1:])]
+
+
+def main():
+    if not Span.has_extension("sent_id"):
+        Span.set_extension("sent_id", default=None)
+    filenames = sys.argv[1:] or glob.glob("tests/test_data/test_txt/*.txt")
+    text = "\n\n".join(open(filename).read() for filename in filenames)
+    documents = ["\n\n".join([text] * REPEAT)] * 5
+
+    print("segmenter\tms/doc\taccuracy")
+    reference = None
+    for segmenter in SEGMENTERS:
+        nlp = spacy.blank("en")
+        if segmenter in SENTENCIZERS:
+            nlp.add_pipe(SENTENCIZERS[segmenter])
+        start = time.perf_counter()
+        ids = [annotate(nlp, document, segmenter) for document in documents]
+        elapsed = time.perf_counter() - start
+        pairs = same_sentence(ids[0])
+        if reference is None:
+            reference = pairs
+        accuracy = sum(a == b for a, b in zip(pairs, reference)) / len(reference)
+        print(
+            "{}\t{:.1f}\t{:.3f}".format(
+                segmenter, 1000 * elapsed / len(documents), accuracy
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Microbenchmark of the tf-idf vectorizers used to encode mentions for entity linking.
+
+Usage: python eval/bench_vectorizer.py [LINKER_NAME_OR_PATH]
+
+Without argument, the vectorizer is fitted on synthetic taxon names. Otherwise, the
+vectorizer of the given linker (e.g. gbif_backbone) is used.
+"""
+
+import sys
+import random
+import timeit
+import numpy
+import joblib
+from sklearn.feature_extraction.text import TfidfVectorizer
+from taxonerd.linking.file_cache import cached_path
+from taxonerd.linking.candidate_generation import LinkerPathsFactory
+from taxonerd.linking.vectorizer import TrigramVectorizer
+
+SYLLABLES = ["ar", "bo", "ca", "de", "fi", "lu", "mo", "ne", "ra", "si", "to", "us"]
+
+
+def random_name(rng):
+    words = [
+        "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5)))
+        for _ in range(rng.randint(1, 3))
+    ]
+    return " ".join(words).capitalize()
+
+
+def main():
+    rng = random.Random(0)
+    if len(sys.argv) > 1:
+        linker_paths = LinkerPathsFactory().get_linker_paths(sys.argv[1])
+        vectorizer = joblib.load(cached_path(linker_paths.tfidf_vectorizer))
+    else:
+        vectorizer = TfidfVectorizer(
+            analyzer="char_wb", ngram_range=(3, 3), min_df=10, dtype=numpy.float32
+        )
+        vectorizer.fit([random_name(rng) for _ in range(100000)])
+    fast_vectorizer = TrigramVectorizer.from_tfidf_vectorizer(vectorizer)
+
+    print("batch size\tsklearn (ms)\tTrigramVectorizer (ms)\tspeedup")
+    for batch_size in [1, 10, 100, 1000, 10000]:
+        mentions = [random_name(rng) for _ in range(batch_size)]
+        number = max(1, 10000 // batch_size)
+        sklearn_time = timeit.timeit(
+            lambda: vectorizer.transform(mentions), number=number
+        )
+        fast_time = timeit.timeit(
+            lambda: fast_vectorizer.transform(mentions), number=number
+        )
+        print(
+            "{}\t{:.3f}\t{:.3f}\t{:.1f}x".format(
+                batch_size,
+                1000 * sklearn_time / number,
+                1000 * fast_time / number,
+                sklearn_time / fast_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
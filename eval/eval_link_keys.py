@@ -0,0 +1,59 @@
+"""
+Comparison of the strings used to look up mentions in the knowledge base of an entity
+linker (see `taxonerd.linking.linking_utils.LINK_KEYS`).
+
+Usage: python eval/eval_link_keys.py [LINKER_NAME_OR_PATH] [TEXT_FILE...]
+
+By default, the taxref linker and the text files of the test corpus are used. The
+en_ner_eco_md model must be installed. For each link key, the time spent annotating
+the documents is reported, with the share of the entities found with lemma keys that
+are still found and linked to the same concepts.
+"""
+
+import sys
+import glob
+import time
+from taxonerd import TaxoNERD
+from taxonerd.linking.linking_utils import LINK_KEYS
+
+MODEL = "en_ner_eco_md"
+EXCLUDE = ["tagger", "attribute_ruler", "parser", "pysbd_sentencizer"]
+
+
+def annotate(link_key, linker, texts):
+    nerd = TaxoNERD()
+    exclude = EXCLUDE + (["lemmatizer"] if link_key == "text" else [])
+    nerd.load(MODEL, exclude=exclude, linker=linker, link_key=link_key)
+    nerd.ner(texts[0])  # Warm up
+    start = time.perf_counter()
+    docs = [nerd.ner(text) for text in texts]
+    elapsed = time.perf_counter() - start
+    links = {}
+    for i, doc in enumerate(docs):
+        for ent in doc.ents:
+            concepts = frozenset(concept_id for concept_id, *_ in ent._.kb_ents)
+            links[(i, ent.start_char, ent.end_char)] = concepts
+    return elapsed, links
+
+
+def main():
+    linker = sys.argv[1] if len(sys.argv) > 1 else "taxref"
+    filenames = sys.argv[2:] or glob.glob("tests/test_data/test_txt/*.txt")
+    texts = [open(filename).read() for filename in filenames]
+
+    print("link key\ttime (s)\tentities\tsame links")
+    reference = None
+    for link_key in LINK_KEYS:
+        elapsed, links = annotate(link_key, linker, texts)
+        if reference is None:
+            reference = links
+        same = sum(links.get(key) == concepts for key, concepts in reference.items())
+        print(
+            "{}\t{:.2f}\t{}\t{:.3f}".format(
+                link_key, elapsed, len(links), same / max(len(reference), 1)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
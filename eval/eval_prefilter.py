@@ -0,0 +1,110 @@
+"""
+Recall loss of the paragraph pre-filter (see `taxonerd.prefilter`).
+
+Usage: python eval/eval_prefilter.py [--model MODEL] [--kb LINKER_NAME_OR_PATH]
+                                     [TEXT_FILE ANN_FILE...]
+
+By default, the text files of the test corpus and their BRAT annotations are used.
+Two measures are reported for each setting of the pre-filter:
+
+* without model: the share of the text processed by the model, and the share of the
+  annotated entities that lie in the processed lines (an upper bound of the recall)
+* with a model (e.g. en_ner_eco_md, if installed): the time spent annotating the
+  documents, and the share of the entities found by the full run that are still found
+  with the pre-filter
+"""
+
+import sys
+import time
+import argparse
+from taxonerd import TaxoNERD
+from taxonerd.prefilter import ParagraphFilter, load_genera
+
+TEST_CORPUS = [
+    ("tests/test_data/test_txt/test1.txt", "tests/test_data/test_ann/sample_text1.ann"),
+    ("tests/test_data/test_txt/test2.txt", "tests/test_data/test_ann/sample_text2.ann"),
+]
+REPEAT = 20
+EXCLUDE = ["tagger", "attribute_ruler", "parser", "pysbd_sentencizer"]
+
+
+def read_ann(filename):
+    entities = []
+    with open(filename) as f:
+        for line in f:
+            _, offsets, _ = line.rstrip("\n").split("\t")
+            _, start, end = offsets.split(" ")
+            entities.append((int(start), int(end)))
+    return entities
+
+
+def in_candidates(paragraph_filter, text, entities):
+    runs = [(s, e) for s, e, candidate in paragraph_filter.split(text) if candidate]
+    found = [any(s <= start and end <= e for s, e in runs) for start, end in entities]
+    processed = sum(e - s for s, e in runs)
+    return processed, sum(found)
+
+
+def annotate(nerd, texts):
+    nerd.ner(texts[0])  # Warm up
+    start = time.perf_counter()
+    docs = [nerd.ner(text) for text in texts]
+    elapsed = time.perf_counter() - start
+    entities = {
+        (i, ent.start_char, ent.end_char)
+        for i, doc in enumerate(docs)
+        for ent in doc.ents
+    }
+    return elapsed, entities
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="NER model, e.g. en_ner_eco_md")
+    parser.add_argument("--kb", help="Entity linker whose genus names are used")
+    parser.add_argument("files", nargs="*", help="TEXT_FILE ANN_FILE pairs")
+    args = parser.parse_args()
+    pairs = list(zip(args.files[::2], args.files[1::2])) or TEST_CORPUS
+    texts = [open(text_file).read() for text_file, _ in pairs]
+    annotations = [read_ann(ann_file) for _, ann_file in pairs]
+
+    genera = load_genera(args.kb) if args.kb else None
+    settings = [
+        ("context=0", ParagraphFilter(genera, context=0)),
+        ("context=1", ParagraphFilter(genera, context=1)),
+        ("context=2", ParagraphFilter(genera, context=2)),
+    ]
+
+    print("pre-filter\tprocessed text\tannotated entities in processed text")
+    total = sum(len(text) for text in texts)
+    n_entities = sum(len(entities) for entities in annotations)
+    for name, paragraph_filter in settings:
+        processed = found = 0
+        for text, entities in zip(texts, annotations):
+            counts = in_candidates(paragraph_filter, text, entities)
+            processed += counts[0]
+            found += counts[1]
+        print(
+            "{}\t{:.3f}\t{:.3f} ({}/{})".format(
+                name, processed / total, found / n_entities, found, n_entities
+            )
+        )
+
+    if not args.model:
+        return
+    nerd = TaxoNERD()
+    nerd.load(args.model, exclude=EXCLUDE)
+    texts = texts * REPEAT
+    print()
+    print("pre-filter\ttime (s)\tentities\trecall")
+    elapsed, reference = annotate(nerd, texts)
+    print("none\t{:.2f}\t{}\t1.000".format(elapsed, len(reference)))
+    for name, paragraph_filter in settings:
+        nerd.prefilter = paragraph_filter
+        elapsed, entities = annotate(nerd, texts)
+        recall = len(entities & reference) / max(len(reference), 1)
+        print("{}\t{:.2f}\t{}\t{:.3f}".format(name, elapsed, len(entities), recall))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 from scispacy.abbreviation import AbbreviationDetector
 
 from typing import Tuple, List, Optional, Set, Dict
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from heapq import heappop, heappush
 from spacy.tokens import Span, Doc
 from spacy.matcher import Matcher
 from spacy.language import Language
@@ -23,62 +25,84 @@ class TaxonomicAbbreviationDetector(AbbreviationDetector):
 
     def __call__(self, doc: Doc) -> Doc:
         doc = super().__call__(doc)
-        doc = self.apply_filter(doc)
-        doc = self.find_abbreviated_scientific_names(doc)
+        ents = self.add_abbreviations(doc, list(doc.ents))
+        self.link_abbreviated_scientific_names(ents)
+        doc.set_ents(ents)
         return doc
 
     def find_abbreviated_scientific_names(self, doc):
         """
         Match abbreviated scientific names with their long form.
         """
+        self.link_abbreviated_scientific_names(list(doc.ents))
+        return doc
+
+    def link_abbreviated_scientific_names(self, ents: List[Span]) -> None:
+        """
+        Set the long form of the entities `ents`, sorted by position.
+
+        The long form of an abbreviated name (e.g. Q. robur) is an entity preceding it,
+        with the same first letter and the same trailing tokens (e.g. Quercus robur).
+        Entities are indexed by (first letter, trailing tokens), in order, so that the
+        long forms are found without comparing each abbreviated name with all the
+        entities. If several entities match, the closest to the abbreviated name is
+        chosen.
+        """
 
         def is_abbreviated_scientific_name(span, abb_name_pattern):
             return len(span) > 1 and abb_name_pattern.fullmatch(span[0].text)
 
-        def is_long_form_of_abbreviated_name(span, abb):
-            if (
-                (span.text != abb.text)
-                and (len(span) == len(abb))
-                and (span[0].text[0] == abb[0].text[0])
-                and span.end < abb.start
-            ):
-                for i in range(1, len(span)):
-                    if span[i].text != abb[i].text:
-                        return False
-                return True
-            return False
+        def index_key(span):
+            return span[0].text[0], tuple(token.text for token in span[1:])
+
+        def find_long_form(abb, index):
+            candidates = index.get(index_key(abb))
+            if not candidates:
+                return None
+            ends, spans = candidates
+            # Look for the closest entity ending before the abbreviated name
+            i = bisect_left(ends, abb.start)
+            while i > 0:
+                i -= 1
+                if spans[i].text != abb.text:
+                    return spans[i]
+            return None
 
         abb_name_pattern = re.compile("[A-Z]{1}\.")
-        ents = []
+        index = defaultdict(lambda: ([], []))
+        for span in ents:
+            ends, spans = index[index_key(span)]
+            ends.append(span.end)
+            spans.append(span)
+
         short_to_long_map = {}
-        for short_candidate in doc.ents:
+        for short_candidate in ents:
             if (
                 short_candidate.text not in short_to_long_map
                 and is_abbreviated_scientific_name(short_candidate, abb_name_pattern)
             ):
-                long_forms = set(
-                    [
-                        span
-                        for span in doc.ents
-                        if is_long_form_of_abbreviated_name(span, short_candidate)
-                    ]
+                short_to_long_map[short_candidate.text] = find_long_form(
+                    short_candidate, index
                 )
-                short_to_long_map[short_candidate.text] = (
-                    next(iter(long_forms)) if long_forms else None
-                )  # What if several matches for long form ?
 
             if short_candidate.text in short_to_long_map:
                 short_candidate._.long_form = short_to_long_map[short_candidate.text]
             else:
                 short_candidate._.long_form = short_candidate
-            ents.append(short_candidate)
-        doc.set_ents(ents)
-        return doc
 
     def apply_filter(self, doc):
         """
         Keep only abbreviations whose long forms match taxonomic entities.
         """
+        doc.set_ents(self.add_abbreviations(doc, list(doc.ents)))
+        return doc
+
+    def add_abbreviations(self, doc: Doc, ents: List[Span]) -> List[Span]:
+        """
+        Return the entities `ents` of `doc` and the abbreviations whose long forms match
+        taxonomic entities, sorted by position. The abbreviations overlapping an entity
+        or a longer abbreviation are left out.
+        """
 
         def is_valid_abbrev(abrv, ents_dict):
             return (
@@ -87,41 +111,59 @@ class TaxonomicAbbreviationDetector(AbbreviationDetector):
                 and abrv._.long_form.text in ents_dict
             )
 
-        def remove_overlapping_spans(spans):
-            keep = [True] * len(spans)
-            for i in range(len(spans)):
-                if keep[i]:
-                    for j in range(i + 1, len(spans)):
-                        span_i = spans[i]
-                        span_j = spans[j]
-                        if not (
-                            span_i.start > span_j.end or span_i.end < span_j.start
-                        ):  # Overlapping, keep the longest span
-                            if len(span_i) <= len(span_j):
-                                keep[i] = False
-                            else:
-                                keep[j] = False
-            return list(compress(spans, keep))
-
-        ents = [ent for ent in doc.ents]
-        if ents and len(doc._.abbreviations) > 0:
-            ents_dict = {ent.text: ent for ent in ents}
-            abbreviations = [
-                abrv for abrv in doc._.abbreviations if is_valid_abbrev(abrv, ents_dict)
-            ]
-            # scispacy's AbbreviationDetector may return overlapping spans -> keep the longest
-            abbreviations = remove_overlapping_spans(abbreviations)
-            # Abbreviations may overlap with entities -> remove them
-            for i in range(len(abbreviations)):
-                overlapping_span = False
-                abrv = abbreviations[i]
-                for ent in doc.ents:
-                    if not (ent.start > abrv.end or ent.end < abrv.start):
-                        overlapping_span = True
-                        break  # Current abbreviation overlaps an entity. Stop.
-                if not overlapping_span:
-                    new_ent = Span(doc, abrv.start, abrv.end, "LIVB")
-                    new_ent._.long_form = abrv._.long_form
-                    ents.append(new_ent)
-            doc.set_ents(ents)
-        return doc
+        if not ents or not doc._.abbreviations:
+            return ents
+        ents_dict = {ent.text: ent for ent in ents}
+        abbreviations = [
+            abrv for abrv in doc._.abbreviations if is_valid_abbrev(abrv, ents_dict)
+        ]
+        # scispacy's AbbreviationDetector may return overlapping spans -> keep the longest
+        abbreviations = remove_overlapping_spans(abbreviations)
+        # Abbreviations may overlap with entities -> remove them. Entities are sorted
+        # and do not overlap, so the last entity starting before the end of an
+        # abbreviation is the only one that may overlap it.
+        starts = [ent.start for ent in ents]
+        new_ents = []
+        for abrv in abbreviations:
+            i = bisect_right(starts, abrv.end) - 1
+            if i < 0 or ents[i].end < abrv.start:
+                new_ent = Span(doc, abrv.start, abrv.end, "LIVB")
+                new_ent._.long_form = abrv._.long_form
+                new_ents.append(new_ent)
+        if new_ents:
+            ents = sorted(ents + new_ents, key=lambda span: span.start)
+        return ents
+
+
+def overlapping_pairs(spans: List[Span]) -> List[List[int]]:
+    """
+    Return the indices of the spans overlapping (or touching) each of the `spans`,
+    found by sweeping the spans sorted by start.
+    """
+    pairs = [[] for _ in spans]
+    active = []  # heap of (end, index) of the spans which may overlap the next ones
+    for i in sorted(range(len(spans)), key=lambda i: spans[i].start):
+        while active and active[0][0] < spans[i].start:
+            heappop(active)
+        for _, j in active:
+            pairs[i].append(j)
+            pairs[j].append(i)
+        heappush(active, (spans[i].end, i))
+    return pairs
+
+
+def remove_overlapping_spans(spans: List[Span]) -> List[Span]:
+    """
+    Remove the spans overlapping a longer span. The spans are compared in order: when
+    two overlapping spans have the same length, the last one is kept.
+    """
+    keep = [True] * len(spans)
+    for i, overlapping in enumerate(overlapping_pairs(spans)):
+        if keep[i]:
+            for j in sorted(overlapping):
+                if j > i:
+                    if len(spans[i]) <= len(spans[j]):
+                        keep[i] = False
+                    else:
+                        keep[j] = False
+    return list(compress(spans, keep))
@@ -0,0 +1,259 @@
+"""
+Asyncio API of TaxoNERD.
+
+`AsyncTaxoNERD` wraps a loaded `TaxoNERD` instance. The texts of concurrent requests
+are queued and coalesced into batches, which are processed with `TaxoNERD.pipe` on a
+bounded thread pool, so that serving many requests concurrently keeps the throughput
+of batched inference. Text extraction and file I/O run in the default executor of the
+event loop, never on the loop itself. If a batch fails, its texts are processed again
+one by one, so that only the failing requests raise.
+
+    >>> nerd = TaxoNERD()
+    >>> nerd.load("en_ner_eco_md")
+    >>> async with AsyncTaxoNERD(nerd) as anerd:
+    ...     df = await anerd.find_in_text("Brown bears (Ursus arctos) eat salmon")
+"""
+
+import os
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from taxonerd.writers import BratWriter
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTaxoNERD:
+    """
+    Parameters
+    ----------
+
+    nerd: `TaxoNERD`, required.
+        A TaxoNERD instance, with a loaded model.
+    max_batch_size: int, optional (default = 32)
+        The maximum number of texts processed in a batch.
+    max_wait: float, optional (default = 0.005)
+        How long (in seconds) the first text of a batch waits for other texts before the
+        batch is processed.
+    max_workers: int, optional (default = 1)
+        The number of batches processed at the same time, in threads (see the thread
+        safety of `TaxoNERD.find_in_text`). While all the workers are busy, the texts
+        of new requests are queued, and processed in larger batches.
+    max_tokens: int, optional (default = None)
+        Split the texts of a batch into sub-batches of similar lengths with this token
+        budget (see `TaxoNERD.pipe`).
+    """
+
+    def __init__(
+        self,
+        nerd,
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+        max_workers: int = 1,
+        max_tokens: Optional[int] = None,
+    ):
+        self.nerd = nerd
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_workers = max_workers
+        self.max_tokens = max_tokens
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="taxonerd"
+        )
+        # Created in the event loop, on first use
+        self._queue = None
+        self._workers = None
+        self._write_lock = None
+        self._batcher = None
+
+    def _start(self):
+        if self._batcher is None:
+            self._queue = asyncio.Queue()
+            self._workers = asyncio.Semaphore(self.max_workers)
+            self._write_lock = asyncio.Lock()
+            self._batcher = asyncio.ensure_future(self._batch_loop())
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                # Wait for a free worker, and for more texts
+                await self._workers.acquire()
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    try:
+                        if timeout > 0:
+                            text = await asyncio.wait_for(self._queue.get(), timeout)
+                        else:
+                            text = self._queue.get_nowait()
+                    except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                        break
+                    batch.append(text)
+                task = asyncio.ensure_future(self._run_batch(batch))
+                task.add_done_callback(lambda _: self._workers.release())
+                batch = []
+        except asyncio.CancelledError:
+            self._stop_requests(batch)
+            raise
+        except Exception as e:
+            # Requests would otherwise wait forever for the stopped batcher
+            logger.exception("The batching of requests failed")
+            self._stop_requests(batch, e)
+            self._stop_requests(self._drain_queue(), e)
+            raise
+
+    def _drain_queue(self):
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    def _stop_requests(self, batch, error=None):
+        """Cancel the requests of `batch`, or fail them with `error`"""
+        for _, future in batch:
+            if not future.done():
+                future.cancel() if error is None else future.set_exception(error)
+
+    async def _run_batch(self, batch):
+        # Requests cancelled while waiting are not processed
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            return
+        loop = asyncio.get_running_loop()
+        texts = [text for text, _ in batch]
+        try:
+            docs = await loop.run_in_executor(self.executor, self._process, texts)
+        except Exception as e:
+            if len(batch) == 1:
+                self._stop_requests(batch, e)
+                return
+            # Process the texts one by one, so that only the failing requests fail
+            logger.warning(
+                "Batch of {} texts failed ({!r}), retry them one by one".format(
+                    len(batch), e
+                )
+            )
+            for item in batch:
+                await self._run_batch([item])
+            return
+        for (_, future), doc in zip(batch, docs):
+            if not future.done():
+                future.set_result(doc)
+
+    def _process(self, texts: List[str]):
+        logger.debug("Process a batch of {} texts".format(len(texts)))
+        return list(
+            self.nerd.pipe(texts, batch_size=len(texts), max_tokens=self.max_tokens)
+        )
+
+    async def ner(self, text: str):
+        """Return the annotated spaCy document of `text`, as `TaxoNERD.ner` does"""
+        self._start()
+        if self._batcher.done():
+            raise RuntimeError(
+                "The batching of requests failed, close and restart"
+            ) from self._batcher.exception()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def find_in_text(self, text: str):
+        """Return the entities found in `text`, as `TaxoNERD.find_in_text` does"""
+        return self.nerd.doc_to_df(await self.ner(text))
+
+    async def write(self, doc_id, doc, writer=None):
+        """Write the entities of `doc` with `writer` off the event loop, one at a time"""
+        if writer is None:
+            return self.nerd.doc_to_df(doc)
+        self._start()
+        async with self._write_lock:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.nerd.write, doc_id, doc, writer
+            )
+
+    async def find_in_file(self, filename, output_dir=None, name=None, writer=None):
+        """
+        Return the entities found in the file `filename`, or write them, as
+        `TaxoNERD.find_in_file` does.
+        """
+        if name is None:
+            name = ".".join(os.path.basename(filename).split(".")[:-1])
+        if writer is None and output_dir:
+            writer = BratWriter(output_dir)
+        text = await asyncio.get_running_loop().run_in_executor(
+            None, self.nerd.extract_text, filename
+        )
+        if text is None:
+            return None
+        return await self.write(name, await self.ner(text), writer)
+
+    async def find_in_corpus(
+        self,
+        input_dir=None,
+        output_dir=None,
+        recursive=False,
+        file_list=None,
+        shard=None,
+        text_key="text",
+        id_key="id",
+        writer=None,
+    ):
+        """
+        Return the entities found in the documents of a corpus, or write them, as
+        `TaxoNERD.find_in_corpus` does. The documents are read in the default executor,
+        and up to 2 * `max_batch_size` documents are annotated concurrently.
+        """
+        loop = asyncio.get_running_loop()
+        texts = self.nerd.iter_corpus_texts(
+            input_dir, recursive, file_list, shard, text_key, id_key
+        )
+        if writer is None and output_dir:
+            writer = BratWriter(output_dir)
+        results = {}
+        pending = deque()
+
+        async def collect():
+            name, doc_id, doc = pending.popleft()
+            results[name] = await self.write(doc_id, await doc, writer)
+
+        end = object()
+        try:
+            while True:
+                item = await loop.run_in_executor(None, next, texts, end)
+                if item is end:
+                    break
+                text, (name, doc_id) = item
+                pending.append((name, doc_id, asyncio.ensure_future(self.ner(text))))
+                if len(pending) >= 2 * self.max_batch_size:
+                    await collect()
+            while pending:
+                await collect()
+        finally:
+            for _, _, doc in pending:
+                doc.cancel()
+        return results
+
+    async def close(self):
+        """Stop the batching of requests, and shut the workers down"""
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except (asyncio.CancelledError, Exception):
+                pass  # Failures are logged by the batcher
+            self._batcher = None
+            self._stop_requests(self._drain_queue())
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
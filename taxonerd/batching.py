@@ -0,0 +1,93 @@
+"""
+Batching of documents by length, for the transformer models: documents of a batch are
+padded to the longest one, so that a batch mixing a long article with short abstracts
+costs as much as a batch of long articles.
+
+Documents are read by windows, sorted by length within each window, and grouped into
+batches whose padded size stays within a token budget. Results are returned in the
+order of the documents. Windows are sized after the token budget, so that the results
+of a stream of documents (e.g. records read from stdin) are only delayed by a few
+batches.
+"""
+
+from typing import Callable, Iterable, Iterator, List, Sequence, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Number of full batches of documents read, and sorted by length, at once
+WINDOW_BATCHES = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """A fast estimate of the number of tokens of `text`"""
+    return text.count(" ") + text.count("\n") + 1
+
+
+def token_budget_batches(
+    lengths: Sequence[int], max_tokens: int, max_batch_size: int = None
+) -> List[List[int]]:
+    """
+    Group the documents of the given `lengths` (in tokens) into batches of similar
+    lengths, whose padded size (number of documents times the length of the longest)
+    does not exceed `max_tokens`, and which have at most `max_batch_size` documents.
+    Documents longer than `max_tokens` are processed alone. Return the batches as lists
+    of indices in `lengths`.
+    """
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        if batch and (
+            (len(batch) + 1) * lengths[i] > max_tokens
+            or (max_batch_size and len(batch) >= max_batch_size)
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def process_by_length(
+    process: Callable[[List[T]], Iterable[R]],
+    items: Iterable[T],
+    max_tokens: int,
+    max_batch_size: int = None,
+    length: Callable[[T], int] = estimate_tokens,
+    window_size: int = None,
+) -> Iterator[R]:
+    """
+    Apply `process` to batches of `items` formed by `token_budget_batches`, and yield
+    the results in the order of `items`. `process` returns one result per item of a
+    batch, in order. Items are read by windows of `window_size` items, or by default of
+    WINDOW_BATCHES times `max_tokens` tokens, and at most WINDOW_BATCHES times
+    `max_batch_size` items. The results of a window are yielded once the whole window
+    is processed.
+    """
+    if window_size is None:
+        window_tokens = WINDOW_BATCHES * max_tokens
+        if max_batch_size:
+            window_size = WINDOW_BATCHES * max_batch_size
+    else:
+        window_tokens = None
+    items = iter(items)
+    while True:
+        window = []
+        lengths = []
+        tokens = 0
+        for item in items:
+            window.append(item)
+            lengths.append(length(item))
+            tokens += lengths[-1]
+            if window_size and len(window) >= window_size:
+                break
+            if window_tokens and tokens >= window_tokens:
+                break
+        if not window:
+            return
+        results = [None] * len(window)
+        for batch in token_budget_batches(lengths, max_tokens, max_batch_size):
+            for i, result in zip(batch, process([window[i] for i in batch])):
+                results[i] = result
+        yield from results
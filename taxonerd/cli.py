@@ -1,9 +1,15 @@
 import click
 import sys
 import os
+import json
 import logging
 import logging.config
 from taxonerd import TaxoNERD
+from taxonerd.corpus import is_collection, merge_outputs, parse_shard
+from taxonerd.writers import OUTPUT_FORMATS, entities_to_records, get_writer
+from taxonerd.segmentation import SEGMENTERS
+from taxonerd.linking.linking_utils import LINK_KEYS
+from taxonerd.linking.gazetteer import GAZETTEER_MODES
 
 
 @click.group()
@@ -11,6 +17,64 @@ def cli():
     pass
 
 
+def read_jsonl(lines, text_key="text", id_key="id"):
+    """
+    Yield (text, (id, error)) tuples for the JSON records of `lines`. Records without an
+    id are identified by their line index. Records that cannot be read, or whose text is
+    missing or not a string, are yielded with an empty text and an error message.
+    """
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield "", (i, "Invalid record on line {}: {!r}".format(i + 1, e))
+            continue
+        if not isinstance(record, dict):
+            yield "", (i, "Invalid record on line {}: not an object".format(i + 1))
+            continue
+        doc_id = record.get(id_key, i)
+        text = record.get(text_key)
+        if not isinstance(text, str):
+            error = "Invalid record on line {}: {} is {}".format(
+                i + 1,
+                text_key,
+                "missing" if text_key not in record else "not a string",
+            )
+            yield "", (doc_id, error)
+            continue
+        yield text, (doc_id, None)
+
+
+def annotate_jsonl(
+    nerd, input_stream, output_stream, batch_size=32, max_tokens=None, **kwargs
+):
+    """
+    Annotate the JSONL records of `input_stream` by batches, and write one JSON result
+    per record to `output_stream`, in order, as soon as its batch is processed. With
+    `max_tokens`, records are batched by length (see `TaxoNERD.pipe`), and the results
+    are written by windows of records.
+    """
+    records = read_jsonl(input_stream, **kwargs)
+    docs = nerd.pipe(records, batch_size, as_tuples=True, max_tokens=max_tokens)
+    for doc, (doc_id, error) in docs:
+        if error:
+            result = {"id": doc_id, "error": error}
+        else:
+            entities = entities_to_records(nerd.doc_to_df(doc))
+            result = {"id": doc_id, "entities": entities}
+        output_stream.write(json.dumps(result) + "\n")
+        output_stream.flush()
+
+
+def validate_shard(ctx, param, value):
+    try:
+        return parse_shard(value) if value else None
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @cli.command()
 @click.option(
     "--model",
@@ -19,9 +83,71 @@ def cli():
     help="A TaxoNERD model [default = en_ner_eco_md]",
     default="en_ner_eco_md",
 )
-@click.option("--input-dir", "-i", type=str, help="Input directory")
+@click.option(
+    "--input-dir",
+    "-i",
+    type=str,
+    help="Input directory, archive (.tar.gz, .zip...) or JSONL file",
+)
 @click.option("--output-dir", "-o", type=str, help="Output directory")
+@click.option(
+    "--output-format",
+    type=click.Choice(OUTPUT_FORMATS),
+    help="brat: one .ann file per document, jsonl: one JSON record per document "
+    "(to stdout without output directory), parquet: one row per entity, docbin: "
+    "annotated spaCy docs [default = brat]",
+    default="brat",
+)
 @click.option("--filename", "-f", type=str, help="Input text file")
+@click.option(
+    "--recursive",
+    "-r",
+    type=bool,
+    help="Search the subdirectories of the input directory too",
+    is_flag=True,
+)
+@click.option(
+    "--file-list",
+    type=str,
+    help="File listing the input files, one per line (relative to the input directory)",
+)
+@click.option(
+    "--shard",
+    type=str,
+    help="Only process the i-th of N subsets of the input files (i/N, 0 <= i < N)",
+    callback=validate_shard,
+)
+@click.option(
+    "--jsonl",
+    type=bool,
+    help="Read JSON records from stdin and write one JSON result per record to stdout",
+    is_flag=True,
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    help="Number of documents or JSON records processed at once [default = 32]",
+    default=32,
+)
+@click.option(
+    "--max-tokens",
+    type=int,
+    help="Batch documents of similar lengths, with at most this number of (padded) "
+    "tokens per batch, instead of --batch-size documents of any length. Recommended "
+    "with the transformer models",
+)
+@click.option(
+    "--text-key",
+    type=str,
+    help="Field containing the text of JSONL records [default = text]",
+    default="text",
+)
+@click.option(
+    "--id-key",
+    type=str,
+    help="Field containing the id of JSONL records [default = id]",
+    default="id",
+)
 @click.option(
     "--with-abbrev",
     "-a",
@@ -36,24 +162,102 @@ def cli():
     help="Add sentence segmenter to the pipeline",
     is_flag=True,
 )
+@click.option(
+    "--segmenter",
+    type=click.Choice(SEGMENTERS),
+    help="Sentence segmenter used with --with-sentence. pysbd: accurate, rule: "
+    "punctuation-based and faster, lazy: pysbd on the paragraphs containing entities "
+    "only [default = pysbd]",
+    default="pysbd",
+)
 @click.option("--link-to", "-l", type=str, help="Add entity linker to the pipeline")
+@click.option(
+    "--link-key",
+    type=click.Choice(LINK_KEYS),
+    help="Strings looked up in the knowledge base. lemma: lemmas of the whole document, "
+    "entity_lemma: lemmas of the entities only (faster), text: lowercased text, without "
+    "lemmatizer [default = lemma]",
+    default="lemma",
+)
+@click.option(
+    "--gazetteer",
+    type=str,
+    help="Tag the aliases of the knowledge base of this entity linker as entities "
+    "(requires pyahocorasick)",
+)
+@click.option(
+    "--gazetteer-mode",
+    type=click.Choice(GAZETTEER_MODES),
+    help="union: add the aliases found to the entities of the NER model, standalone: "
+    "replace the NER model with the gazetteer [default = union]",
+    default="union",
+)
+@click.option(
+    "--prefilter",
+    type=bool,
+    help="Only run the NER model on the lines containing taxon-like names (faster, "
+    "but vernacular names without such a name nearby are missed)",
+    is_flag=True,
+)
+@click.option(
+    "--prefilter-kb",
+    type=str,
+    help="Also run the NER model on the lines containing the genus names of the "
+    "knowledge base of this entity linker (implies --prefilter)",
+)
 @click.option(
     "--thresh",
     "-t",
     help="Similarity threshold for entity linking [default = 0.7]",
     default=0.7,
 )
+@click.option(
+    "--extraction-jobs",
+    type=int,
+    help="Number of documents from which text is extracted in parallel [default = 1]",
+    default=1,
+)
+@click.option(
+    "--extraction-timeout",
+    type=float,
+    help="Skip documents whose text extraction takes longer (in seconds)",
+    default=None,
+)
+@click.option(
+    "--clean-txt",
+    type=bool,
+    help="Clean the text of .txt input files like extracted text",
+    is_flag=True,
+)
 @click.option("--prefer-gpu", type=bool, help="Use GPU if available", is_flag=True)
 @click.option("--verbose", "-v", type=bool, help="Verbose mode", is_flag=True)
 @click.argument("input_text", required=False)
 def ask(
     input_dir,
     output_dir,
+    output_format,
     filename,
+    recursive,
+    file_list,
+    shard,
+    jsonl,
+    batch_size,
+    max_tokens,
+    text_key,
+    id_key,
     with_abbrev,
     with_sentence,
+    segmenter,
     link_to,
+    link_key,
+    gazetteer,
+    gazetteer_mode,
+    prefilter,
+    prefilter_kb,
     thresh,
+    extraction_jobs,
+    extraction_timeout,
+    clean_txt,
     prefer_gpu,
     verbose,
     model,
@@ -72,6 +276,9 @@ def ask(
         prefer_gpu=prefer_gpu,
         verbose=verbose,
         logger=logger,
+        extraction_jobs=extraction_jobs,
+        extraction_timeout=extraction_timeout,
+        clean_txt=clean_txt,
     )
 
     exclude = ["tagger", "attribute_ruler", "parser"]
@@ -79,28 +286,76 @@ def ask(
         exclude.append("taxo_abbrev_detector")
     if not with_sentence:
         exclude.append("pysbd_sentencizer")
-    if not link_to:
+    if not link_to or link_key == "text":
         exclude.append("lemmatizer")
     nerd.load(
         ner_model,
         exclude=exclude,
         linker=link_to,
         threshold=thresh,
+        segmenter=segmenter,
+        link_key=link_key,
+        gazetteer=gazetteer,
+        gazetteer_mode=gazetteer_mode,
+        prefilter=prefilter,
+        prefilter_kb=prefilter_kb,
     )
 
     if output_dir:
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-    if input_text:
+    if jsonl:
+        annotate_jsonl(
+            nerd,
+            click.get_text_stream("stdin"),
+            click.get_text_stream("stdout"),
+            batch_size,
+            max_tokens,
+            text_key=text_key,
+            id_key=id_key,
+        )
+    elif output_format != "brat":
+        try:
+            writer = get_writer(output_format, output_dir, shard)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        with writer:
+            if input_text:
+                nerd.write("input", nerd.ner(input_text), writer)
+            elif filename and not is_collection(filename):
+                nerd.find_in_file(filename, writer=writer)
+            elif filename or input_dir or file_list:
+                nerd.find_in_corpus(
+                    filename or input_dir,
+                    recursive=recursive,
+                    file_list=file_list,
+                    shard=shard,
+                    text_key=text_key,
+                    id_key=id_key,
+                    writer=writer,
+                    batch_size=batch_size,
+                    max_tokens=max_tokens,
+                )
+    elif input_text:
         df = nerd.find_in_text(input_text)
         df.to_csv(sys.stdout, sep="\t", header=False)
     else:
         dfs = {}
-        if filename:
+        if filename and not is_collection(filename):
             dfs[os.path.basename(filename)] = nerd.find_in_file(filename, output_dir)
-        elif input_dir:
-            dfs = nerd.find_in_corpus(input_dir, output_dir)
+        elif filename or input_dir or file_list:
+            dfs = nerd.find_in_corpus(
+                filename or input_dir,
+                output_dir,
+                recursive,
+                file_list,
+                shard,
+                text_key,
+                id_key,
+                batch_size=batch_size,
+                max_tokens=max_tokens,
+            )
 
         if not output_dir:
             if len(dfs) > 1:
@@ -112,5 +367,64 @@ def ask(
                 dfs[filename].to_csv(sys.stdout, sep="\t", header=False)
 
 
+@cli.command()
+@click.argument("shard_dirs", nargs=-1, required=True)
+@click.option("--output-dir", "-o", type=str, help="Output directory", required=True)
+def merge(shard_dirs, output_dir):
+    """Merge the output directories of several shards into a single directory"""
+    for path in merge_outputs(shard_dirs, output_dir):
+        click.echo(path)
+
+
+@cli.group()
+def cache():
+    """Manage the local cache of entity linker data"""
+    pass
+
+
+@cache.command("prefetch")
+@click.argument("linkers", nargs=-1, required=True)
+@click.option(
+    "--revalidate",
+    type=bool,
+    help="Download again the files that have changed since they were cached",
+    is_flag=True,
+)
+@click.option(
+    "-j",
+    "--workers",
+    type=int,
+    help="Number of concurrent range requests used to download large files",
+    default=None,
+)
+def prefetch_linkers(linkers, revalidate, workers):
+    """Download the data of the given entity linkers for offline use"""
+    from taxonerd.linking.file_cache import prefetch
+    from taxonerd.linking.candidate_generation import get_linker_files
+
+    for linker in linkers:
+        files = get_linker_files(linker)
+        for path in prefetch(files, revalidate=revalidate, workers=workers):
+            click.echo(path)
+
+
+@cache.command("revalidate")
+@click.argument("linkers", nargs=-1)
+def revalidate_linkers(linkers):
+    """Update the cached data of the given entity linkers (default = all cached files)"""
+    from taxonerd.linking.file_cache import prefetch, read_cache_index
+    from taxonerd.linking.candidate_generation import get_linker_files
+
+    if linkers:
+        files = [f for linker in linkers for f in get_linker_files(linker)]
+    else:
+        files = [
+            (entry["url"], entry["name"]) if entry.get("name") else entry["url"]
+            for entry in read_cache_index().values()
+        ]
+    for path in prefetch(files, revalidate=True):
+        click.echo(path)
+
+
 def main():
     cli()
@@ -0,0 +1,286 @@
+"""
+Utilities for listing the documents of a corpus, for reading documents from archives
+and JSONL files, and for splitting a corpus into shards that are processed
+independently, e.g. on the nodes of a cluster.
+"""
+
+import os
+import io
+import gzip
+import json
+import shutil
+import tarfile
+import zipfile
+import posixpath
+from collections import Counter
+from fnmatch import fnmatch
+from glob import glob
+from hashlib import md5
+from typing import Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def read_file_list(file_list: str, input_dir: str = None) -> List[str]:
+    """
+    Return the paths listed in `file_list`, one per line. Relative paths are relative
+    to `input_dir` if given, or to the current directory otherwise.
+    """
+    with open(file_list) as f:
+        paths = [line.strip() for line in f]
+    return [
+        os.path.join(input_dir, path) if input_dir else path for path in paths if path
+    ]
+
+
+def list_files(
+    input_dir: str = None, recursive: bool = False, file_list: str = None
+) -> List[str]:
+    """
+    Return the sorted paths of the files of `input_dir` (and of its subdirectories if
+    `recursive` is True), or the paths listed in the `file_list` file.
+    """
+    if file_list:
+        return read_file_list(file_list, input_dir)
+    if not os.path.exists(input_dir):
+        raise FileNotFoundError("No such file or directory: {}".format(input_dir))
+    if recursive:
+        paths = glob(os.path.join(input_dir, "**", "*"), recursive=True)
+    else:
+        paths = glob(os.path.join(input_dir, "*"))
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def parse_shard(shard: Union[str, Tuple[int, int], None]) -> Tuple[int, int]:
+    """
+    Parse a shard specification "i/N" (the i-th of N shards, starting from 0).
+    No specification means a single shard, (0, 1).
+    """
+    if shard is None or isinstance(shard, tuple):
+        index, count = shard if shard else (0, 1)
+    else:
+        try:
+            index, count = (int(part) for part in shard.split("/"))
+        except ValueError:
+            raise ValueError("Invalid shard {}, expected i/N".format(shard))
+    if not 0 <= index < count:
+        raise ValueError(
+            "Invalid shard {}/{}, expected 0 <= i < N".format(index, count)
+        )
+    return index, count
+
+
+def in_shard(path: str, index: int, count: int) -> bool:
+    """
+    Return True if the document `path` (relative to the corpus directory) belongs to the
+    shard `index` out of `count`. Documents are assigned to shards by the hash of their
+    path, so adding documents to a corpus does not move the other documents to other
+    shards.
+    """
+    digest = md5(path.replace(os.sep, "/").encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count == index
+
+
+def doc_ids(paths: List[str], root: str = None) -> List[str]:
+    """
+    Return the id of each document: its path relative to `root` (by default, the common
+    directory of the documents), without extension. Documents sharing a name
+    (e.g. paper.pdf and paper.docx) are identified by their full filename.
+    """
+    if not paths:
+        return []
+    root = os.path.abspath(root) if root else corpus_root(paths)
+    stems = [os.path.splitext(os.path.abspath(path))[0] for path in paths]
+    counts = Counter(stems)
+    return [
+        os.path.relpath(os.path.abspath(path) if counts[stem] > 1 else stem, root)
+        for path, stem in zip(paths, stems)
+    ]
+
+
+def corpus_root(paths: List[str]) -> str:
+    """Return the deepest directory containing all the `paths`"""
+    return os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+
+
+# The files written by the writers of taxonerd.writers: the BRAT files of the
+# documents, and the JSONL, Parquet and DocBin files of the shards
+OUTPUT_PATTERNS = ("*.ann", "entities*.jsonl", "entities*.parquet", "docs*.spacy")
+
+
+def merge_outputs(shard_dirs: Iterable[str], output_dir: str) -> List[str]:
+    """
+    Copy the output files of the shards' output directories to `output_dir`, keeping
+    their relative paths, and return their new paths. The output files are the
+    annotation files of the documents and the JSONL, Parquet and DocBin files of the
+    shards, which are named after their shard. Raise ``FileExistsError`` if two shards
+    produced the same file, e.g. annotations for the same document, and warn about the
+    other files, which are not copied.
+    """
+    merged = []
+    for shard_dir in shard_dirs:
+        for path in sorted(glob(os.path.join(shard_dir, "**", "*"), recursive=True)):
+            if not os.path.isfile(path):
+                continue
+            name = os.path.basename(path)
+            if not any(fnmatch(name, pattern) for pattern in OUTPUT_PATTERNS):
+                logger.warning("{} is not an output file, not merged".format(path))
+                continue
+            output_path = os.path.join(output_dir, os.path.relpath(path, shard_dir))
+            if os.path.exists(output_path):
+                raise FileExistsError(
+                    "{} already exists, cannot merge {}".format(output_path, path)
+                )
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            shutil.copy2(path, output_path)
+            merged.append(output_path)
+    logger.info("Merged {} output files into {}".format(len(merged), output_dir))
+    return merged
+
+
+ARCHIVE_EXTENSIONS = (
+    ".tar",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".tbz2",
+    ".tar.xz",
+    ".txz",
+    ".zip",
+)
+JSONL_EXTENSIONS = (".jsonl", ".jsonl.gz", ".ndjson")
+
+
+def is_collection(path: str) -> bool:
+    """
+    Return True if `path` is an archive or a JSONL file containing several documents.
+    """
+    return os.path.isfile(path) and path.lower().endswith(
+        ARCHIVE_EXTENSIONS + JSONL_EXTENSIONS
+    )
+
+
+def collection_name(path: str) -> str:
+    """Return the name of a collection file, without its extension"""
+    for extension in ARCHIVE_EXTENSIONS + JSONL_EXTENSIONS:
+        if path.lower().endswith(extension):
+            return path[: -len(extension)]
+    return path
+
+
+def normalize_doc_id(doc_id: str) -> str:
+    """
+    Return `doc_id` as a relative posix path that stays inside the output directory
+    when used as the name of an annotation file.
+    """
+    parts = posixpath.normpath(doc_id.replace("\\", "/")).split("/")
+    return "/".join(
+        part if part != ".." else "_" for part in parts if part not in ("", ".")
+    )
+
+
+def unique_doc_id(doc_id: str, seen: Set[str]) -> Optional[str]:
+    """
+    Return `doc_id` if it is not in `seen` (ignoring case, as on case-insensitive file
+    systems), or `doc_id`_2, `doc_id`_3... otherwise, and add it to `seen`. Return None
+    for an empty id, which cannot name an annotation file.
+    """
+    if not doc_id:
+        return None
+    unique_id, i = doc_id, 1
+    while unique_id.lower() in seen:
+        i += 1
+        unique_id = "{}_{}".format(doc_id, i)
+    if unique_id != doc_id:
+        logger.warning("Duplicate document id {}, renamed {}".format(doc_id, unique_id))
+    seen.add(unique_id.lower())
+    return unique_id
+
+
+def iter_tar(path: str) -> Iterator[Tuple[str, str]]:
+    # Read the archive as a stream: members are decompressed one after the other,
+    # without seeking back
+    with tarfile.open(path, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if not member.name.endswith(".txt"):
+                logger.warning(
+                    "Skip {} in {}: not a text file".format(member.name, path)
+                )
+                continue
+            text = tar.extractfile(member).read().decode("utf-8", errors="replace")
+            yield normalize_doc_id(member.name[:-4]), text
+
+
+def iter_zip(path: str) -> Iterator[Tuple[str, str]]:
+    with zipfile.ZipFile(path) as archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            if not member.filename.endswith(".txt"):
+                logger.warning(
+                    "Skip {} in {}: not a text file".format(member.filename, path)
+                )
+                continue
+            with archive.open(member) as f:
+                text = f.read().decode("utf-8", errors="replace")
+            yield normalize_doc_id(member.filename[:-4]), text
+
+
+def iter_jsonl(
+    path: str, text_key: str = "text", id_key: str = "id"
+) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the (id, text) of each record of a JSONL file. Records without an id (or with
+    a null or empty id) are identified by their line number. Records that cannot be
+    read, or whose text is missing or not a string, are logged and skipped.
+    """
+    opener = gzip.open if path.lower().endswith(".gz") else io.open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                error = "{!r}".format(e)
+            else:
+                if not isinstance(record, dict):
+                    error = "not an object"
+                elif not isinstance(record.get(text_key), str):
+                    error = "{} is {}".format(
+                        text_key,
+                        "missing" if text_key not in record else "not a string",
+                    )
+                else:
+                    error = None
+            if error:
+                logger.error(
+                    "Invalid record on line {} of {}: {}. Skip.".format(
+                        i + 1, path, error
+                    )
+                )
+                continue
+            doc_id = record.get(id_key)
+            if doc_id is None or not normalize_doc_id(str(doc_id)):
+                doc_id = i
+            yield normalize_doc_id(str(doc_id)), record[text_key]
+
+
+def iter_collection(
+    path: str, text_key: str = "text", id_key: str = "id"
+) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the (id, text) of each document of an archive (text files of a tar or zip
+    archive, identified by their path in the archive) or of a JSONL file (records with
+    a `text_key` field, identified by their `id_key` field).
+    """
+    if path.lower().endswith(JSONL_EXTENSIONS):
+        yield from iter_jsonl(path, text_key, id_key)
+    elif path.lower().endswith(".zip"):
+        yield from iter_zip(path)
+    else:
+        yield from iter_tar(path)
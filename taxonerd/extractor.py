@@ -1,40 +1,438 @@
 import textract
 import os
+import json
+import tempfile
 from glob import glob
+from hashlib import sha256
 import re
+import time
+import signal
+import logging
+import itertools
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from queue import Queue, Full
+from taxonerd.linking.file_cache import CACHE_ROOT, FileLock
+
+EXTRACTION_CACHE = str(CACHE_ROOT / "extractions")
+# How long (in seconds) a stopped extraction is waited for
+STOP_TIMEOUT = 5
+# The (path, size, mtime) -> content hash index of the documents, in the cache directory.
+# Compacted when loaded, keeping the last entry of each document
+SOURCE_INDEX = "sources.jsonl"
+# Increment when the extracted text changes, e.g. when clean_text is modified
+EXTRACTION_VERSION = 1
+
+TAB_TO_SPACE = bytes.maketrans(b"\t", b" ")
+PARAGRAPH_BREAK = re.compile(b"(\n\n+)")
+MULTIPLE_SPACES = re.compile(b"  +")
+LEADING_PUNCTUATION = re.compile(r"^([^\w\s\(\)]\s*)*")
+# The length of the chunks of text cleaned at once by clean_text
+CLEAN_CHUNK_SIZE = 1 << 20
+
+
+def clean_text(text):
+    """
+    Remove non-ascii characters, word breaks and newlines inside paragraphs, collapse
+    whitespaces, and remove the punctuation at the beginning of `text`.
+
+    The text is cleaned in chunks of CLEAN_CHUNK_SIZE characters with iter_clean_text.
+    """
+    chunks = (
+        text[i : i + CLEAN_CHUNK_SIZE] for i in range(0, len(text), CLEAN_CHUNK_SIZE)
+    )
+    return "".join(iter_clean_text(chunks))
+
+
+def _clean_paragraphs(data):
+    # Remove newline characters in paragraphs: once the text is split on runs of
+    # newlines, the newlines left inside paragraphs are single newlines
+    parts = PARAGRAPH_BREAK.split(data)
+    parts[::2] = [paragraph.replace(b"\n", b" ") for paragraph in parts[::2]]
+    # Remove multiple whitespaces
+    return MULTIPLE_SPACES.sub(b" ", b"".join(parts)).decode("ascii")
+
+
+def iter_clean_text(chunks):
+    """
+    Clean the text read as an iterable of `chunks` like clean_text, and yield the
+    cleaned text as soon as its paragraphs are complete.
+
+    Same output as applying each normalization with a regular expression over the whole
+    text, but only the last, incomplete paragraph of the text read so far is kept in
+    memory.
+    """
+    data = b""
+    hyphen = False  # Whether the last chunk ends with "-", which may be a word break
+    head = ""  # The beginning of the text, until it has more than punctuation
+    tail = ""  # The trailing spaces and newlines, yielded if more text follows
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:  # End of the text
+            cleaned = _clean_paragraphs(data + b"-" if hyphen else data)
+        else:
+            # Remove non-ascii characters, and replace \t by whitespace
+            new = chunk.encode("ascii", "ignore").translate(TAB_TO_SPACE)
+            if hyphen:
+                new = b"-" + new
+            hyphen = new.endswith(b"-")
+            if hyphen:
+                new = new[:-1]
+            # Remove word breaks
+            data += new.replace(b"-\n", b"")
+            # Clean up to the end of the last paragraph break followed by text, as the
+            # newlines at the end may be continued by the next chunk
+            cut = data.rstrip(b"\n").rfind(b"\n\n")
+            if cut < 0:
+                continue
+            cleaned = _clean_paragraphs(data[: cut + 2])
+            data = data[cut + 2 :]
+        if head is not None:
+            # Remove leading newlines and punctuation
+            head = (head + cleaned).lstrip(" \n")
+            start = LEADING_PUNCTUATION.match(head).end()
+            if start == len(head):
+                continue
+            head, cleaned = None, head[start:]
+        # Remove trailing newlines
+        text = cleaned.rstrip(" \n")
+        if text:
+            yield tail + text
+            tail = ""
+        tail += cleaned[len(text) :]
+
+
+def _extraction_worker(extractor_class, kwargs, conn):
+    """
+    Extract the text of the paths received on `conn` with a new `extractor_class`
+    instance, and send back the output paths, until None is received. True is sent
+    once the worker is ready.
+    """
+    if hasattr(os, "setsid"):
+        # Start a new process group, so that the subprocesses spawned by textract
+        # (pdftotext, tesseract...) can be killed along with this process on timeout
+        os.setsid()
+    extractor = extractor_class(**kwargs)
+    conn.send(True)
+    while True:
+        try:
+            path = conn.recv()
+        except EOFError:
+            break
+        if path is None:
+            break
+        conn.send(extractor.extract_from_file(path))
+    conn.close()
+
+
+def get_worker_context(extractor_class):
+    """
+    Return the multiprocessing context of the extraction workers. Workers are not
+    forked from the caller, which may hold a loaded model and threads. If available,
+    they are forked from a fork server, which imports the module of `extractor_class`
+    once when it starts.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__, extractor_class.__module__])
+        return context
+    return multiprocessing.get_context("spawn")
 
 
 class TextExtractor:
-    def __init__(self, logger=None):
-        self.logger = logger
+    """
+    Extract the text of documents (pdf, docx, images...) with textract and write it
+    to .txt files in a cache directory. The cached text is keyed by the content of the
+    document and the extraction settings, so a document is only extracted once.
+
+    Parameters
+    ----------
+    logger: logging.Logger, optional (default = None)
+    n_jobs: int, optional (default = 1)
+        The number of documents extracted in parallel, in a pool of worker processes.
+        Each worker creates its own extractor of the same class, with the `cache_dir`
+        and `clean_txt` arguments.
+    timeout: float, optional (default = None)
+        The maximum number of seconds spent extracting a single document. Documents
+        that take longer are skipped. If set, documents are always extracted in a
+        separate process, even if `n_jobs` is 1.
+    cache_dir: str, optional (default = None)
+        The directory of the cached text ($TAXONERD_CACHE/extractions by default).
+    clean_txt: bool, optional (default = False)
+        Whether to clean the text of .txt files too. By default, .txt files are used as is.
+    """
+
+    def __init__(
+        self, logger=None, n_jobs=1, timeout=None, cache_dir=None, clean_txt=False
+    ):
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.n_jobs = max(1, n_jobs)
+        self.timeout = timeout
+        self.cache_dir = cache_dir if cache_dir else EXTRACTION_CACHE
+        self.clean_txt = clean_txt
+        self.output_paths = None  # Loaded from the source index on first use
 
     def __call__(self, path):
         if not os.path.exists(path):
             raise FileNotFoundError("No such file or directory: {}".format(path))
         if os.path.isdir(path):
             files = [f for f in glob(os.path.join(path, "*"))]
-            for f in files:
-                self.extract_from_file(f)
+            self.extract_from_files(files)
             return path
         elif os.path.isfile(path):
-            output_path = self.extract_from_file(path)
+            output_path = self.extract_from_files([path])[0]
             return output_path
 
+    def extract_from_files(self, paths):
+        """
+        Extract the text of `paths` and return the list of the output paths (None for
+        the documents that could not be extracted), in the same order.
+        """
+        output_paths = [None] * len(paths)
+        for i, output_path in self.iter_extract_from_files(paths):
+            output_paths[i] = output_path
+        return output_paths
+
+    def iter_extract(self, paths, queue_size=None):
+        """
+        Extract the text of `paths` in a background thread, and yield (path, output_path)
+        pairs as soon as each document is extracted, in completion order. At most
+        `queue_size` extracted documents (default = 2 * n_jobs) wait to be consumed,
+        so that extraction does not get too far ahead of the consumer.
+
+        If the consumer stops early, the running extraction processes are killed. An
+        extraction running in the background thread itself (`n_jobs` = 1 without
+        timeout) cannot be interrupted: it is waited for up to STOP_TIMEOUT seconds,
+        then left behind.
+        """
+        queue = Queue(maxsize=queue_size or 2 * self.n_jobs)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def produce():
+            extraction = self.iter_extract_from_files(paths, stop)
+            try:
+                for i, output_path in extraction:
+                    if not put((paths[i], output_path)):
+                        return
+            except Exception as e:
+                put(e)
+            else:
+                put(done)
+            finally:
+                extraction.close()
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join(STOP_TIMEOUT)
+            if producer.is_alive():
+                self.logger.warning(
+                    "Text extraction still running after {}s, leave it".format(
+                        STOP_TIMEOUT
+                    )
+                )
+
+    def iter_extract_from_files(self, paths, stop=None):
+        """
+        Extract the text of `paths` and yield (index in paths, output_path) pairs in
+        completion order. The extraction stops as soon as possible once the `stop`
+        event (a `threading.Event`) is set.
+        """
+        if self.n_jobs == 1 and self.timeout is None:
+            for i, path in enumerate(paths):
+                if stop is not None and stop.is_set():
+                    return
+                yield i, self.extract_from_file(path)
+        else:
+            yield from self.iter_extract_in_processes(paths, stop)
+
+    @property
+    def worker_kwargs(self):
+        """The arguments of the extractor created in each extraction worker"""
+        return {"cache_dir": self.cache_dir, "clean_txt": self.clean_txt}
+
+    def start_worker(self, context):
+        conn, worker_conn = context.Pipe()
+        process = context.Process(
+            target=_extraction_worker,
+            args=(type(self), self.worker_kwargs, worker_conn),
+            daemon=True,
+        )
+        process.start()
+        worker_conn.close()
+        return process, conn
+
+    def stop_worker(self, process, conn, kill=False):
+        if not kill:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=1)
+        if process.is_alive():
+            self.kill(process)
+            process.join()
+        conn.close()
+
+    def iter_extract_in_processes(self, paths, stop=None):
+        """
+        Extract the text of `paths` in a pool of `n_jobs` worker processes, and yield
+        (index in paths, output_path) pairs in completion order. A worker that exceeds
+        the timeout is killed, and replaced by a new one. The timeout of a document
+        starts once its worker is ready.
+        """
+        # Documents are checked one at a time as they are dispatched, so that the first
+        # results do not wait for the whole corpus to be hashed
+        pending = iter(range(len(paths)))
+        exhausted = False
+        context = get_worker_context(type(self))
+        idle = []  # (process, connection)
+        running = {}  # connection -> (index, process, deadline)
+        try:
+            while not exhausted or running:
+                while not exhausted and len(running) < self.n_jobs:
+                    i = next(pending, None)
+                    if i is None:
+                        exhausted = True
+                        break
+                    # Text files and cached documents are returned as is, no need to
+                    # send them to a worker
+                    if self.is_text(paths[i]):
+                        yield i, paths[i]
+                        continue
+                    output_path = self.get_output_path(paths[i])
+                    if os.path.exists(output_path):
+                        yield i, output_path
+                        continue
+                    if idle:
+                        process, conn = idle.pop()
+                        ready = True
+                    else:
+                        process, conn = self.start_worker(context)
+                        ready = False
+                    conn.send(paths[i])
+                    deadline = (
+                        time.monotonic() + self.timeout
+                        if self.timeout and ready
+                        else None
+                    )
+                    running[conn] = (i, process, deadline)
+                if not running:
+                    continue
+
+                deadlines = [d for _, _, d in running.values() if d is not None]
+                timeout = (
+                    max(0, min(deadlines) - time.monotonic()) if deadlines else None
+                )
+                if stop is not None:
+                    # Check the stop event regularly
+                    timeout = min(timeout, 0.1) if timeout is not None else 0.1
+                wait(list(running), timeout=timeout)
+                if stop is not None and stop.is_set():
+                    return
+
+                now = time.monotonic()
+                for conn, (i, process, deadline) in list(running.items()):
+                    output_path = None
+                    if conn.poll():
+                        try:
+                            output_path = conn.recv()
+                            if output_path is True:  # The worker is ready
+                                if self.timeout:
+                                    deadline = now + self.timeout
+                                    running[conn] = (i, process, deadline)
+                                continue
+                            idle.append((process, conn))
+                        except EOFError:
+                            process.join()
+                            self.logger.error(
+                                "Extraction process exited with code {}. In file {}. Skip.".format(
+                                    process.exitcode, paths[i]
+                                )
+                            )
+                            conn.close()
+                    elif deadline is None or now < deadline:
+                        continue
+                    else:
+                        self.logger.error(
+                            "Timeout after {}s. In file {}. Skip.".format(
+                                self.timeout, paths[i]
+                            )
+                        )
+                        self.stop_worker(process, conn, kill=True)
+                    del running[conn]
+                    yield i, output_path
+        finally:
+            # The consumer stopped early, do not leave processes behind
+            for conn, (i, process, deadline) in running.items():
+                self.stop_worker(process, conn, kill=True)
+            for process, conn in idle:
+                self.stop_worker(process, conn)
+
+    def kill(self, process):
+        if hasattr(os, "killpg"):
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:  # the process group was not created yet
+                process.kill()
+        else:
+            process.kill()
+
     def extract_from_file(self, path):
-        if os.path.basename(path).endswith(".txt"):
+        if self.is_text(path):
             return path
         output_path = self.get_output_path(path)
+        if os.path.exists(output_path):
+            self.logger.info("Use text of {} cached in {}".format(path, output_path))
+            return output_path
         self.logger.info("Extract text from {} to {}".format(path, output_path))
         try:
-            text = textract.process(path).decode("utf-8")
+            text = self.process(path)
         except Exception as e:
             self.logger.error("{}. In file {}. Skip.".format(e, path))
         else:
-            with open(output_path, "w") as f:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            # Write to a temporary file then rename it, so that the cache never
+            # contains partial text
+            tmp_path = "{}.tmp-{}".format(output_path, os.getpid())
+            with open(tmp_path, "w") as f:
                 f.write(self.clean_text(text))
+            os.replace(tmp_path, output_path)
             return output_path
         return None
 
+    def is_text(self, path):
+        """Return True if `path` is a text file that does not need to be extracted"""
+        if not path.endswith(".txt"):
+            return False
+        cache_dir = os.path.join(os.path.abspath(self.cache_dir), "")
+        return not self.clean_txt or os.path.abspath(path).startswith(cache_dir)
+
+    def process(self, path):
+        if path.endswith(".txt"):
+            with open(path, "r") as f:
+                return f.read()
+        return textract.process(path).decode("utf-8")
+
     # def extract_from_pdf_file(self, path):
     #     output_path = self.get_output_path(path)
     #     self.logger.info("Extract text from {} to {}".format(path, output_path))
@@ -45,21 +443,7 @@ class TextExtractor:
     #     return output_path
 
     def clean_text(self, text):
-        # Remove non-ascii characters
-        text = text.encode("ascii", "ignore").decode()
-        # Replace \t by whitespace
-        text = re.sub("\t+", " ", text)
-        # Remove word break
-        text = re.sub("-\n", "", text)
-        # Remove newline characters in paragraphs
-        text = re.sub("(?<!\n)\n(?!\n)", " ", text)
-        # Remove multiple whitespaces
-        text = re.sub(" +", " ", text)
-        # Remove trailing newlines
-        text = text.strip(" \n")
-        # Remove punctuation at beginning
-        text = re.sub("^([^\w\s\(\)]\s*)*", "", text)
-        return text
+        return clean_text(text)
 
     # def post_processing(self, text):
     #     # Replace \t by whitespace
@@ -74,10 +458,81 @@ class TextExtractor:
     #     text = text.strip(" \n")
     #     return text
 
+    @property
+    def settings(self):
+        """The settings that the extracted text depends on"""
+        return {
+            "version": EXTRACTION_VERSION,
+            "extractor": "{}.{}".format(type(self).__module__, type(self).__name__),
+        }
+
+    @property
+    def settings_key(self):
+        return json.dumps(self.settings, sort_keys=True)
+
+    def load_source_index(self):
+        """
+        Return the (path, size, mtime) -> filename map of the documents hashed with the
+        settings of this extractor, read from the source index of the cache directory.
+
+        The index is compacted on load: only the last entry of each (path, settings)
+        pair is kept, the older ones being those of modified documents.
+        """
+        index_path = os.path.join(self.cache_dir, SOURCE_INDEX)
+        if not os.path.exists(index_path):
+            return {}
+        entries = {}
+        n_lines = 0
+        # Appends of concurrent extractors would be lost by the compaction
+        with FileLock(index_path + ".lock"):
+            with open(index_path) as f:
+                for line in f:
+                    n_lines += 1
+                    try:
+                        path, size, mtime, key, filename = json.loads(line)
+                    except ValueError:  # e.g. a line of an interrupted write
+                        continue
+                    entries.pop((path, key), None)
+                    entries[(path, key)] = (size, mtime, filename)
+            if n_lines > len(entries):
+                # Write to a temporary file then rename it, so that readers never see
+                # a partial index
+                with tempfile.NamedTemporaryFile(
+                    "w", dir=self.cache_dir, prefix=SOURCE_INDEX, delete=False
+                ) as index_file:
+                    for (path, key), (size, mtime, filename) in entries.items():
+                        index_file.write(
+                            json.dumps([path, size, mtime, key, filename]) + "\n"
+                        )
+                os.replace(index_file.name, index_path)
+        settings_key = self.settings_key
+        return {
+            (path, size, mtime): filename
+            for (path, key), (size, mtime, filename) in entries.items()
+            if key == settings_key
+        }
+
+    def add_to_source_index(self, source, filename):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index_path = os.path.join(self.cache_dir, SOURCE_INDEX)
+        line = json.dumps(list(source) + [self.settings_key, filename]) + "\n"
+        with FileLock(index_path + ".lock"):
+            with open(index_path, "a") as f:
+                f.write(line)
+
     def get_output_path(self, path):
-        tokens = os.path.basename(path).split(".")
-        if len(tokens):
-            filename = ".".join(tokens[:-1]) + ".txt"
-        dirname = os.path.dirname(path)
-        output_path = os.path.join(dirname, filename)
-        return output_path
+        # Documents are only hashed again if they have been modified, even across runs
+        if self.output_paths is None:
+            self.output_paths = self.load_source_index()
+        stat = os.stat(path)
+        source = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if source not in self.output_paths:
+            key = sha256(self.settings_key.encode("utf-8"))
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    key.update(chunk)
+            filename = key.hexdigest()
+            self.output_paths[source] = filename
+            self.add_to_source_index(source, filename)
+        filename = self.output_paths[source]
+        return os.path.join(self.cache_dir, filename[:2], filename + ".txt")
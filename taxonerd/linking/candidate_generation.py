@@ -3,6 +3,7 @@ from os import path
 import json
 import datetime
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import scipy
 import numpy
@@ -13,6 +14,8 @@ from nmslib.dist import FloatIndex
 
 from .file_cache import cached_path
 from .linking_utils import KnowledgeBase, KnowledgeBaseFactory
+from .mmap_utils import load_sparse_matrix, load_string_array
+from .vectorizer import TrigramVectorizer
 import logging
 
 from pathlib import Path
@@ -151,6 +154,18 @@ class LinkerPathsFactory:
         return None
 
 
+def get_linker_files(name: str) -> List[Union[str, Tuple[str, str]]]:
+    """
+    Return the (possibly remote) paths to all the files used by a pretrained entity linker,
+    i.e. its KB and its LinkerPaths.
+    """
+    linker_paths = LinkerPathsFactory().get_linker_paths(name)
+    kb_path = KnowledgeBaseFactory().get_kb_path(name)
+    if linker_paths is None or kb_path is None:
+        raise ValueError(f"Unknown entity linker {name}")
+    return [kb_path] + list(linker_paths)
+
+
 class MentionCandidate(NamedTuple):
     """
     A data class representing a candidate entity that a mention may be linked to.
@@ -171,8 +186,66 @@ class MentionCandidate(NamedTuple):
     similarities: List[float]
 
 
+TFIDF_VECTORS_DTYPES = ("float32", "float16", "uint8")
+
+
+def quantize_tfidf_vectors(
+    vectors: scipy.sparse.csr_matrix, dtype: str = "float16"
+) -> scipy.sparse.csr_matrix:
+    """
+    Convert tf-idf vectors to a reduced-precision storage type.
+
+    Parameters
+    ----------
+    vectors: scipy.sparse.csr_matrix, required.
+        The tf-idf vectors of the aliases in the KB, one row per alias.
+    dtype: str, optional (default = "float16")
+        One of "float32", "float16" or "uint8". With "uint8", each row is rescaled so
+        that its largest weight maps to 255. The per-row scale is not stored, so only
+        the cosine similarity between vectors is preserved (up to rounding): their
+        norms and dot products are not. The index only uses cosine similarity.
+    """
+    if dtype not in TFIDF_VECTORS_DTYPES:
+        raise ValueError(
+            f"Unsupported dtype {dtype} for tf-idf vectors. Expected one of {TFIDF_VECTORS_DTYPES}"
+        )
+    vectors = scipy.sparse.csr_matrix(vectors)
+    if dtype != "uint8":
+        return vectors.astype(dtype)
+    row_max = vectors.max(axis=1).toarray().reshape(-1)
+    row_max[row_max == 0] = 1.0
+    scale = numpy.repeat(255.0 / row_max, numpy.diff(vectors.indptr))
+    quantized = scipy.sparse.csr_matrix(
+        (
+            numpy.rint(vectors.data * scale).astype(numpy.uint8),
+            vectors.indices,
+            vectors.indptr,
+        ),
+        shape=vectors.shape,
+    )
+    # Weights far below the row maximum round to zero
+    quantized.eliminate_zeros()
+    return quantized
+
+
+def add_tfidf_vectors(
+    ann_index: FloatIndex, vectors: scipy.sparse.csr_matrix, chunk_size: int = 100000
+) -> None:
+    """
+    Add tf-idf vectors to an nmslib index, converting them to float32 one chunk
+    at a time so that no full float32 copy of reduced-precision vectors is made.
+    """
+    vectors = scipy.sparse.csr_matrix(vectors)
+    for start in range(0, vectors.shape[0], chunk_size):
+        end = min(start + chunk_size, vectors.shape[0])
+        ann_index.addDataPointBatch(
+            vectors[start:end].astype(numpy.float32, copy=False),
+            ids=numpy.arange(start, end, dtype=numpy.int32),
+        )
+
+
 def load_approximate_nearest_neighbours_index(
-    linker_paths: LinkerPaths, ef_search: int = 200
+    linker_paths: LinkerPaths, ef_search: int = 200, mmap: bool = False
 ) -> FloatIndex:
     """
     Load an approximate nearest neighbours index from disk.
@@ -181,20 +254,31 @@ def load_approximate_nearest_neighbours_index(
     ----------
     linker_paths: LinkerPaths, required.
         Contains the paths to the data required for the entity linker.
+        The tf-idf vectors may be stored as float32, float16 or uint8.
     ef_search: int, optional (default = 200)
         Controls speed performance at query time. Max value is 2000,
         but reducing to around ~100 will increase query speed by an order
         of magnitude for a small performance hit.
+    mmap: bool, optional (default = False)
+        If True, the tf-idf vectors are read from memory-mapped files instead of
+        being decompressed in memory. Note that nmslib still keeps its own copy of
+        the vectors in the index.
     """
-    concept_alias_tfidfs = scipy.sparse.load_npz(
-        cached_path(linker_paths.tfidf_vectors)
-    ).astype(numpy.float32)
+    if mmap:
+        concept_alias_tfidfs = load_sparse_matrix(
+            cached_path(linker_paths.tfidf_vectors)
+        )
+    else:
+        concept_alias_tfidfs = scipy.sparse.load_npz(
+            cached_path(linker_paths.tfidf_vectors)
+        )
     ann_index = nmslib.init(
         method="hnsw",
         space="cosinesimil_sparse",
         data_type=nmslib.DataType.SPARSE_VECTOR,
     )
-    ann_index.addDataPointBatch(concept_alias_tfidfs)
+    add_tfidf_vectors(ann_index, concept_alias_tfidfs)
+    del concept_alias_tfidfs
     ann_index.loadIndex(cached_path(linker_paths.ann_index))
     query_time_params = {"efSearch": ef_search}
     ann_index.setQueryTimeParams(query_time_params)
@@ -202,6 +286,17 @@ def load_approximate_nearest_neighbours_index(
     return ann_index
 
 
+def load_tfidf_vectorizer(linker_paths: LinkerPaths) -> TfidfVectorizer:
+    return joblib.load(cached_path(linker_paths.tfidf_vectorizer))
+
+
+def load_concept_aliases_list(linker_paths: LinkerPaths, mmap: bool = False):
+    if mmap:
+        return load_string_array(cached_path(linker_paths.concept_aliases_list))
+    with open(cached_path(linker_paths.concept_aliases_list)) as f:
+        return json.load(f)
+
+
 class CandidateGenerator:
     """
     A candidate generator for entity linking to a KnowledgeBase. Currently, two defaults are available:
@@ -211,6 +306,8 @@ class CandidateGenerator:
     To use these configured default KBs, pass the `name` parameter, either 'umls' or 'mesh'.
 
     It uses a sklearn.TfidfVectorizer to embed mention text into a sparse embedding of character 3-grams.
+    When the TfidfVectorizer uses the default char_wb 3-gram analyzer, it is replaced by an equivalent,
+    faster TrigramVectorizer.
     These are then compared via cosine distance in a pre-indexed approximate nearest neighbours index of
     a subset of all entities and aliases in the KB.
 
@@ -249,6 +346,9 @@ class CandidateGenerator:
         if a preconstructed ann_index is passed.
     name: str, optional (default = None)
         The name of the prPathetrained entity linker to load. Must be one of 'umls' or 'mesh'.
+    mmap: bool, optional (default = False)
+        If True, the KB, the concept aliases list and the tf-idf vectors are memory-mapped,
+        so that processes running on the same host share a single copy of them.
     """
 
     def __init__(
@@ -260,6 +360,7 @@ class CandidateGenerator:
         verbose: bool = False,
         ef_search: int = 200,
         name_or_path: str = None,
+        mmap: bool = False,
     ) -> None:
         if name_or_path is not None and any(
             [ann_index, tfidf_vectorizer, ann_concept_aliases_list]  # , kb]
@@ -270,18 +371,40 @@ class CandidateGenerator:
 
         name_or_path = name_or_path or "gbif_backbone"
         logger.info(f"Initialize LinkerPaths with name or path {name_or_path}")
-        self.kb = kb or KnowledgeBaseFactory().get_kb(name_or_path)
         linker_paths = LinkerPathsFactory().get_linker_paths(name_or_path)
 
-        self.ann_index = ann_index or load_approximate_nearest_neighbours_index(
-            linker_paths=linker_paths, ef_search=ef_search
-        )
-        self.vectorizer = tfidf_vectorizer or joblib.load(
-            cached_path(linker_paths.tfidf_vectorizer)
-        )
-        self.ann_concept_aliases_list = ann_concept_aliases_list or json.load(
-            open(cached_path(linker_paths.concept_aliases_list))
-        )
+        # The KB, the index, the vectorizer and the aliases list are independent
+        # and mostly I/O bound, so they are loaded concurrently.
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            if kb is None:
+                kb = executor.submit(
+                    KnowledgeBaseFactory().get_kb, name_or_path, mmap=mmap
+                )
+            if ann_index is None:
+                ann_index = executor.submit(
+                    load_approximate_nearest_neighbours_index,
+                    linker_paths=linker_paths,
+                    ef_search=ef_search,
+                    mmap=mmap,
+                )
+            if tfidf_vectorizer is None:
+                tfidf_vectorizer = executor.submit(
+                    load_tfidf_vectorizer, linker_paths=linker_paths
+                )
+            if ann_concept_aliases_list is None:
+                ann_concept_aliases_list = executor.submit(
+                    load_concept_aliases_list, linker_paths=linker_paths, mmap=mmap
+                )
+
+        def result(value):
+            return value.result() if isinstance(value, Future) else value
+
+        self.kb = result(kb)
+        self.ann_index = result(ann_index)
+        self.vectorizer = result(tfidf_vectorizer)
+        if TrigramVectorizer.is_supported(self.vectorizer):
+            self.vectorizer = TrigramVectorizer.from_tfidf_vectorizer(self.vectorizer)
+        self.ann_concept_aliases_list = result(ann_concept_aliases_list)
 
         self.verbose = verbose
 
@@ -426,7 +549,7 @@ class CandidateGenerator:
 
 
 def create_tfidf_ann_index(
-    out_path: str, kb: KnowledgeBase = None
+    out_path: str, kb: KnowledgeBase = None, vectors_dtype: str = "float32"
 ) -> Tuple[List[str], TfidfVectorizer, FloatIndex]:
     """
     Build tfidf vectorizer and ann index.
@@ -437,7 +560,10 @@ def create_tfidf_ann_index(
         The path where the various model pieces will be saved.
     kb : KnowledgeBase, optional.
         The kb items to generate the index and vectors for.
-
+    vectors_dtype: str, optional (default = "float32")
+        The storage type of the tf-idf vectors, one of "float32", "float16" or "uint8".
+        The index is built from the stored vectors, so that it matches what
+        `load_approximate_nearest_neighbours_index` will load.
     """
     tfidf_vectorizer_path = f"{out_path}/tfidf_vectorizer.joblib"
     ann_index_path = f"{out_path}/nmslib_index.bin"
@@ -474,9 +600,10 @@ def create_tfidf_ann_index(
     concept_aliases = list(kb.alias_to_cuis.keys())
 
     # NOTE: here we are creating the tf-idf vectorizer with float32 type, but we can serialize the
-    # resulting vectors using float16, meaning they take up half the memory on disk. Unfortunately
-    # we can't use the float16 format to actually run the vectorizer, because of this bug in sparse
-    # matrix representations in scipy: https://github.com/scipy/scipy/issues/7408
+    # resulting vectors using float16 or uint8 (see `vectors_dtype`), meaning they take up half or
+    # a quarter of the memory on disk. Unfortunately we can't use the float16 format to actually run
+    # the vectorizer, because of this bug in sparse matrix representations in scipy:
+    # https://github.com/scipy/scipy/issues/7408
     print(f"Fitting tfidf vectorizer on {len(concept_aliases)} aliases")
     tfidf_vectorizer = TfidfVectorizer(
         analyzer="char_wb", ngram_range=(3, 3), min_df=10, dtype=numpy.float32
@@ -513,9 +640,8 @@ def create_tfidf_ann_index(
     )
     json.dump(concept_aliases, open(uml_concept_aliases_path, "w"))
 
-    scipy.sparse.save_npz(
-        tfidf_vectors_path, concept_alias_tfidfs  # .astype(numpy.float16)
-    )
+    concept_alias_tfidfs = quantize_tfidf_vectors(concept_alias_tfidfs, vectors_dtype)
+    scipy.sparse.save_npz(tfidf_vectors_path, concept_alias_tfidfs)
 
     print(f"Fitting ann index on {len(concept_aliases)} aliases (takes 2 hours)")
     start_time = datetime.datetime.now()
@@ -524,7 +650,7 @@ def create_tfidf_ann_index(
         space="cosinesimil_sparse",
         data_type=nmslib.DataType.SPARSE_VECTOR,
     )
-    ann_index.addDataPointBatch(concept_alias_tfidfs)
+    add_tfidf_vectors(ann_index, concept_alias_tfidfs)
     ann_index.createIndex(index_params, print_progress=True)
     ann_index.saveIndex(ann_index_path)
     end_time = datetime.datetime.now()
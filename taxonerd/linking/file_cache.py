@@ -3,35 +3,59 @@ Utilities for working with the local dataset cache.
 """
 
 import os
-import shutil
 import tempfile
 import json
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from pathlib import Path
-from typing import Tuple, Union, IO
+from typing import Dict, Iterable, List, Optional, Tuple, Union, IO
 from hashlib import sha256
 
 import requests
 import logging
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 CACHE_ROOT = Path(os.getenv("TAXONERD_CACHE", str(Path.home() / ".taxonerd")))
 DATASET_CACHE = str(CACHE_ROOT / "datasets")
+CACHE_INDEX = "index.json"
+OFFLINE = os.getenv("TAXONERD_OFFLINE", "").lower() not in ("", "0", "false")
+DOWNLOAD_WORKERS = int(os.getenv("TAXONERD_DOWNLOAD_WORKERS", "1"))
+DOWNLOAD_TIMEOUT = float(os.getenv("TAXONERD_DOWNLOAD_TIMEOUT", "60"))
+DOWNLOAD_RETRIES = 3
+CHUNK_SIZE = 1024 * 1024
+PARALLEL_DOWNLOAD_MIN_SIZE = 64 * CHUNK_SIZE
 
 logger = logging.getLogger(__name__)
 
 
-def cached_path(url_or_filename: Union[str, Path, Tuple], cache_dir: str = None) -> str:
+def cached_path(
+    url_or_filename: Union[str, Path, Tuple],
+    cache_dir: str = None,
+    revalidate: bool = False,
+    workers: int = None,
+) -> str:
     """
     Given something that might be a URL (or might be a local path),
     determine which. If it's a URL, download the file and cache it, and
     return the path to the cached file. If it's already a local path,
     make sure the file exists and then return the path.
+    A URL that is already cached is resolved without network access,
+    unless `revalidate` is True (see `get_from_cache`).
+    `url_or_filename` may also be a (url, name) or (url, name, sha256) tuple.
     """
     if cache_dir is None:
         cache_dir = DATASET_CACHE
 
     user_friendly_name = None
+    checksum = None
     if type(url_or_filename) is tuple:
+        if len(url_or_filename) > 2:
+            checksum = url_or_filename[2]
         user_friendly_name = url_or_filename[1]
         url_or_filename = url_or_filename[0]
 
@@ -42,7 +66,14 @@ def cached_path(url_or_filename: Union[str, Path, Tuple], cache_dir: str = None)
 
     if parsed.scheme in ("http", "https"):
         # URL, so get it from the cache (downloading if necessary)
-        return get_from_cache(url_or_filename, user_friendly_name, cache_dir)
+        return get_from_cache(
+            url_or_filename,
+            user_friendly_name,
+            cache_dir,
+            revalidate=revalidate,
+            checksum=checksum,
+            workers=workers,
+        )
     elif os.path.exists(url_or_filename):
         # File, and it exists.
         return url_or_filename
@@ -101,24 +132,316 @@ def filename_to_url(filename: str, cache_dir: str = None) -> Tuple[str, str]:
     return url, etag
 
 
-def http_get(url: str, temp_file: IO) -> None:
-    req = requests.get(url, stream=True)
-    for chunk in req.iter_content(chunk_size=1024):
-        if chunk:  # filter out keep-alive new chunks
-            temp_file.write(chunk)
+class FileLock:
+    """
+    An exclusive lock shared between processes, held while the context is active.
+    Used to make sure that a single process downloads each file of the cache.
 
+    Parameters
+    ----------
+    path: str, required.
+        The path to the lock file, which is created if it does not exist.
+    """
 
-def get_from_cache(url: str, name: str, cache_dir: str = None) -> str:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.path, "a+b")
+        if fcntl:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.lock_file.seek(0)
+            while True:
+                try:  # LK_LOCK gives up after 10 seconds
+                    msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        return self
+
+    def __exit__(self, *args):
+        if fcntl:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.lock_file.close()
+
+
+def http_get(url: str, temp_file: IO, checksum=None) -> None:
+    """
+    Download `url` to `temp_file`, which must be opened in binary read/write mode.
+    If the file already contains the beginning of an interrupted download, only the
+    missing bytes are requested, unless the server does not support range requests.
+    `checksum` is a hashlib object, updated with the whole content of the file.
+    Raise ``requests.Timeout`` or ``requests.ConnectionError`` if the server does not
+    respond for DOWNLOAD_TIMEOUT seconds, leaving the partial content in `temp_file`.
+    """
+    temp_file.seek(0, os.SEEK_END)
+    resume_from = temp_file.tell()
+    headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+    req = requests.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    if resume_from and req.status_code == 206:
+        logger.info(f"Resume download of {url} from byte {resume_from}")
+        if checksum is not None:
+            temp_file.seek(0)
+            for chunk in iter(lambda: temp_file.read(CHUNK_SIZE), b""):
+                checksum.update(chunk)
+    elif resume_from:
+        temp_file.seek(0)
+        temp_file.truncate()
+        if req.status_code != 200:  # e.g. 416 if the range is not satisfiable
+            req.close()
+            req = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    with req:
+        req.raise_for_status()
+        for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:  # filter out keep-alive new chunks
+                temp_file.write(chunk)
+                if checksum is not None:
+                    checksum.update(chunk)
+    temp_file.flush()
+
+
+def http_get_ranges(url: str, temp_file: IO, size: int, workers: int) -> None:
+    """
+    Download `url` to `temp_file` with `workers` concurrent range requests.
+    The server must support range requests, and `size` is the size of the file.
+    """
+    temp_file.truncate(size)
+    step = -(-size // workers)
+
+    def get_range(start):
+        end = min(start + step, size) - 1
+        headers = {"Range": f"bytes={start}-{end}"}
+        with requests.get(
+            url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT
+        ) as req:
+            req.raise_for_status()
+            if req.status_code != 206:
+                raise IOError(f"Range request not supported for url {url}")
+            offset = start
+            for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    os.pwrite(temp_file.fileno(), chunk, offset)
+                    offset += len(chunk)
+        if offset != end + 1:
+            raise IOError(f"Incomplete download of bytes {start}-{end} of url {url}")
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(get_range, range(0, size, step)))
+
+
+def download(
+    url: str,
+    cache_path: str,
+    headers: Dict[str, str] = None,
+    checksum: str = None,
+    workers: int = 1,
+) -> str:
+    """
+    Download `url` to `cache_path` and return the sha256 checksum of its content.
+    The file is downloaded next to `cache_path` and renamed once complete, so that
+    `cache_path` never contains a partial file. An interrupted download is resumed
+    from where it stopped, up to DOWNLOAD_RETRIES times if the connection times out or
+    is lost. If `workers` > 1 and the HEAD response `headers` show that
+    the server supports range requests, large files are downloaded in parallel.
+    Raise ``IOError`` if the sha256 `checksum` of the file is given and does not match.
+    """
+    headers = headers or {}
+    size = int(headers.get("Content-Length", 0))
+    part_path = cache_path + ".part"
+    content_hash = sha256()
+
+    def verify_and_rename(temp_path):
+        if checksum and content_hash.hexdigest() != checksum.lower():
+            os.remove(temp_path)
+            raise IOError(
+                "Checksum mismatch for url {}: expected {}, got {}".format(
+                    url, checksum, content_hash.hexdigest()
+                )
+            )
+        os.replace(temp_path, cache_path)
+
+    if (
+        workers > 1
+        and size >= PARALLEL_DOWNLOAD_MIN_SIZE
+        and headers.get("Accept-Ranges") == "bytes"
+        and hasattr(os, "pwrite")
+    ):
+        # Ranges are downloaded out of order, so the download cannot be resumed
+        ranges_path = cache_path + ".ranges"
+        logger.info(f"Downloading {url} to {ranges_path} with {workers} workers")
+        try:
+            with open(ranges_path, "w+b") as temp_file:
+                http_get_ranges(url, temp_file, size, workers)
+                temp_file.seek(0)
+                for chunk in iter(lambda: temp_file.read(CHUNK_SIZE), b""):
+                    content_hash.update(chunk)
+            verify_and_rename(ranges_path)
+        finally:
+            if os.path.exists(ranges_path):
+                os.remove(ranges_path)
+    else:
+        logger.info(f"Downloading {url} to {part_path}")
+        for attempt in range(DOWNLOAD_RETRIES, -1, -1):
+            content_hash = sha256()
+            try:
+                with open(part_path, "a+b") as temp_file:
+                    http_get(url, temp_file, content_hash)
+                break
+            except (requests.Timeout, requests.ConnectionError) as e:
+                if not attempt:
+                    raise
+                logger.warning(f"Download of {url} interrupted ({e}), resume it")
+        verify_and_rename(part_path)
+    return content_hash.hexdigest()
+
+
+def read_cache_index(cache_dir: str = None) -> Dict[str, Dict[str, str]]:
+    """
+    Return the index of the cache, which maps the url (and user friendly name)
+    of each downloaded file to its filename in the cache and its etag.
+    """
+    if cache_dir is None:
+        cache_dir = DATASET_CACHE
+
+    index_path = os.path.join(cache_dir, CACHE_INDEX)
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path) as index_file:
+            return json.load(index_file)
+    except ValueError:
+        logger.warning(f"Ignore corrupted cache index {index_path}")
+        return {}
+
+
+def update_cache_index(
+    url: str, name: str, filename: str, etag: str = None, cache_dir: str = None
+) -> None:
+    if cache_dir is None:
+        cache_dir = DATASET_CACHE
+
+    url_for_filename = url if not name else url + f"/{name}"
+    index_path = os.path.join(cache_dir, CACHE_INDEX)
+    # Concurrent updates would otherwise overwrite each other's entries
+    with FileLock(index_path + ".lock"):
+        index = read_cache_index(cache_dir)
+        index[url_for_filename] = {
+            "url": url,
+            "name": name,
+            "filename": filename,
+            "etag": etag,
+        }
+        # Write to a temporary file then rename it, so that readers never see a
+        # partial index
+        with tempfile.NamedTemporaryFile(
+            "w", dir=cache_dir, prefix=CACHE_INDEX, delete=False
+        ) as index_file:
+            json.dump(index, index_file, indent=2)
+        os.replace(index_file.name, index_path)
+
+
+def find_in_cache(url: str, name: str = None, cache_dir: str = None) -> Optional[str]:
+    """
+    Return the path to the cached file for `url` and `name`, without any network access,
+    or None if the file has not been downloaded yet.
+    """
+    if cache_dir is None:
+        cache_dir = DATASET_CACHE
+
+    url_for_filename = url if not name else url + f"/{name}"
+    entry = read_cache_index(cache_dir).get(url_for_filename)
+    if entry:
+        cache_path = os.path.join(cache_dir, entry["filename"])
+        if os.path.exists(cache_path):
+            return cache_path
+
+    # Files downloaded before the cache index was introduced: their filenames
+    # start with the hash of the url, followed by the hash of their etag
+    prefix = url_to_filename(url_for_filename).split(".")[0]
+    candidates = [
+        path
+        for path in Path(cache_dir).glob(prefix + ".*")
+        if os.path.exists(str(path) + ".json")
+    ]
+    if candidates:
+        cache_path = str(max(candidates, key=os.path.getmtime))
+        _, etag = filename_to_url(os.path.basename(cache_path), cache_dir)
+        update_cache_index(url, name, os.path.basename(cache_path), etag, cache_dir)
+        return cache_path
+
+    return None
+
+
+def read_checksum(cache_path: str) -> Optional[str]:
+    """
+    Return the sha256 checksum stored in the metadata of a cached file, if any.
+    """
+    try:
+        with open(cache_path + ".json") as meta_file:
+            return json.load(meta_file).get("sha256")
+    except (OSError, ValueError):
+        return None
+
+
+def get_from_cache(
+    url: str,
+    name: str,
+    cache_dir: str = None,
+    revalidate: bool = False,
+    checksum: str = None,
+    workers: int = None,
+) -> str:
     """
     Given a URL, look for the corresponding dataset in the local cache.
     If it's not there, download it. Then return the path to the cached file.
+
+    A file found in the cache is returned without any network access, unless `revalidate`
+    is True. In this case, the ETag of the remote file is checked and the file is downloaded
+    again if it has changed. If the network is not available, the cached file is returned.
+    Set the TAXONERD_OFFLINE environment variable to never access the network.
+
+    Concurrent calls from several processes download the file only once. If the sha256
+    `checksum` of the file is given, it is verified after the download. The file is
+    downloaded with `workers` concurrent range requests (default = TAXONERD_DOWNLOAD_WORKERS).
     """
     if cache_dir is None:
         cache_dir = DATASET_CACHE
+    if workers is None:
+        workers = DOWNLOAD_WORKERS
 
     os.makedirs(cache_dir, exist_ok=True)
 
-    response = requests.head(url, allow_redirects=True)
+    url_for_filename = url if not name else url + f"/{name}"
+    cached = find_in_cache(url, name, cache_dir)
+    if cached and checksum:
+        stored_checksum = read_checksum(cached)
+        if stored_checksum and stored_checksum != checksum.lower():
+            logger.warning(f"Cached file {cached} does not match checksum {checksum}")
+            os.remove(cached)
+            cached = None
+    if cached and not revalidate:
+        return cached
+    if OFFLINE:
+        if cached:
+            return cached
+        raise FileNotFoundError(
+            f"{url_for_filename} not found in cache {cache_dir} and TAXONERD_OFFLINE is set"
+        )
+
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+    except (requests.Timeout, requests.ConnectionError) as e:
+        if cached:
+            logger.warning(
+                f"Cannot revalidate {url_for_filename} ({e}), use cached file"
+            )
+            return cached
+        raise
     if response.status_code != 200:
         raise IOError(
             "HEAD request failed for url {} with status code {}".format(
@@ -127,37 +450,43 @@ def get_from_cache(url: str, name: str, cache_dir: str = None) -> str:
         )
     etag = response.headers.get("ETag")
 
-    url_for_filename = url if not name else url + f"/{name}"
     filename = url_to_filename(url_for_filename, etag)
 
     # get cache path to put the file
     cache_path = os.path.join(cache_dir, filename)
 
     if not os.path.exists(cache_path):
-        # Download to temporary file, then copy to cache dir once finished.
-        # Otherwise you get corrupt cache entries if the download gets interrupted.
-        with tempfile.NamedTemporaryFile() as temp_file:  # type: IO
-            logger.info(
-                f"{url_for_filename} not found in cache, downloading to {temp_file.name}"
-            )
-
-            # GET file object
-            http_get(url, temp_file)
-
-            # we are copying the file before closing it, so flush to avoid truncation
-            temp_file.flush()
-            # shutil.copyfileobj() starts at the current position, so go to the start
-            temp_file.seek(0)
-
-            logger.info(
-                f"Finished download, copying {temp_file.name} to cache at {cache_path}"
-            )
-            with open(cache_path, "wb") as cache_file:
-                shutil.copyfileobj(temp_file, cache_file)
+        with FileLock(cache_path + ".lock"):
+            # Another process may have downloaded the file while we were waiting
+            if not os.path.exists(cache_path):
+                logger.info(f"{url_for_filename} not found in cache, downloading")
+                content_hash = download(
+                    url,
+                    cache_path,
+                    response.headers,
+                    checksum=checksum,
+                    workers=workers,
+                )
+                meta = {"url": url, "name": name, "etag": etag, "sha256": content_hash}
+                with open(cache_path + ".json", "w") as meta_file:
+                    json.dump(meta, meta_file)
+                logger.info(f"Finished download of {url_for_filename} to {cache_path}")
+
+    update_cache_index(url, name, filename, etag, cache_dir)
+    return cache_path
 
-            meta = {"url": url, "etag": etag}
-            meta_path = cache_path + ".json"
-            with open(meta_path, "w") as meta_file:
-                json.dump(meta, meta_file)
 
-    return cache_path
+def prefetch(
+    urls_or_filenames: Iterable[Union[str, Path, Tuple]],
+    cache_dir: str = None,
+    revalidate: bool = False,
+    workers: int = None,
+) -> List[str]:
+    """
+    Download the given files to the cache (if they are not cached yet, or if they have
+    changed when `revalidate` is True), so that they can later be used offline.
+    """
+    return [
+        cached_path(url_or_filename, cache_dir, revalidate=revalidate, workers=workers)
+        for url_or_filename in urls_or_filenames
+    ]
@@ -0,0 +1,200 @@
+"""
+Dictionary-based NER with the aliases of the knowledge base of an entity linker.
+
+The aliases of the KB are compiled into an Aho-Corasick automaton (requires
+pyahocorasick), which finds all the aliases occurring in a text in a single pass. The
+`taxo_gazetteer` component tags the exact alias matches as entities, already linked to
+the concepts of the KB. It can replace the statistical NER model, or complement it.
+
+The automaton is cached on disk next to the KB, and shared by the components of a
+process.
+"""
+
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+from spacy.util import filter_spans
+
+from .file_cache import cached_path
+from .linking_utils import KnowledgeBaseFactory
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+GAZETTEER_MODES = ("union", "standalone")
+
+# Automata already loaded, by path
+_automata: Dict[str, object] = {}
+_automata_lock = threading.Lock()
+
+
+def import_ahocorasick():
+    try:
+        import ahocorasick
+    except ImportError:
+        raise ImportError(
+            "pyahocorasick is required by the gazetteer: pip install pyahocorasick"
+        )
+    return ahocorasick
+
+
+def get_kb_file(name_or_path: str) -> Optional[str]:
+    """Return the local path to the json/jsonl file of a pretrained or local KB"""
+    kb_path = KnowledgeBaseFactory().get_kb_path(name_or_path)
+    if kb_path is not None:
+        return cached_path(kb_path)
+    path = Path(name_or_path)
+    if path.is_dir():
+        kb_files = list(path.glob("*.jsonl"))
+        if len(kb_files) == 1:
+            return str(kb_files[0])
+    return None
+
+
+def build_automaton(aliases: Iterable[Tuple[str, List[str]]], lowercase: bool = False):
+    """
+    Build an automaton matching the `aliases`, given as (alias, concept ids) pairs.
+    Each match has the value (length of the match, alias, concept ids).
+    """
+    ahocorasick = import_ahocorasick()
+    automaton = ahocorasick.Automaton()
+    for alias, cuis in aliases:
+        key = lower(alias) if lowercase else alias
+        if key:
+            value = automaton.get(key, None)
+            if value is not None:  # Several aliases with the same lowercased form
+                cuis = value[2] + tuple(cui for cui in cuis if cui not in value[2])
+            automaton.add_word(key, (len(key), alias, tuple(cuis)))
+    automaton.make_automaton()
+    return automaton
+
+
+def load_automaton(name_or_path: str, lowercase: bool = False):
+    """
+    Return the automaton matching the aliases of the KB of the entity linker
+    `name_or_path`, built once and cached next to the KB.
+    """
+    kb_file = get_kb_file(name_or_path)
+    if kb_file is None:
+        raise ValueError(f"Cannot find the KnowledgeBase of {name_or_path}")
+    automaton_path = "{}{}.automaton".format(
+        os.path.splitext(kb_file)[0], ".lower" if lowercase else ""
+    )
+    with _automata_lock:
+        if automaton_path in _automata:
+            return _automata[automaton_path]
+        ahocorasick = import_ahocorasick()
+        if os.path.exists(automaton_path):
+            automaton = ahocorasick.load(automaton_path, pickle.loads)
+        else:
+            logger.info(f"Create automaton {automaton_path} from {kb_file}")
+            kb = KnowledgeBaseFactory().get_kb(name_or_path, mmap=True)
+            rows = kb.conn.execute("SELECT alias, cuis FROM alias_to_cuis;")
+            automaton = build_automaton(
+                ((alias, kb.format_cuis(cuis)) for alias, cuis in rows), lowercase
+            )
+            # Write the automaton to a temporary file, so that concurrent processes
+            # never load a partially written automaton
+            tmp_path = "{}.tmp-{}".format(automaton_path, os.getpid())
+            automaton.save(tmp_path, pickle.dumps)
+            os.replace(tmp_path, automaton_path)
+        _automata[automaton_path] = automaton
+        return automaton
+
+
+def lower(text: str) -> str:
+    """Lowercase `text`, keeping the characters whose lowercase form is longer"""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return "".join(c if len(c.lower()) > 1 else c.lower() for c in text)
+
+
+def is_word_boundary(text: str, i: int) -> bool:
+    return i <= 0 or i >= len(text) or not (text[i - 1].isalnum() and text[i].isalnum())
+
+
+def find_aliases(doc: Doc, automaton, lowercase: bool = False, label: str = "LIVB"):
+    """
+    Return the longest non-overlapping alias matches in `doc` aligned with its tokens,
+    with the matched (alias, concept ids).
+    """
+    text = doc.text
+    matches = {}
+    for end, (length, alias, cuis) in automaton.iter(
+        lower(text) if lowercase else text
+    ):
+        start = end - length + 1
+        end += 1
+        if not (is_word_boundary(text, start) and is_word_boundary(text, end)):
+            continue
+        span = doc.char_span(start, end, label=label)
+        if span is not None:
+            matches[(span.start, span.end)] = (span, alias, cuis)
+    spans = filter_spans([span for span, _, _ in matches.values()])
+    return [matches[(span.start, span.end)] for span in spans]
+
+
+@Language.factory("taxo_gazetteer")
+class Gazetteer:
+    """
+    A spacy pipeline component which tags the aliases of the knowledge base of an entity
+    linker found in text, and links them to their concepts in `._.kb_ents`, as the
+    `taxo_linker` component does, with a score of 1.0.
+
+    Parameters
+    ----------
+
+    nlp: `Language`, a required argument for spacy to use this as a factory
+    name: `str`, a required argument for spacy to use this as a factory
+    linker_name: str, optional (default = None)
+        The name of the pretrained entity linker (or the path to a local entity linker)
+        whose KB aliases are tagged.
+    mode: str, optional (default = "union")
+        "union" adds the aliases found to the entities of the doc, keeping the longest of
+        overlapping entities. "standalone" replaces the entities of the doc.
+    lowercase: bool, optional (default = False)
+        Whether aliases are matched regardless of case.
+    label: str, optional (default = "LIVB")
+        The label of the entities.
+    """
+
+    def __init__(
+        self,
+        nlp: Optional[Language] = None,
+        name: str = "taxo_gazetteer",
+        linker_name: Optional[str] = None,
+        mode: str = "union",
+        lowercase: bool = False,
+        label: str = "LIVB",
+    ):
+        if mode not in GAZETTEER_MODES:
+            raise ValueError(
+                "Unknown gazetteer mode {}, expected one of {}".format(
+                    mode, ", ".join(GAZETTEER_MODES)
+                )
+            )
+        if not Span.has_extension("kb_ents"):
+            Span.set_extension("kb_ents", default=[])
+        self.automaton = load_automaton(linker_name or "gbif_backbone", lowercase)
+        self.mode = mode
+        self.lowercase = lowercase
+        self.label = label
+
+    def __call__(self, doc: Doc) -> Doc:
+        matches = find_aliases(doc, self.automaton, self.lowercase, self.label)
+        spans = []
+        for span, alias, cuis in matches:
+            span._.kb_ents = [(cui, alias, 1.0) for cui in cuis]
+            spans.append(span)
+        if self.mode == "union":
+            # Statistical entities come first, and are kept over matches of equal length
+            spans = filter_spans(list(doc.ents) + spans)
+        doc.set_ents(spans)
+        return doc
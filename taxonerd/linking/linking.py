@@ -2,7 +2,48 @@ from spacy.tokens import Doc
 from spacy.tokens import Span
 from spacy.language import Language
 from taxonerd.linking.candidate_generation import CandidateGenerator, LinkerPaths
-from typing import Optional
+from taxonerd.linking.linking_utils import LINK_KEYS
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+import threading
+
+# Candidate generators being loaded in the background, see `prefetch_candidate_generator`
+_prefetched: Dict[Tuple[str, bool], Future] = {}
+_prefetched_lock = threading.Lock()
+
+
+def load_candidate_generator_in_background(
+    linker_name: Optional[str] = None, mmap: bool = False
+) -> Future:
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="taxo_linker")
+    future = executor.submit(CandidateGenerator, name_or_path=linker_name, mmap=mmap)
+    executor.shutdown(wait=False)
+    return future
+
+
+def prefetch_candidate_generator(
+    linker_name: Optional[str] = None, mmap: bool = False
+) -> Future:
+    """
+    Start loading the candidate generator of a pretrained entity linker in a background
+    thread. The next `taxo_linker` component created with the same `linker_name` and
+    `mmap` arguments uses this candidate generator instead of loading its own.
+    """
+    with _prefetched_lock:
+        key = (linker_name, mmap)
+        if key not in _prefetched:
+            _prefetched[key] = load_candidate_generator_in_background(linker_name, mmap)
+        return _prefetched[key]
+
+
+def discard_prefetched_candidate_generator(
+    linker_name: Optional[str] = None, mmap: bool = False
+):
+    """Forget the candidate generator prefetched with these arguments, if any"""
+    with _prefetched_lock:
+        future = _prefetched.pop((linker_name, mmap), None)
+    if future is not None:
+        future.cancel()
 
 
 @Language.component("lower_case_lemmas")
@@ -69,6 +110,18 @@ class EntityLinker:
         how many are nearest neighbours are found.
     linker_name: str, optional (default = None)
         The name of the pretrained entity linker to load.
+    mmap: bool, optional (default = False)
+        Whether to memory-map the data of the pretrained entity linker, so that
+        processes running on the same host share a single copy of it.
+    background: bool, optional (default = False)
+        If True, the pretrained entity linker is loaded in a background thread and the
+        component is created immediately. The first call to the component blocks until
+        the linker is loaded.
+    link_key: str, optional (default = "lemma")
+        How mentions are turned into the strings looked up in the knowledge base, see
+        `LINK_KEYS`. "entity_lemma" gives the same strings as "lemma" followed by
+        `lower_case_lemmas`, with the lemmatizer of the pipeline disabled. "text" does
+        not need a lemmatizer.
     """
 
     def __init__(
@@ -83,41 +136,102 @@ class EntityLinker:
         filter_for_definitions: bool = True,
         max_entities_per_mention: int = 5,
         linker_name: Optional[str] = None,
+        mmap: bool = False,
+        background: bool = False,
+        link_key: str = "lemma",
     ):
+        if link_key not in LINK_KEYS:
+            raise ValueError(
+                "Unknown link key {}, expected one of {}".format(
+                    link_key, ", ".join(LINK_KEYS)
+                )
+            )
         Span.set_extension("kb_ents", default=[], force=True)
-        self.candidate_generator = candidate_generator or CandidateGenerator(
-            name_or_path=linker_name
-        )
+        self.link_key = link_key
+        self.lemmatizer = None
+        if link_key == "entity_lemma" and nlp and "lemmatizer" in nlp.component_names:
+            self.lemmatizer = nlp.get_pipe("lemmatizer")
+        self._candidate_generator = candidate_generator
+        self._candidate_generator_future = None
+        if candidate_generator is None:
+            with _prefetched_lock:
+                future = _prefetched.pop((linker_name, mmap), None)
+            if background:
+                self._candidate_generator_future = (
+                    future or load_candidate_generator_in_background(linker_name, mmap)
+                )
+            elif future:
+                self._candidate_generator = future.result()
+            else:
+                self._candidate_generator = CandidateGenerator(
+                    name_or_path=linker_name, mmap=mmap
+                )
         self.resolve_abbreviations = resolve_abbreviations
         self.k = k
         self.threshold = threshold
         self.no_definition_threshold = no_definition_threshold
-        self.kb = self.candidate_generator.kb
         self.filter_for_definitions = filter_for_definitions
         self.max_entities_per_mention = max_entities_per_mention
 
+    @property
+    def candidate_generator(self) -> CandidateGenerator:
+        # Blocks until the candidate generator is loaded
+        if self._candidate_generator is None:
+            self._candidate_generator = self._candidate_generator_future.result()
+        return self._candidate_generator
+
+    @property
+    def kb(self):
+        return self.candidate_generator.kb
+
+    @property
+    def ready(self) -> bool:
+        """
+        Whether the candidate generator is loaded, i.e. whether calling the component won't block.
+        """
+        return (
+            self._candidate_generator is not None
+            or self._candidate_generator_future.done()
+        )
+
+    def token_lemma(self, token) -> str:
+        if token.lemma == 0 and self.lemmatizer is not None:
+            # Lemmatize the token as the lemmatizer and lower_case_lemmas would have
+            token.lemma_ = self.lemmatizer.lemmatize(token)[0].lower()
+        return token.lemma_.lower() if token.lemma else token.lower_
+
+    def mention_string(self, span: Span) -> str:
+        """Return the string looked up in the knowledge base for the mention `span`"""
+        if self.link_key == "text":
+            return " ".join([tok.lower_ for tok in span])
+        if self.link_key == "entity_lemma":
+            return " ".join([self.token_lemma(tok) for tok in span])
+        return " ".join([tok.lemma_ for tok in span])
+
     def __call__(self, doc: Doc) -> Doc:
         mentions = doc.ents
-        mention_strings = []
 
+        # The string of each mention, computed once. Mentions without a string are
+        # not linked, e.g. the mentions already linked by a gazetteer
         if self.resolve_abbreviations and Doc.has_extension("abbreviations"):
             # TODO: This is possibly sub-optimal - we might
             # prefer to look up both the long and short forms.
-            # mention_strings = [
-            #     ent._.long_form.text for ent in doc.ents if ent._.long_form is not None
-            # ]
             mention_strings = [
-                " ".join([tok.lemma_ for tok in ent._.long_form])
-                for ent in doc.ents
-                if ent._.long_form is not None
+                (
+                    self.mention_string(ent._.long_form)
+                    if ent._.long_form is not None
+                    else None
+                )
+                for ent in mentions
             ]
         else:
-            # mention_strings = [ent.text for ent in doc.ents]
-            mention_strings = [
-                " ".join([tok.lemma_ for tok in ent]) for ent in doc.ents
-            ]
+            mention_strings = [self.mention_string(ent) for ent in mentions]
+        mention_strings = [
+            None if ent._.kb_ents else mention_string
+            for ent, mention_string in zip(mentions, mention_strings)
+        ]
 
-        unique_mention_strings = set(mention_strings)
+        unique_mention_strings = set(mention_strings) - {None}
 
         if len(unique_mention_strings) > 0:
             batch_candidates = self.candidate_generator(unique_mention_strings, self.k)
@@ -127,7 +241,6 @@ class EntityLinker:
             for mention_string, candidates in zip(
                 unique_mention_strings, batch_candidates
             ):
-                # for mention, candidates in zip(doc.ents, batch_candidates):
                 predicted = []
 
                 for cand in candidates:
@@ -150,30 +263,14 @@ class EntityLinker:
                         pred for pred in sorted_predicted if pred[-1] == max_score
                     ]
 
-                # mention._.umls_ents = sorted_predicted[: self.max_entities_per_mention]
-                # kb_ents = sorted_predicted[: self.max_entities_per_mention]
-
                 kb_ents_per_mention_string[mention_string] = (
                     kb_ents if kb_ents else None
                 )
-                # mention._.kb_ents = kb_ents if kb_ents != [] else None
 
             new_ents = []
-            for mention in mentions:
-                if self.resolve_abbreviations and Doc.has_extension("abbreviations"):
-                    if mention._.long_form is not None:
-                        mention_text = " ".join(
-                            [tok.lemma_ for tok in mention._.long_form]
-                        )
-                        mention._.kb_ents = kb_ents_per_mention_string[mention_text]
-                        # mention._.kb_ents = kb_ents_per_mention_string[
-                        #     mention._.long_form.text
-                        # ]
-                else:
-                    mention_text = " ".join([tok.lemma_ for tok in mention])
-                    mention._.kb_ents = kb_ents_per_mention_string[mention_text]
-                    # mention._.kb_ents = kb_ents_per_mention_string[mention.text]
-
+            for mention, mention_string in zip(mentions, mention_strings):
+                if mention_string is not None:
+                    mention._.kb_ents = kb_ents_per_mention_string[mention_string]
                 if mention._.kb_ents:
                     new_ents.append(mention)
 
@@ -1,8 +1,11 @@
 from typing import List, Dict, NamedTuple, Optional, Set, Tuple, Union
 import json
+import ast
 from pathlib import Path
 from collections import defaultdict
+from collections.abc import Mapping
 import sqlite3
+import threading
 from .file_cache import cached_path
 from urllib.request import pathname2url
 import os
@@ -10,6 +13,13 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# How mentions are turned into the strings looked up in the knowledge base:
+# - lemma: the lowercased lemmas set by the lemmatizer of the pipeline
+# - entity_lemma: the lowercased lemmas of the entity tokens, computed on demand by the
+#   (disabled) lemmatizer of the pipeline, without lemmatizing the whole document
+# - text: the lowercased tokens, without lemmatization
+LINK_KEYS = ("lemma", "entity_lemma", "text")
+
 
 def escape_quotes(alias):
     alias = alias.replace("'", "''")
@@ -42,6 +52,35 @@ class Entity(NamedTuple):
         return rep
 
 
+class SqliteMapping(Mapping):
+    """
+    A read-only mapping backed by a two-column table of the SQLite database of `kb`.
+    Values are decoded on access, so that the table never has to be loaded in memory.
+    """
+
+    def __init__(self, kb: "KnowledgeBase", table: str, key: str, value: str, decode):
+        self.kb = kb
+        self.table = table
+        self.key = key
+        self.value = value
+        self.decode = decode
+
+    def __getitem__(self, k):
+        row = self.kb.conn.execute(
+            f"SELECT {self.value} FROM {self.table} WHERE {self.key} = ?;", (k,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(k)
+        return self.decode(row[0])
+
+    def __iter__(self):
+        for row in self.kb.conn.execute(f"SELECT {self.key} FROM {self.table};"):
+            yield row[0]
+
+    def __len__(self):
+        return self.kb.conn.execute(f"SELECT COUNT(*) FROM {self.table};").fetchone()[0]
+
+
 class KnowledgeBase:
     """
     A class representing two commonly needed views of a Knowledge Base:
@@ -52,10 +91,29 @@ class KnowledgeBase:
     ----------
     file_path: str, required.
         The file path to the json/jsonl representation of the KB to load.
+    prefix: str, optional.
+        The prefix added to the concept ids returned by `get_cuis_from_aliases`.
+    mmap: bool, optional (default = False)
+        If True, both views are read on demand from the SQLite database instead of
+        being loaded in memory. The database is memory-mapped, so that processes
+        running on the same host share a single copy of the KB through the page cache.
+        The json/jsonl file is only parsed once, when the database is created.
+
+    A KnowledgeBase can be shared by threads: each thread reads the database through its
+    own read-only connection (see `conn`), so that queries do not wait for each other.
     """
 
-    def __init__(self, file_path: Union[str, Path, Tuple] = None, prefix: str = ""):
+    # Maximum number of bytes of the SQLite database to memory-map
+    mmap_size = 2**40
+
+    def __init__(
+        self,
+        file_path: Union[str, Path, Tuple] = None,
+        prefix: str = "",
+        mmap: bool = False,
+    ):
         self.prefix = prefix
+        self._local = threading.local()
         if file_path is None:
             raise ValueError(
                 "Do not use the default arguments to KnowledgeBase. "
@@ -65,6 +123,49 @@ class KnowledgeBase:
         file_path = cached_path(file_path)
         db_path = os.path.splitext(file_path)[0] + ".db"
 
+        if mmap:
+            if not self.has_entities_table(db_path):
+                logger.info(
+                    "Create memory-mappable SQLite database {} from {}".format(
+                        db_path, file_path
+                    )
+                )
+                self.load_json(file_path)
+                self.json_to_sqlite(db_path, with_entities=True)
+            self.db_path = db_path
+            self.cui_to_entity = SqliteMapping(
+                self,
+                "entities",
+                "concept_id",
+                "entity",
+                lambda entity: Entity(**json.loads(entity)),
+            )
+            self.alias_to_cuis = SqliteMapping(
+                self, "alias_to_cuis", "alias", "cuis", ast.literal_eval
+            )
+            return
+
+        self.load_json(file_path)
+
+        if not os.path.exists(db_path):
+            logger.info(
+                "File {} not found, create SQLite database from {}".format(
+                    db_path, file_path
+                )
+            )
+            self.json_to_sqlite(db_path)
+
+        self.db_path = db_path
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """The connection of the current thread to the database, opened on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.get_conn_to_db(self.db_path)
+        return conn
+
+    def load_json(self, file_path: str):
         if file_path.endswith("jsonl"):
             raw = (
                 json.loads(line)
@@ -85,28 +186,49 @@ class KnowledgeBase:
 
         self.alias_to_cuis: Dict[str, Set[str]] = {**alias_to_cuis}
 
+    def has_entities_table(self, db_path: str = None):
         if not os.path.exists(db_path):
-            logger.info(
-                "File {} not found, create SQLite database from {}".format(
-                    db_path, file_path
-                )
-            )
-            self.conn = self.json_to_sqlite(db_path)
-
-        self.conn = self.get_conn_to_db(db_path)
-
-    def json_to_sqlite(self, db_path: str = None):
-        conn = sqlite3.connect(db_path)
+            return False
+        conn = sqlite3.connect(
+            "file:{}?mode=ro".format(pathname2url(db_path)), uri=True
+        )
+        try:
+            row = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'entities';"
+            ).fetchone()
+        finally:
+            conn.close()
+        return row is not None
+
+    def json_to_sqlite(self, db_path: str = None, with_entities: bool = False):
+        # Build the database in a temporary file, so that concurrent processes
+        # never open a partially written database
+        tmp_path = "{}.tmp-{}".format(db_path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
         c = conn.cursor()
         c.execute("""CREATE TABLE alias_to_cuis (alias, cuis)""")
         entries = [(k, str(v)) for k, v in self.alias_to_cuis.items()]
         c.executemany("INSERT INTO alias_to_cuis VALUES (?,?)", entries)
+        c.execute("""CREATE INDEX alias_index ON alias_to_cuis (alias)""")
+        if with_entities:
+            c.execute("""CREATE TABLE entities (concept_id PRIMARY KEY, entity)""")
+            c.executemany(
+                "INSERT INTO entities VALUES (?,?)",
+                (
+                    (cui, json.dumps(entity._asdict()))
+                    for cui, entity in self.cui_to_entity.items()
+                ),
+            )
         conn.commit()
-        return conn
+        conn.close()
+        os.replace(tmp_path, db_path)
 
     def get_conn_to_db(self, file_path: str = None):
-        dburi = "file:{}?mode=rw".format(pathname2url(file_path))
+        dburi = "file:{}?mode=ro".format(pathname2url(file_path))
         conn = sqlite3.connect(dburi, uri=True)
+        conn.execute("PRAGMA mmap_size = {};".format(self.mmap_size))
         return conn
 
     def get_cuis_from_alias(self, alias):
@@ -133,12 +255,13 @@ class KnowledgeBase:
         )
         mentions_to_concepts: Dict[str, List[str]] = defaultdict(list)
         for x in c.fetchall():
-            concept_ids = [
-                self.prefix + ":" + t.strip() for t in x[1].strip("{}").split(",")
-            ]
-            mentions_to_concepts[x[0]].extend(concept_ids)
+            mentions_to_concepts[x[0]].extend(self.format_cuis(x[1]))
         return mentions_to_concepts
 
+    def format_cuis(self, cuis: str) -> List[str]:
+        """Return the prefixed concept ids of a row of the alias_to_cuis table"""
+        return [self.prefix + ":" + t.strip() for t in cuis.strip("{}").split(",")]
+
 
 class KnowledgeBaseFactory:
 
@@ -150,53 +273,75 @@ class KnowledgeBaseFactory:
             # "ncbi_lite": NCBILiteKnowledgeBase(),
         }
 
-    def get_kb(self, name_or_path=None):
+    def get_kb(self, name_or_path=None, mmap=False):
         if name_or_path in self.factory:
-            return self.factory[name_or_path]()
+            return self.factory[name_or_path](mmap=mmap)
         else:
             path = Path(name_or_path)
             if path.exists() and path.is_dir():
                 kb_file = list(path.glob("*.jsonl"))
                 if len(kb_file) == 1:
-                    return KnowledgeBase(file_path=kb_file[0], prefix=path.name.upper())
+                    return KnowledgeBase(
+                        file_path=kb_file[0], prefix=path.name.upper(), mmap=mmap
+                    )
         logger.info(f"Cannot initialize KnowledgeBase with name or path {name_or_path}")
         return None
 
+    def get_kb_path(self, name):
+        """
+        Return the (possibly remote) path to the json/jsonl file of a pretrained KB.
+        """
+        return {
+            "gbif_backbone": GbifKnowledgeBasePath,
+            "taxref": TaxRefKnowledgeBasePath,
+            "ncbi_taxonomy": NCBIKnowledgeBasePath,
+        }.get(name)
+
+
+GbifKnowledgeBasePath = (
+    "https://cloud.univ-grenoble-alpes.fr/s/jpzMLYDLkG7ywSH/download",
+    "gbif_backbone/gbif_backbone_20230828.jsonl",
+)
+
+TaxRefKnowledgeBasePath = (
+    "https://cloud.univ-grenoble-alpes.fr/s/jPCMbGoDN8Pi6QP/download",
+    "taxref/taxref_v17.jsonl",
+)
+
+NCBIKnowledgeBasePath = (
+    "https://cloud.univ-grenoble-alpes.fr/s/Sg487BjiSYkJqtC/download",
+    "ncbi_taxonomy/ncbi_taxonomy_20240522.jsonl",
+)
+
 
 class GbifKnowledgeBase(KnowledgeBase):
     def __init__(
         self,
-        file_path=(
-            "https://cloud.univ-grenoble-alpes.fr/s/jpzMLYDLkG7ywSH/download",
-            "gbif_backbone/gbif_backbone_20230828.jsonl",
-        ),
+        file_path=GbifKnowledgeBasePath,
         prefix="GBIF",
+        mmap=False,
     ):
-        super().__init__(file_path, prefix)
+        super().__init__(file_path, prefix, mmap)
 
 
 class TaxRefKnowledgeBase(KnowledgeBase):
     def __init__(
         self,
-        file_path=(
-            "https://cloud.univ-grenoble-alpes.fr/s/jPCMbGoDN8Pi6QP/download",
-            "taxref/taxref_v17.jsonl",
-        ),
+        file_path=TaxRefKnowledgeBasePath,
         prefix="TAXREF",
+        mmap=False,
     ):
-        super().__init__(file_path, prefix)
+        super().__init__(file_path, prefix, mmap)
 
 
 class NCBIKnowledgeBase(KnowledgeBase):
     def __init__(
         self,
-        file_path=(
-            "https://cloud.univ-grenoble-alpes.fr/s/Sg487BjiSYkJqtC/download",
-            "ncbi_taxonomy/ncbi_taxonomy_20240522.jsonl",
-        ),
+        file_path=NCBIKnowledgeBasePath,
         prefix="NCBI",
+        mmap=False,
     ):
-        super().__init__(file_path, prefix)
+        super().__init__(file_path, prefix, mmap)
 
 
 # class NCBILiteKnowledgeBase(KnowledgeBase):
@@ -0,0 +1,125 @@
+"""
+Utilities for storing linker data in memory-mappable files, so that several
+processes on the same host share a single physical copy through the page cache.
+"""
+
+import os
+import json
+from collections.abc import Sequence
+from typing import List
+
+import scipy
+import numpy
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _replace_atomically(write_fn, path: str) -> None:
+    # Write to a private temporary file first, so that concurrent processes
+    # never observe a partially written file.
+    tmp_path = "{}.tmp-{}".format(path, os.getpid())
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class StringArray(Sequence):
+    """
+    A read-only list of strings backed by two memory-mapped files: a blob of
+    utf-8 encoded strings and an array of offsets into this blob.
+
+    Parameters
+    ----------
+    path: str, required.
+        The path prefix of the files created by `save_string_array`.
+    """
+
+    def __init__(self, path: str):
+        self.offsets = numpy.load(path + ".offsets.npy", mmap_mode="r")
+        if os.path.getsize(path + ".strings.bin") > 0:
+            self.blob = numpy.memmap(path + ".strings.bin", dtype=numpy.uint8, mode="r")
+        else:  # numpy cannot map empty files
+            self.blob = numpy.empty(0, dtype=numpy.uint8)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("StringArray index out of range")
+        return (
+            self.blob[self.offsets[i] : self.offsets[i + 1]].tobytes().decode("utf-8")
+        )
+
+
+def save_string_array(strings: List[str], path: str) -> None:
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(s) for s in encoded], out=offsets[1:])
+
+    def write_blob(tmp_path):
+        with open(tmp_path, "wb") as f:
+            for s in encoded:
+                f.write(s)
+
+    def write_offsets(tmp_path):
+        with open(tmp_path, "wb") as f:
+            numpy.save(f, offsets)
+
+    # The offsets are written last: their presence marks a complete array
+    _replace_atomically(write_blob, path + ".strings.bin")
+    _replace_atomically(write_offsets, path + ".offsets.npy")
+
+
+def load_string_array(json_path: str) -> StringArray:
+    """
+    Load a json list of strings as a memory-mapped StringArray. The memory-mappable
+    files are created next to the json file the first time it is loaded.
+    """
+    path = os.path.splitext(json_path)[0]
+    if not os.path.exists(path + ".offsets.npy"):
+        logger.info(f"Create memory-mappable string array from {json_path}")
+        with open(json_path) as f:
+            save_string_array(json.load(f), path)
+    return StringArray(path)
+
+
+CSR_ARRAYS = ("data", "indices", "indptr")
+
+
+def load_sparse_matrix(npz_path: str) -> scipy.sparse.csr_matrix:
+    """
+    Load a sparse matrix saved with `scipy.sparse.save_npz` as a CSR matrix whose
+    arrays are memory-mapped. Uncompressed copies of the arrays are created next
+    to the npz file the first time it is loaded.
+    """
+    path = os.path.splitext(npz_path)[0]
+    shape_path = path + ".shape.npy"
+    if not os.path.exists(shape_path):
+        logger.info(f"Create memory-mappable sparse matrix from {npz_path}")
+        matrix = scipy.sparse.load_npz(npz_path).tocsr()
+        for name in CSR_ARRAYS + ("shape",):
+            array = numpy.array(
+                matrix.shape if name == "shape" else getattr(matrix, name)
+            )
+
+            def write_array(tmp_path):
+                with open(tmp_path, "wb") as f:
+                    numpy.save(f, array)
+
+            # The shape is written last: its presence marks a complete matrix
+            _replace_atomically(write_array, "{}.{}.npy".format(path, name))
+    arrays = [
+        numpy.load("{}.{}.npy".format(path, name), mmap_mode="r") for name in CSR_ARRAYS
+    ]
+    shape = tuple(numpy.load(shape_path))
+    return scipy.sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
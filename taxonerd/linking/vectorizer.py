@@ -0,0 +1,177 @@
+from typing import Dict, Iterable
+
+import scipy
+import numpy
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TrigramVectorizer:
+    """
+    A drop-in replacement for the transform method of a fitted sklearn TfidfVectorizer
+    with `analyzer="char_wb"` and `ngram_range=(3, 3)`, as used by the CandidateGenerator.
+
+    sklearn builds a Python string for each character 3-gram and looks it up in the
+    vocabulary dict. Instead, this vectorizer encodes the mentions as an array of
+    character codes, computes an integer key for every 3-gram at once, and looks the
+    keys up in a sorted array built from the vocabulary. The idf weighting and the
+    normalization are applied on the whole batch with numpy.
+
+    The output is the same CSR matrix as `TfidfVectorizer.transform`.
+
+    Parameters
+    ----------
+    vocabulary: Dict[str, int], required.
+        A mapping from character 3-grams to feature indices.
+    idf: numpy.ndarray, optional.
+        The idf weight of each feature. No idf weighting is applied if None.
+    norm: str, optional (default = "l2")
+        Either "l2" or None.
+    lowercase: bool, optional (default = True)
+        Whether to lowercase the mentions before vectorizing them.
+    dtype: numpy.dtype, optional (default = numpy.float32)
+        The type of the output matrix.
+    """
+
+    def __init__(
+        self,
+        vocabulary: Dict[str, int],
+        idf: numpy.ndarray = None,
+        norm: str = "l2",
+        lowercase: bool = True,
+        dtype=numpy.float32,
+    ):
+        if norm not in ("l2", None):
+            raise ValueError(f"Unsupported norm {norm}")
+        if any(len(trigram) != 3 for trigram in vocabulary):
+            raise ValueError("The vocabulary must only contain character 3-grams")
+        self.n_features = len(vocabulary)
+        self.norm = norm
+        self.lowercase = lowercase
+        self.dtype = dtype
+        self.idf = None if idf is None else numpy.asarray(idf, dtype=dtype)
+
+        # Characters are encoded as 1..len(alphabet), 0 stands for unknown characters
+        alphabet = sorted(set("".join(vocabulary)))
+        self.base = len(alphabet) + 1
+        self.char_codes = numpy.zeros(
+            (ord(alphabet[-1]) if alphabet else 0) + 2, dtype=numpy.int64
+        )
+        for i, char in enumerate(alphabet):
+            self.char_codes[ord(char)] = i + 1
+
+        trigrams = list(vocabulary)
+        keys = self.encode(
+            numpy.array([ord(char) for char in "".join(trigrams)], dtype=numpy.uint32)
+        ).reshape(-1, 3)
+        keys = (keys[:, 0] * self.base + keys[:, 1]) * self.base + keys[:, 2]
+        order = numpy.argsort(keys)
+        self.keys = keys[order]
+        self.feature_ids = numpy.array(
+            [vocabulary[trigram] for trigram in trigrams], dtype=numpy.int32
+        )[order]
+
+    @classmethod
+    def is_supported(cls, vectorizer: TfidfVectorizer) -> bool:
+        """
+        Return True if the fitted vectorizer can be replaced by a TrigramVectorizer.
+        """
+        return (
+            isinstance(vectorizer, TfidfVectorizer)
+            and hasattr(vectorizer, "vocabulary_")
+            and vectorizer.analyzer == "char_wb"
+            and tuple(vectorizer.ngram_range) == (3, 3)
+            and vectorizer.preprocessor is None
+            and vectorizer.strip_accents is None
+            and vectorizer.input == "content"
+            and not vectorizer.binary
+            and not vectorizer.sublinear_tf
+            and vectorizer.norm in ("l2", None)
+        )
+
+    @classmethod
+    def from_tfidf_vectorizer(cls, vectorizer: TfidfVectorizer) -> "TrigramVectorizer":
+        if not cls.is_supported(vectorizer):
+            raise ValueError(
+                "Only char_wb 3-gram TfidfVectorizers without custom preprocessing are supported"
+            )
+        return cls(
+            vectorizer.vocabulary_,
+            idf=vectorizer.idf_ if vectorizer.use_idf else None,
+            norm=vectorizer.norm,
+            lowercase=vectorizer.lowercase,
+            dtype=vectorizer.dtype,
+        )
+
+    def encode(self, codepoints: numpy.ndarray) -> numpy.ndarray:
+        codepoints = numpy.minimum(codepoints, len(self.char_codes) - 1)
+        return self.char_codes[codepoints]
+
+    def transform(self, raw_documents: Iterable[str]) -> scipy.sparse.csr_matrix:
+        # Mirror sklearn's char_wb analyzer: each word is padded with a whitespace
+        # on both sides, and 3-grams never span two words.
+        words_per_doc = []
+        words = []
+        for doc in raw_documents:
+            doc_words = (doc.lower() if self.lowercase else doc).split()
+            words_per_doc.append(len(doc_words))
+            words.extend(doc_words)
+        n_docs = len(words_per_doc)
+
+        padded_lengths = numpy.array(
+            [len(word) + 2 for word in words], dtype=numpy.int64
+        )
+        text = "".join([" " + word + " " for word in words])
+        codes = self.encode(
+            numpy.frombuffer(
+                text.encode("utf-32-le", "surrogatepass"), dtype=numpy.uint32
+            )
+        )
+
+        word_ids = numpy.repeat(numpy.arange(len(words)), padded_lengths)
+        doc_ids = numpy.repeat(numpy.arange(n_docs), words_per_doc)
+        first, second, third = codes[:-2], codes[1:-1], codes[2:]
+        valid = (
+            (word_ids[:-2] == word_ids[2:]) & (first > 0) & (second > 0) & (third > 0)
+        )
+        keys = ((first * self.base + second) * self.base + third)[valid]
+        rows = doc_ids[word_ids[:-2][valid]]
+
+        positions = numpy.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        in_vocabulary = self.keys[positions] == keys if len(self.keys) else keys < 0
+        rows = rows[in_vocabulary]
+        cols = self.feature_ids[positions[in_vocabulary]]
+
+        # Count the occurrences of each (row, feature) pair, sorted by row then feature
+        pairs, counts = numpy.unique(
+            rows.astype(numpy.int64) * self.n_features + cols, return_counts=True
+        )
+        indptr = numpy.zeros(n_docs + 1, dtype=numpy.int32)
+        numpy.cumsum(
+            numpy.bincount(pairs // self.n_features, minlength=n_docs), out=indptr[1:]
+        )
+        X = scipy.sparse.csr_matrix(
+            (
+                counts.astype(self.dtype),
+                (pairs % self.n_features).astype(numpy.int32),
+                indptr,
+            ),
+            shape=(n_docs, self.n_features),
+        )
+
+        if self.idf is not None:
+            X.data *= self.idf[X.indices]
+
+        if self.norm == "l2":
+            nnz_rows = numpy.repeat(numpy.arange(n_docs), numpy.diff(X.indptr))
+            norms = numpy.sqrt(
+                numpy.bincount(nnz_rows, weights=X.data**2, minlength=n_docs)
+            ).astype(self.dtype)
+            norms[norms == 0] = 1.0
+            X.data /= norms[nnz_rows]
+
+        return X
@@ -0,0 +1,255 @@
+"""
+Pre-filtering of the paragraphs of a document before entity recognition.
+
+Most paragraphs of a scientific document (methods, references, acknowledgements...)
+mention no organism. The `ParagraphFilter` looks for cheap lexical signals of taxon
+names in each line of a text:
+
+* Latin-like binomials (e.g. "Ursus arctos", "Carex sp.")
+* abbreviated genus names (e.g. "U. arctos")
+* genus names of a knowledge base, if one is given
+
+Only the runs of lines with such a signal (and their neighbouring lines) are processed
+by the model. The other lines are only tokenized, and the documents of the runs are
+concatenated back into a single document of the whole text, so that the offsets of the
+entities are unchanged.
+
+Entities without any of these signals nearby (e.g. vernacular names alone in a
+paragraph) are missed: `eval/eval_prefilter.py` measures the recall loss on a corpus.
+Sentence ids then number the sentences of the processed lines only.
+"""
+
+import os
+import re
+from collections import deque
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Common endings of specific epithets (-on, but not the English -ion)
+LATIN_ENDINGS = "us|um|a|ae|i|is|es|os|(?<!i)on|ix|ax|ex|ens|ensis|oides"
+
+# Capitalized words starting sentences, which are not genus names
+SENTENCE_STARTS = (
+    "The|This|These|That|Those|There|Their|They|Then|Thus|Here|However|When|While|"
+    "Where|Which|With|From|Our|Its|For|And|But|After|Before|Although|Since|Both|Each|"
+    "All|Some|Such|Other|Most|Many|Only|Few|Several|Among|Between|During|Under|Using"
+)
+
+SIGNALS = [
+    # Binomials, possibly with a subgenus: Ursus arctos, Daphnia (Ctenodaphnia) magna
+    re.compile(
+        r"\b(?!(?:" + SENTENCE_STARTS + r")\b)[A-Z][a-z]{2,}\s+"
+        r"(?:\([A-Z][a-z]+\)\s+)?[a-z]{2,}(?:" + LATIN_ENDINGS + r")\b"
+    ),
+    # Unidentified species: Carex sp., Carex spp.
+    re.compile(r"\b[A-Z][a-z]{2,}\s+spp?\."),
+    # Abbreviated genus names: U. arctos
+    re.compile(r"\b[A-Z]\.\s?[a-z]{3,}\b"),
+]
+
+CAPITALIZED_WORD = re.compile(r"\b[A-Z][a-z]{2,}\b")
+GENUS = re.compile(r"[A-Z][a-z]{2,}")
+EPITHET = re.compile(r"[a-z-]{2,}(?:" + LATIN_ENDINGS + ")")
+
+LINE = re.compile(r"[^\n]*(?:\n|$)")
+
+
+def genera_from_aliases(aliases: Iterable[str]) -> Set[str]:
+    """
+    Return the genus names of the binomials among `aliases`, i.e. the capitalized first
+    words followed by a Latin-like epithet (unlike "Red fox")
+    """
+    genera = set()
+    for alias in aliases:
+        words = alias.split()
+        if (
+            len(words) >= 2
+            and GENUS.fullmatch(words[0])
+            and EPITHET.fullmatch(words[1])
+        ):
+            genera.add(words[0])
+    return genera
+
+
+def load_genera(name_or_path: str) -> Set[str]:
+    """
+    Return the genus names of the KB of the entity linker `name_or_path`, extracted once
+    and cached next to the KB.
+    """
+    from taxonerd.linking.gazetteer import get_kb_file
+    from taxonerd.linking.linking_utils import KnowledgeBaseFactory
+
+    kb_file = get_kb_file(name_or_path)
+    if kb_file is None:
+        raise ValueError(f"Cannot find the KnowledgeBase of {name_or_path}")
+    genera_path = os.path.splitext(kb_file)[0] + ".genera"
+    if os.path.exists(genera_path):
+        with open(genera_path) as f:
+            return set(f.read().split())
+    logger.info(f"Create genus list {genera_path} from {kb_file}")
+    kb = KnowledgeBaseFactory().get_kb(name_or_path, mmap=True)
+    rows = kb.conn.execute("SELECT alias FROM alias_to_cuis;")
+    genera = genera_from_aliases(alias for (alias,) in rows)
+    tmp_path = "{}.tmp-{}".format(genera_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(sorted(genera)))
+    os.replace(tmp_path, genera_path)
+    return genera
+
+
+def move_spans(value, doc: Doc, token_offset: int):
+    """Move the spans of an attribute value to `doc`, shifted by `token_offset` tokens"""
+    if isinstance(value, Span):
+        return Span(
+            doc, value.start + token_offset, value.end + token_offset, value.label
+        )
+    if isinstance(value, (list, tuple)):
+        return type(value)(move_spans(v, doc, token_offset) for v in value)
+    return value
+
+
+def merge_docs(docs: List[Doc]) -> Doc:
+    """
+    Concatenate `docs`, the consecutive parts of a text, into a document of the whole
+    text. Unlike `Doc.from_docs`, the spans stored in custom attributes (e.g.
+    `long_form`) are moved to the new document, and list values of document attributes
+    (e.g. `abbreviations`) are concatenated.
+    """
+    if len(docs) == 1:
+        return docs[0]
+    attrs = [
+        attr
+        for attr in Doc._get_array_attrs()
+        if any(doc.has_annotation(attr) for doc in docs)
+    ]
+    merged = Doc.from_docs(
+        docs, ensure_whitespace=False, attrs=attrs, exclude=["user_data", "tensor"]
+    )
+    char_offset = token_offset = 0
+    for doc in docs:
+        for key, value in doc.user_data.items():
+            if not (isinstance(key, tuple) and len(key) == 4 and key[0] == "._."):
+                continue
+            _, name, start, end = key
+            value = move_spans(value, merged, token_offset)
+            if start is None:
+                if isinstance(value, list):
+                    merged.user_data.setdefault(key, []).extend(value)
+                else:
+                    merged.user_data[key] = value
+            else:
+                end = end + char_offset if end is not None else None
+                merged.user_data[("._.", name, start + char_offset, end)] = value
+        char_offset += len(doc.text)
+        token_offset += len(doc)
+    return merged
+
+
+class ParagraphFilter:
+    """
+    Select the lines of a text that are processed by the model.
+
+    The recall of the model can drop: entities in lines that are not candidates are
+    lost, e.g. vernacular names ("brown bears", "salmon") without a binomial, an
+    abbreviated genus name or a genus of `genera` in the same run of lines. Use
+    `eval/eval_prefilter.py` to compare the entities found with and without the filter
+    on a corpus before enabling it.
+
+    Parameters
+    ----------
+
+    genera: set of str, optional (default = None)
+        Genus names (e.g. of a KB, see `load_genera`) whose occurrence in a line makes it
+        a candidate, in addition to the lexical signals.
+    context: int, optional (default = 1)
+        The number of lines before and after a candidate line processed with it.
+    """
+
+    def __init__(self, genera: Optional[Set[str]] = None, context: int = 1):
+        self.genera = genera
+        self.context = context
+
+    def is_candidate(self, line: str) -> bool:
+        if any(signal.search(line) for signal in SIGNALS):
+            return True
+        if self.genera:
+            return any(word in self.genera for word in CAPITALIZED_WORD.findall(line))
+        return False
+
+    def split(self, text: str) -> List[Tuple[int, int, bool]]:
+        """
+        Split `text` into runs of consecutive lines, returned as (start, end, candidate)
+        character offsets, where candidate is True if the run is processed by the model.
+        The runs cover the whole text.
+        """
+        lines = [match.span() for match in LINE.finditer(text) if match.group()]
+        if not lines:
+            return [(0, len(text), False)]
+        selected = [False] * len(lines)
+        for i, (start, end) in enumerate(lines):
+            if self.is_candidate(text[start:end]):
+                for j in range(
+                    max(i - self.context, 0), min(i + self.context + 1, len(lines))
+                ):
+                    selected[j] = True
+        runs = []
+        for (start, end), candidate in zip(lines, selected):
+            if runs and runs[-1][2] == candidate:
+                runs[-1] = (runs[-1][0], end, candidate)
+            else:
+                runs.append((start, end, candidate))
+        return runs
+
+    def __call__(self, nlp: Language, text: str) -> Doc:
+        """Process the candidate lines of `text` with `nlp`"""
+        parts = [
+            nlp(text[start:end]) if candidate else nlp.make_doc(text[start:end])
+            for start, end, candidate in self.split(text)
+        ]
+        return merge_docs(parts)
+
+    def pipe(
+        self,
+        nlp: Language,
+        items: Iterable[Tuple[str, object]],
+        process: Callable[[Iterable[Tuple[str, object]]], Iterator[Tuple[Doc, object]]],
+    ) -> Iterator[Tuple[Doc, object]]:
+        """
+        Yield (doc, context) tuples for the (text, context) tuples `items`, in order.
+        The candidate runs of lines of all the texts are processed as a single stream by
+        `process`, which takes and yields (text, context) and (doc, context) tuples in
+        order (e.g. ``nlp.pipe(..., as_tuples=True)``), so that they are batched together.
+        """
+        # Texts waiting for the docs of their candidate runs, in order, as
+        # [parts, number of missing parts, context]
+        pending = deque()
+
+        def candidates():
+            for text, context in items:
+                runs = self.split(text)
+                parts = [
+                    None if candidate else nlp.make_doc(text[start:end])
+                    for start, end, candidate in runs
+                ]
+                entry = [parts, parts.count(None), context]
+                pending.append(entry)
+                for i, (start, end, candidate) in enumerate(runs):
+                    if candidate:
+                        yield text[start:end], (entry, i)
+
+        for doc, (entry, i) in process(candidates()):
+            entry[0][i] = doc
+            entry[1] -= 1
+            while pending and pending[0][1] == 0:
+                parts, _, context = pending.popleft()
+                yield merge_docs(parts), context
+        # Texts without candidate runs at the end of the stream
+        while pending:
+            parts, _, context = pending.popleft()
+            yield merge_docs(parts), context
@@ -0,0 +1,90 @@
+"""
+Assignment of sentence ids to the entities of a document.
+
+Three sentence segmenters are available:
+
+* pysbd: scispacy's pysbd_sentencizer segments the whole document (the most accurate,
+  and the slowest)
+* rule: spaCy's punctuation-based sentencizer segments the whole document
+* lazy: pysbd only segments the paragraphs containing entities, after entity
+  recognition. The sentence ids are then numbered across these paragraphs only: the
+  entities of a sentence share an id, and ids increase along the document, but an id
+  is not the index of the sentence in the whole document.
+"""
+
+import re
+from bisect import bisect_right
+from typing import List
+
+import numpy as np
+from spacy.attrs import IDX, SENT_START
+from spacy.tokens import Doc, Span
+
+SEGMENTERS = ("pysbd", "rule", "lazy")
+SENTENCIZERS = {"pysbd": "pysbd_sentencizer", "rule": "sentencizer"}
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+def sentence_starts(doc: Doc) -> np.ndarray:
+    """Return the indices of the first tokens of the sentences of `doc`"""
+    starts = np.flatnonzero(doc.to_array(SENT_START) == 1)
+    if not len(starts) or starts[0] != 0:
+        starts = np.insert(starts, 0, 0)
+    return starts
+
+
+def set_sentence_ids(doc: Doc, ents: List[Span]) -> None:
+    """
+    Set the `sent_id` of the entities `ents` of `doc` to the index of the sentence they
+    start in, using the sentence boundaries of `doc`.
+    """
+    starts = sentence_starts(doc)
+    ids = np.searchsorted(starts, [ent.start for ent in ents], side="right") - 1
+    for ent, sent_id in zip(ents, ids.tolist()):
+        ent._.sent_id = sent_id
+
+
+def paragraph_bounds(text: str) -> List[int]:
+    """Return the character offsets at which the paragraphs of `text` start"""
+    return [0] + [match.end() for match in PARAGRAPH_BREAK.finditer(text)]
+
+
+def set_sentence_ids_lazily(doc: Doc, ents: List[Span], segmenter=None) -> None:
+    """
+    Set the `sent_id` of the entities `ents` of `doc`, sorted by position, segmenting
+    only the paragraphs containing entities with pysbd.
+    """
+    import pysbd
+    from scispacy.consts import ABBREVIATIONS
+
+    if not ents:
+        return
+    if segmenter is None:
+        segmenter = pysbd.Segmenter(language="en", clean=False, char_span=True)
+    text = doc.text
+    paragraphs = paragraph_bounds(text)
+    token_offsets = doc.to_array(IDX)
+    starts = []  # character offsets of the sentences of the segmented paragraphs
+    segmented = set()
+    for ent in ents:
+        i = bisect_right(paragraphs, ent.start_char) - 1
+        if i in segmented:
+            continue
+        segmented.add(i)
+        start = paragraphs[i]
+        end = paragraphs[i + 1] if i + 1 < len(paragraphs) else len(text)
+        for sent in segmenter.segment(text[start:end]):
+            sent_start = start + sent.start
+            # As in pysbd_sentencizer, sentences do not start after an abbreviation
+            token = np.searchsorted(token_offsets, sent_start)
+            if (
+                starts
+                and 0 < token < len(doc)
+                and token_offsets[token] == sent_start
+                and doc[token - 1].text in ABBREVIATIONS
+            ):
+                continue
+            starts.append(sent_start)
+    for ent in ents:
+        ent._.sent_id = max(bisect_right(starts, ent.start_char) - 1, 0)
@@ -1,14 +1,44 @@
 import pandas as pd
 import spacy
 import os
-from glob import glob
 import warnings
 import sys
 import logging
+from itertools import zip_longest
 from spacy.tokens import Span
 from taxonerd.extractor import TextExtractor
+from taxonerd.writers import BratWriter, read_docbin
+from taxonerd.batching import estimate_tokens, process_by_length
+from taxonerd.segmentation import (
+    SEGMENTERS,
+    SENTENCIZERS,
+    set_sentence_ids,
+    set_sentence_ids_lazily,
+)
+from taxonerd.corpus import (
+    collection_name,
+    corpus_root,
+    doc_ids,
+    in_shard,
+    is_collection,
+    iter_collection,
+    list_files,
+    parse_shard,
+    unique_doc_id,
+)
 import pathlib
 
+# The components of the TaxoNERD models, which are not needed with a standalone gazetteer
+STATISTICAL_COMPONENTS = [
+    "tok2vec",
+    "transformer",
+    "tagger",
+    "attribute_ruler",
+    "lemmatizer",
+    "parser",
+    "ner",
+]
+
 
 class TaxoNERD:
     def __init__(
@@ -16,12 +46,20 @@ class TaxoNERD:
         prefer_gpu=False,
         verbose=False,
         logger=None,
+        extraction_jobs=1,
+        extraction_timeout=None,
+        clean_txt=False,
     ):
         self.logger = logger if logger else logging.getLogger(__name__)
         warnings.simplefilter("ignore")
 
         self.verbose = verbose
-        self.extractor = TextExtractor(logger=self.logger)
+        self.extractor = TextExtractor(
+            logger=self.logger,
+            n_jobs=extraction_jobs,
+            timeout=extraction_timeout,
+            clean_txt=clean_txt,
+        )
 
         if prefer_gpu:
             import torch
@@ -36,6 +74,8 @@ class TaxoNERD:
         self.linker = None
         self.abbrev = None
         self.senten = None
+        self.gazetteer = None
+        self.prefilter = None
 
     def load(
         self,
@@ -44,43 +84,120 @@ class TaxoNERD:
         linker=None,
         neighbours=10,
         threshold=0.7,
+        linker_mmap=False,
+        linker_background=False,
+        segmenter="pysbd",
+        link_key="lemma",
+        gazetteer=None,
+        gazetteer_mode="union",
+        prefilter=False,
+        prefilter_kb=None,
     ):
-        self.nlp = spacy.load(model, exclude=exclude)
-        if "pysbd_sentencizer" not in exclude:
-            from scispacy.custom_sentence_segmenter import pysbd_sentencizer
-
-            if not Span.has_extension("sent_id"):
-                Span.set_extension("sent_id", default=None)
-            before = "parser" if "parser" not in exclude else "ner"
-            self.nlp.add_pipe("pysbd_sentencizer", before=before)
-            self.senten = "pysbd_sentencizer"
-        if "taxo_abbrev_detector" not in exclude:
-            from taxonerd.abbreviation import TaxonomicAbbreviationDetector
-
-            self.nlp.add_pipe("taxo_abbrev_detector")
-            self.abbrev = "taxo_abbrev_detector"
+        if segmenter not in SEGMENTERS:
+            raise ValueError(
+                "Unknown segmenter {}, expected one of {}".format(
+                    segmenter, ", ".join(SEGMENTERS)
+                )
+            )
+        if (
+            linker
+            and gazetteer
+            and gazetteer_mode == "standalone"
+            and link_key != "text"
+        ):
+            # The lemmatizer is not loaded with a standalone gazetteer, whose entities
+            # are linked already: the linker looks up the text of the other entities
+            self.logger.info(
+                "Link key {} is not available with a standalone gazetteer, use text".format(
+                    link_key
+                )
+            )
+            link_key = "text"
         if linker:
-            if "lemmatizer" in exclude:
+            from taxonerd.linking.linking import (
+                discard_prefetched_candidate_generator,
+                prefetch_candidate_generator,
+            )
+            from taxonerd.linking.linking_utils import LINK_KEYS
+
+            if link_key not in LINK_KEYS:
+                raise ValueError(
+                    "Unknown link key {}, expected one of {}".format(
+                        link_key, ", ".join(LINK_KEYS)
+                    )
+                )
+            if link_key != "text" and "lemmatizer" in exclude:
                 raise Exception(
                     "Lemmatizer is needed for entity linking. Make sure lemmatizer is not excluded from the pipeline"
                 )
 
-            import taxonerd.linking.linking
+            # Load the linker data while spaCy loads the model
+            prefetch_candidate_generator(linker, mmap=linker_mmap)
 
-            self.nlp.add_pipe("lower_case_lemmas", after="lemmatizer")
+        try:
+            # With entity_lemma link keys, only the entity tokens are lemmatized, by the
+            # linker: the lemmatizer is loaded but does not process the whole document
+            disable = ["lemmatizer"] if linker and link_key == "entity_lemma" else []
+            if gazetteer and gazetteer_mode == "standalone":
+                # Only the tokenizer of the model is needed
+                exclude = exclude + STATISTICAL_COMPONENTS
+            self.nlp = spacy.load(model, exclude=exclude, disable=disable)
+            if "pysbd_sentencizer" not in exclude:
+                from scispacy.custom_sentence_segmenter import pysbd_sentencizer
 
-            self.nlp.add_pipe(
-                "taxo_linker",
-                config={
-                    "linker_name": linker,
-                    "resolve_abbreviations": "taxo_abbrev_detector" not in exclude,
-                    "filter_for_definitions": False,
-                    "k": neighbours,
-                    "threshold": threshold,
-                },
-                name="taxon_linker",
-            )
-            self.linker = "taxon_linker" in self.nlp.pipe_names
+                if not Span.has_extension("sent_id"):
+                    Span.set_extension("sent_id", default=None)
+                if segmenter == "lazy":
+                    # Sentences are segmented after NER, around the entities only
+                    self.senten = "lazy"
+                else:
+                    before = next(
+                        (p for p in ["parser", "ner"] if p in self.nlp.pipe_names), None
+                    )
+                    self.nlp.add_pipe(SENTENCIZERS[segmenter], before=before)
+                    self.senten = SENTENCIZERS[segmenter]
+            if gazetteer:
+                from taxonerd.linking.gazetteer import Gazetteer
+
+                self.nlp.add_pipe(
+                    "taxo_gazetteer",
+                    config={"linker_name": gazetteer, "mode": gazetteer_mode},
+                )
+                self.gazetteer = "taxo_gazetteer"
+            if "taxo_abbrev_detector" not in exclude:
+                from taxonerd.abbreviation import TaxonomicAbbreviationDetector
+
+                self.nlp.add_pipe("taxo_abbrev_detector")
+                self.abbrev = "taxo_abbrev_detector"
+            if linker:
+                if link_key == "lemma":
+                    self.nlp.add_pipe("lower_case_lemmas", after="lemmatizer")
+
+                self.nlp.add_pipe(
+                    "taxo_linker",
+                    config={
+                        "linker_name": linker,
+                        "resolve_abbreviations": "taxo_abbrev_detector" not in exclude,
+                        "filter_for_definitions": False,
+                        "k": neighbours,
+                        "threshold": threshold,
+                        "mmap": linker_mmap,
+                        "background": linker_background,
+                        "link_key": link_key,
+                    },
+                    name="taxon_linker",
+                )
+                self.linker = "taxon_linker" in self.nlp.pipe_names
+        except BaseException:
+            if linker:
+                # The components were not created: do not keep the prefetched linker
+                discard_prefetched_candidate_generator(linker, mmap=linker_mmap)
+            raise
+        if prefilter or prefilter_kb:
+            from taxonerd.prefilter import ParagraphFilter, load_genera
+
+            genera = load_genera(prefilter_kb) if prefilter_kb else None
+            self.prefilter = ParagraphFilter(genera)
         if self.verbose:
             self.logger.info(
                 "Loaded model {}-{}".format(
@@ -90,40 +207,336 @@ class TaxoNERD:
             self.logger.info(f"Pipeline components: {self.nlp.pipe_names}")
         return self.nlp
 
-    def find_in_corpus(self, input_dir, output_dir=None):
-        df_map = {}
-        input_dir = self.extractor(input_dir)
-        if input_dir:
-            for filename in glob(os.path.join(input_dir, "*.txt")):
-                df = self.find_in_file(filename, output_dir)
-                if df is not None:
-                    df_map[os.path.basename(filename)] = df
-        return df_map
-
-    def find_in_file(self, filename, output_dir=None):
+    def find_in_corpus(
+        self,
+        input_dir=None,
+        output_dir=None,
+        recursive=False,
+        file_list=None,
+        shard=None,
+        text_key="text",
+        id_key="id",
+        writer=None,
+        batch_size=None,
+        max_tokens=None,
+    ):
+        return dict(
+            self.iter_corpus(
+                input_dir,
+                output_dir,
+                recursive,
+                file_list,
+                shard,
+                text_key,
+                id_key,
+                writer,
+                batch_size,
+                max_tokens,
+            )
+        )
+
+    def iter_corpus(
+        self,
+        input_dir=None,
+        output_dir=None,
+        recursive=False,
+        file_list=None,
+        shard=None,
+        text_key="text",
+        id_key="id",
+        writer=None,
+        batch_size=None,
+        max_tokens=None,
+    ):
+        """
+        Yield (filename, entities) pairs for the files of `input_dir`, as soon as each file
+        is processed. The text of the next documents is extracted in the background while
+        the entities of the current one are extracted.
+
+        Files are searched in the subdirectories of `input_dir` too if `recursive` is True,
+        or read from the `file_list` file (one path per line, relative to `input_dir`).
+        Filenames are relative to `input_dir`. With `shard` = "i/N", only the i-th of N
+        disjoint subsets of the files is processed (see `taxonerd.corpus.in_shard`).
+
+        The documents of archives (.tar.gz, .zip...) and JSONL files are read directly
+        from these files (see `iter_collection`). `input_dir` may also be such a file.
+
+        The entities are written with `writer` (see `taxonerd.writers`), or to BRAT .ann
+        files in `output_dir`. In both cases, the value returned by the writer (e.g. the
+        path to the .ann file) is yielded instead of the entities.
+
+        Documents are processed one at a time, or by batches of `batch_size`. With
+        `max_tokens`, they are batched by length with a budget of `max_tokens` padded
+        tokens, and at most `batch_size` documents if given (see `pipe`). Results are
+        yielded in order.
+        """
+        texts = self.iter_corpus_texts(
+            input_dir, recursive, file_list, shard, text_key, id_key
+        )
+        if writer is None and output_dir:
+            writer = BratWriter(output_dir)
+        if batch_size is None and not max_tokens:
+            batch_size = 1
+        docs = self.pipe(texts, batch_size, as_tuples=True, max_tokens=max_tokens)
+        for doc, (name, doc_id) in docs:
+            yield name, self.write(doc_id, doc, writer)
+
+    def iter_corpus_texts(
+        self,
+        input_dir=None,
+        recursive=False,
+        file_list=None,
+        shard=None,
+        text_key="text",
+        id_key="id",
+    ):
+        """
+        Yield (text, (name, document id)) tuples for the documents of the corpus, in the
+        order they are processed by `iter_corpus`. The name of a document is its id
+        followed by .txt. Documents with an empty id are skipped, and duplicate ids are
+        renamed (see `taxonerd.corpus.unique_doc_id`).
+        """
+        seen = set()
+        if input_dir and not os.path.exists(input_dir):
+            raise FileNotFoundError("No such file or directory: {}".format(input_dir))
+        if input_dir and is_collection(input_dir):
+            yield from self.iter_collection_texts(
+                input_dir, shard=shard, text_key=text_key, id_key=id_key, seen=seen
+            )
+            return
+        if input_dir and not os.path.isdir(input_dir):
+            return
+        files = list_files(input_dir, recursive, file_list)
+        if not files:
+            return
+        root = os.path.abspath(input_dir) if input_dir else corpus_root(files)
+        ids = dict(zip(files, doc_ids(files, root)))
+        index, count = parse_shard(shard)
+        if count > 1:
+            files = [
+                f
+                for f in files
+                if in_shard(os.path.relpath(os.path.abspath(f), root), index, count)
+            ]
+        collections = [f for f in files if is_collection(f)]
+        files = [f for f in files if not is_collection(f)]
+        for path, filename in self.extractor.iter_extract(files):
+            if filename:
+                self.logger.info("Extract taxa from file {}".format(filename))
+                with open(filename, "r") as f:
+                    text = f.read()
+                doc_id = unique_doc_id(ids[path], seen)
+                yield text, (doc_id + ".txt", doc_id)
+        for path in collections:
+            prefix = collection_name(os.path.relpath(os.path.abspath(path), root))
+            yield from self.iter_collection_texts(
+                path, prefix=prefix, text_key=text_key, id_key=id_key, seen=seen
+            )
+
+    def iter_collection(
+        self,
+        path,
+        output_dir=None,
+        shard=None,
+        prefix=None,
+        text_key="text",
+        id_key="id",
+        writer=None,
+        batch_size=None,
+        max_tokens=None,
+    ):
+        """
+        Yield (name, entities) pairs for the documents of an archive or a JSONL file,
+        read directly from the file (see `taxonerd.corpus.iter_collection`). Document
+        ids are prefixed with `prefix`/ if given, and named as in `iter_corpus_texts`. With `shard` = "i/N", only
+        the documents of the i-th of N disjoint subsets are processed. The entities are
+        written and the documents batched as in `iter_corpus`.
+        """
+        texts = self.iter_collection_texts(path, shard, prefix, text_key, id_key)
+        if writer is None and output_dir:
+            writer = BratWriter(output_dir)
+        if batch_size is None and not max_tokens:
+            batch_size = 1
+        docs = self.pipe(texts, batch_size, as_tuples=True, max_tokens=max_tokens)
+        for doc, (name, doc_id) in docs:
+            yield name, self.write(doc_id, doc, writer)
+
+    def iter_collection_texts(
+        self, path, shard=None, prefix=None, text_key="text", id_key="id", seen=None
+    ):
+        """
+        Yield (text, (name, document id)) tuples for the documents of an archive or a
+        JSONL file, as `iter_corpus_texts` does. `seen` is the set of the (lower case)
+        ids of the documents already read from the corpus.
+        """
+        seen = set() if seen is None else seen
+        index, count = parse_shard(shard)
+        for doc_id, text in iter_collection(path, text_key, id_key):
+            if not doc_id:
+                self.logger.warning("Skip document with an empty id in {}".format(path))
+                continue
+            if count > 1 and not in_shard(doc_id, index, count):
+                continue
+            if prefix:
+                doc_id = "/".join([prefix.replace(os.sep, "/"), doc_id])
+            doc_id = unique_doc_id(doc_id, seen)
+            self.logger.info("Extract taxa from document {} of {}".format(doc_id, path))
+            if self.extractor.clean_txt:
+                text = self.extractor.clean_text(text)
+            yield text, (doc_id + ".txt", doc_id)
+
+    def write(self, doc_id, doc, writer=None):
+        """
+        Write the entities of `doc` with `writer` and return what it returns, or return
+        the entities if there is no writer.
+        """
+        df = self.doc_to_df(doc)
+        return writer.write(doc_id, df, doc) if writer else df
+
+    def find_in_file(self, filename, output_dir=None, name=None, writer=None):
         if not os.path.exists(filename):
             raise FileNotFoundError("File {} not found".format(filename))
+        if name is None:
+            name = ".".join(os.path.basename(filename).split(".")[:-1])
+        if writer is None and output_dir:
+            writer = BratWriter(output_dir)
+        text = self.extract_text(filename)
+        if text is not None:
+            return self.write(name, self.ner(text), writer)
+        return None
+
+    def extract_text(self, filename):
+        """
+        Return the text of the file `filename` (extracted if needed, see
+        `taxonerd.extractor`), or None if no text could be extracted.
+        """
         filename = self.extractor(filename)
         if filename:
             self.logger.info("Extract taxa from file {}".format(filename))
             with open(filename, "r") as f:
-                text = f.read()
-            df = self.find_in_text(text)
-            if output_dir:
-                ann_filename = os.path.join(
-                    output_dir,
-                    ".".join(os.path.basename(filename).split(".")[:-1]) + ".ann",
-                )
-                df.to_csv(ann_filename, sep="\t", header=False)
-                return ann_filename
-            return df
+                return f.read()
         return None
 
     def find_in_text(self, text):
+        """
+        Return the entities found in `text`, as a DataFrame.
+
+        Once the model is loaded, a TaxoNERD instance can be shared by threads (e.g. the
+        workers of a web service) calling `find_in_text`, `ner` or `pipe`: processing a
+        text does not modify the pipeline, each thread reads the knowledge base of the
+        entity linker through its own SQLite connection, and nmslib releases the GIL
+        while searching the nearest neighbours of the mentions. `load` is not
+        thread-safe.
+        """
         doc = self.ner(text)
         return self.doc_to_df(doc)
 
+    def find_in_texts(self, texts, ids=None, batch_size=32, max_tokens=None):
+        """
+        Return the entities found in the in-memory `texts` as a single DataFrame, with
+        the id of the document of each entity in the "doc_id" column (the index of the
+        text in `texts`, or its id in `ids`) and the entity id (T0, T1...) in the "id"
+        column. The texts are processed in batches (see `pipe`).
+        """
+        results = list(self.iter_texts(texts, ids, batch_size, max_tokens))
+        if not results:
+            return pd.DataFrame(columns=["doc_id", "id"])
+        doc_ids, dfs = zip(*results)
+        df = pd.concat(dfs, keys=range(len(dfs)), names=["doc", "id"]).reset_index()
+        df.insert(0, "doc_id", [doc_ids[i] for i in df.pop("doc")])
+        return df
+
+    def iter_texts(self, texts, ids=None, batch_size=32, max_tokens=None, writer=None):
+        """
+        Yield (document id, entities) pairs for the in-memory `texts`, in order. The
+        documents are identified by their index in `texts`, or by their id in `ids`. The
+        entities are written with `writer` if given, as in `iter_corpus`. Raise
+        ``ValueError`` if `texts` and `ids` do not have the same length (for iterators,
+        once the shorter one is exhausted).
+        """
+        if ids is None:
+            items = ((text, i) for i, text in enumerate(texts))
+        else:
+            if hasattr(texts, "__len__") and hasattr(ids, "__len__"):
+                if len(texts) != len(ids):
+                    raise ValueError(
+                        "Got {} texts and {} ids".format(len(texts), len(ids))
+                    )
+            items = self.iter_with_ids(texts, ids)
+        docs = self.pipe(items, batch_size, as_tuples=True, max_tokens=max_tokens)
+        for doc, doc_id in docs:
+            yield doc_id, self.write(doc_id, doc, writer)
+
+    @staticmethod
+    def iter_with_ids(texts, ids):
+        missing = object()
+        for i, (text, doc_id) in enumerate(zip_longest(texts, ids, fillvalue=missing)):
+            if text is missing or doc_id is missing:
+                raise ValueError(
+                    "Got {} {} but more {}".format(
+                        i,
+                        "texts" if text is missing else "ids",
+                        "ids" if text is missing else "texts",
+                    )
+                )
+            yield text, doc_id
+
     def ner(self, text):
+        if self.prefilter:
+            return self.filter_entities(self.prefilter(self.nlp, text))
+        return self.filter_entities(self.nlp(text))
+
+    def load_docs(self, path):
+        """
+        Yield the (doc_id, doc) of the annotated documents saved in DocBin files by
+        `taxonerd.writers.DocBinWriter` (e.g. with ``taxonerd ask --output-format docbin``).
+        """
+        vocab = self.nlp.vocab if self.nlp else None
+        yield from read_docbin(path, vocab)
+
+    def pipe(self, texts, batch_size=32, as_tuples=False, max_tokens=None):
+        """
+        Process a stream of texts in batches with `nlp.pipe`, and yield the annotated
+        documents in order, as `ner` does. If `as_tuples` is True, `texts` is a stream of
+        (text, context) tuples and (doc, context) tuples are yielded.
+
+        With `max_tokens`, the texts are sorted by length and batched by token budget
+        rather than by count (see `taxonerd.batching`), which avoids padding short texts
+        to the length of long ones with the transformer models. Batches then have at
+        most `max_tokens` padded tokens, and at most `batch_size` texts unless it is
+        None.
+
+        With the `prefilter` option of `load`, only the candidate lines of the texts
+        are processed by the model (see `taxonerd.prefilter`), and they are batched
+        instead of the texts.
+        """
+        if not as_tuples:
+            texts = ((text, None) for text in texts)
+        if max_tokens:
+
+            def process(batch):
+                return self.nlp.pipe(batch, batch_size=len(batch), as_tuples=True)
+
+            def length(item):
+                return estimate_tokens(item[0])
+
+            def run(items):
+                return process_by_length(process, items, max_tokens, batch_size, length)
+
+        else:
+
+            def run(items):
+                return self.nlp.pipe(items, batch_size=batch_size, as_tuples=True)
+
+        if self.prefilter:
+            docs = self.prefilter.pipe(self.nlp, texts, run)
+        else:
+            docs = run(texts)
+        for doc, context in docs:
+            doc = self.filter_entities(doc)
+            yield (doc, context) if as_tuples else doc
+
+    def filter_entities(self, doc):
         def is_valid_entity(ent, doc, text):
             return (
                 "\n" not in text[ent.start_char : ent.end_char].strip("\n")
@@ -131,13 +544,13 @@ class TaxoNERD:
                 and (ent._.kb_ents if self.linker else True)
             )
 
-        doc = self.nlp(text)
+        text = doc.text
         ents = [ent for ent in doc.ents if is_valid_entity(ent, doc, text)]
 
-        if ents and self.senten:
-            sentences = {sent: id for id, sent in enumerate(doc.sents)}
-            for ent in ents:
-                ent._.sent_id = sentences[ent.sent]
+        if ents and self.senten == "lazy":
+            set_sentence_ids_lazily(doc, ents)
+        elif ents and self.senten:
+            set_sentence_ids(doc, ents)
 
         doc.set_ents(ents)
         # displacy.serve(doc, style="ent")
@@ -149,7 +562,7 @@ class TaxoNERD:
                 "offsets": "{} {} {}".format(ent.label_, ent.start_char, ent.end_char),
                 "text": ent.text.replace("\n", " "),
             }
-            if self.linker:
+            if self.linker or self.gazetteer:
                 ent_dict["entity"] = ent._.kb_ents
             if self.senten:
                 ent_dict["sent"] = ent._.sent_id
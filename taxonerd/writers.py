@@ -0,0 +1,360 @@
+"""
+Writers of the entities found in documents. Each writer stores the entities of many
+documents, identified by their document id:
+
+* BratWriter writes one BRAT .ann file per document (the historical output format)
+* JsonlWriter writes one JSON record per document to a single stream
+* ParquetWriter writes the entities of all the documents to a single Parquet file,
+  one file per shard (requires pyarrow)
+* DocBinWriter writes the annotated spaCy documents themselves to DocBin files, with
+  their custom attributes, so that they can be reloaded with `read_docbin`
+
+JsonlWriter, ParquetWriter and DocBinWriter buffer the records, and write them by
+batches.
+"""
+
+import os
+import sys
+import json
+from glob import glob
+from typing import IO, Iterator, List, Tuple, Union
+
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def entities_to_records(df: pd.DataFrame) -> List[dict]:
+    """
+    Convert the DataFrame returned by `TaxoNERD.doc_to_df` to a list of JSON-serializable
+    dicts, one per entity, with the entity id (T0, T1...) in the "id" field.
+    """
+    if df.empty:
+        return []
+    return json.loads(df.rename_axis("id").reset_index().to_json(orient="records"))
+
+
+def link_to_record(link: tuple) -> dict:
+    """Convert a (concept id, [alias,] score) entry of `kb_ents` to a dict"""
+    alias = link[1] if len(link) > 2 else None
+    return {"id": str(link[0]), "alias": alias, "score": float(link[-1])}
+
+
+def shard_filename(prefix: str, extension: str, shard: Tuple[int, int] = None) -> str:
+    if shard is None:
+        return prefix + extension
+    return "{}-{:05d}-of-{:05d}{}".format(prefix, shard[0], shard[1], extension)
+
+
+class Writer:
+    """
+    Base class of the writers. Writers can be used as context managers, to make sure that
+    buffered records are written.
+    """
+
+    def write(self, doc_id: str, df: pd.DataFrame, doc=None) -> str:
+        """
+        Write the entities `df` found in the document `doc_id`, and return the path of
+        the file they are written to. The spaCy `doc` may also be given.
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BratWriter(Writer):
+    """
+    Write the entities of each document to <output_dir>/<doc_id>.ann.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def write(self, doc_id, df, doc=None):
+        ann_filename = os.path.join(self.output_dir, doc_id + ".ann")
+        os.makedirs(os.path.dirname(ann_filename), exist_ok=True)
+        df.to_csv(ann_filename, sep="\t", header=False)
+        return ann_filename
+
+
+class JsonlWriter(Writer):
+    """
+    Write one {"id": doc_id, "entities": [...]} record per document to `output`, a path
+    or a text stream (e.g. sys.stdout). Records are written by batches of `buffer_size`.
+    Like the Parquet and DocBin files, the file at `output` is overwritten, so that
+    processing a shard again does not duplicate its records.
+    """
+
+    def __init__(self, output: Union[str, IO] = None, buffer_size: int = 1000):
+        if output is None:
+            output = sys.stdout
+        self.path = output if isinstance(output, str) else getattr(output, "name", None)
+        self.stream = open(output, "w") if isinstance(output, str) else output
+        self.close_stream = isinstance(output, str)
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write(self, doc_id, df, doc=None):
+        record = {"id": doc_id, "entities": entities_to_records(df)}
+        self.buffer.append(json.dumps(record) + "\n")
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return self.path
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write("".join(self.buffer))
+            self.buffer = []
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+class ParquetWriter(Writer):
+    """
+    Write the entities of all the documents to a Parquet file in `output_dir`, one row per
+    entity. Each shard of a corpus writes its own file. Rows are written by row groups of
+    `row_group_size` entities.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        shard: Tuple[int, int] = None,
+        row_group_size: int = 100000,
+    ):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(
+                "pyarrow is required to write Parquet files: pip install pyarrow"
+            )
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        os.makedirs(output_dir, exist_ok=True)
+        self.path = os.path.join(
+            output_dir, shard_filename("entities", ".parquet", shard)
+        )
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema(
+            [
+                ("doc_id", pyarrow.string()),
+                ("id", pyarrow.string()),
+                ("label", pyarrow.string()),
+                ("start", pyarrow.int64()),
+                ("end", pyarrow.int64()),
+                ("text", pyarrow.string()),
+                ("sent", pyarrow.int64()),
+                (
+                    "entity",
+                    pyarrow.list_(
+                        pyarrow.struct(
+                            [
+                                ("id", pyarrow.string()),
+                                ("alias", pyarrow.string()),
+                                ("score", pyarrow.float64()),
+                            ]
+                        )
+                    ),
+                ),
+            ]
+        )
+        self.columns = {name: [] for name in self.schema.names}
+        self.writer = None
+
+    def write(self, doc_id, df, doc=None):
+        columns = self.columns
+        for entity_id, row in zip(df.index, df.to_dict("records")):
+            label, start, end = row["offsets"].split(" ")
+            columns["doc_id"].append(doc_id)
+            columns["id"].append(entity_id)
+            columns["label"].append(label)
+            columns["start"].append(int(start))
+            columns["end"].append(int(end))
+            columns["text"].append(row["text"])
+            columns["sent"].append(int(row["sent"]) if "sent" in row else None)
+            columns["entity"].append(
+                [link_to_record(link) for link in row["entity"]]
+                if "entity" in row
+                else None
+            )
+        if len(columns["doc_id"]) >= self.row_group_size:
+            self.flush()
+        return self.path
+
+    def flush(self):
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, self.schema)
+        if self.columns["doc_id"]:
+            table = self.pa.Table.from_pydict(self.columns, schema=self.schema)
+            self.writer.write_table(table)
+            self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+SPAN_MARKER = "__span__"
+
+
+def encode_extension_value(value):
+    """
+    Replace the spans in an extension value (e.g. the long form of an abbreviation) by
+    their token offsets and label, as spans cannot be serialized.
+    """
+    from spacy.tokens import Span
+
+    if isinstance(value, Span):
+        return {SPAN_MARKER: (value.start, value.end, value.label_)}
+    if isinstance(value, (list, tuple)):
+        return type(value)(encode_extension_value(v) for v in value)
+    return value
+
+
+def decode_extension_value(doc, value):
+    """Restore the spans of `doc` encoded by `encode_extension_value`"""
+    from spacy.tokens import Span
+
+    if isinstance(value, dict) and SPAN_MARKER in value:
+        start, end, label = value[SPAN_MARKER]
+        return Span(doc, start, end, label)
+    if isinstance(value, (list, tuple)):
+        return tuple(decode_extension_value(doc, v) for v in value)
+    return value
+
+
+class DocBinWriter(Writer):
+    """
+    Write the annotated spaCy documents to DocBin files in `output_dir`, including the
+    values of their custom attributes (e.g. `sent_id`, `long_form` and `kb_ents`) and
+    their document id. A new file is started every `docs_per_file` documents, and each
+    shard of a corpus writes its own files. Use `read_docbin` to load the documents.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        shard: Tuple[int, int] = None,
+        docs_per_file: int = 10000,
+    ):
+        os.makedirs(output_dir, exist_ok=True)
+        self.prefix = os.path.join(output_dir, shard_filename("docs", "", shard))
+        self.docs_per_file = docs_per_file
+        self.n_files = 0
+        self.docbin = None
+
+    @property
+    def path(self):
+        return "{}-{:05d}.spacy".format(self.prefix, self.n_files)
+
+    def write(self, doc_id, df, doc=None):
+        from spacy.tokens import DocBin
+
+        if doc is None:
+            raise ValueError("DocBinWriter needs the spaCy doc of {}".format(doc_id))
+        if self.docbin is None:
+            self.docbin = DocBin(store_user_data=True)
+        user_data = doc.user_data
+        doc.user_data = {
+            key: encode_extension_value(value) for key, value in user_data.items()
+        }
+        doc.user_data["doc_id"] = doc_id
+        try:
+            self.docbin.add(doc)
+        finally:
+            doc.user_data = user_data
+        path = self.path
+        if len(self.docbin) >= self.docs_per_file:
+            self.flush()
+        return path
+
+    def flush(self):
+        if self.docbin is not None and len(self.docbin):
+            self.docbin.to_disk(self.path)
+            self.docbin = None
+            self.n_files += 1
+
+
+def read_docbin(path: str, vocab=None) -> Iterator[Tuple[str, "Doc"]]:
+    """
+    Yield the (doc_id, doc) of the documents written by `DocBinWriter` to the DocBin
+    file `path`, or to the files of the directory `path`. The custom attributes of the
+    documents are registered if needed, so that they can be read as usual
+    (e.g. ``ent._.kb_ents``).
+    """
+    from spacy.tokens import Doc, DocBin, Span, Token
+    from spacy.vocab import Vocab
+
+    if vocab is None:
+        vocab = Vocab()
+    paths = (
+        sorted(glob(os.path.join(path, "*.spacy"))) if os.path.isdir(path) else [path]
+    )
+    for docbin_path in paths:
+        for doc in DocBin().from_disk(docbin_path).get_docs(vocab):
+            doc_id = doc.user_data.pop("doc_id", None)
+            for key, value in list(doc.user_data.items()):
+                if not (isinstance(key, tuple) and len(key) == 4 and key[0] == "._."):
+                    continue
+                _, name, start, end = key
+                if start is None:
+                    cls = Doc
+                elif end is None:
+                    cls = Token
+                else:
+                    cls = Span
+                if not cls.has_extension(name):
+                    cls.set_extension(name, default=None)
+                value = decode_extension_value(doc, value)
+                # Sequences are deserialized as tuples, restore lists of values
+                doc.user_data[key] = list(value) if isinstance(value, tuple) else value
+            yield doc_id, doc
+
+
+OUTPUT_FORMATS = ("brat", "jsonl", "parquet", "docbin")
+
+
+def get_writer(
+    output_format: str = "brat", output_dir: str = None, shard: Tuple[int, int] = None
+) -> Writer:
+    """
+    Return a writer of the given format. JSONL records are written to stdout if no
+    `output_dir` is given. With a `shard`, the JSONL, Parquet and DocBin files are named
+    after it.
+    """
+    if output_format == "jsonl":
+        if not output_dir:
+            return JsonlWriter(sys.stdout)
+        os.makedirs(output_dir, exist_ok=True)
+        return JsonlWriter(
+            os.path.join(output_dir, shard_filename("entities", ".jsonl", shard))
+        )
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            "Unknown output format {}, expected one of {}".format(
+                output_format, ", ".join(OUTPUT_FORMATS)
+            )
+        )
+    if not output_dir:
+        raise ValueError("An output directory is required for {}".format(output_format))
+    if output_format == "parquet":
+        return ParquetWriter(output_dir, shard)
+    if output_format == "docbin":
+        return DocBinWriter(output_dir, shard)
+    return BratWriter(output_dir)
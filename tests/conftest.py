@@ -0,0 +1,35 @@
+import pytest
+import spacy
+from taxonerd import TaxoNERD
+from taxonerd import extractor as extractor_module
+
+
+@pytest.fixture
+def extraction_cache(tmp_path_factory, monkeypatch):
+    """A temporary cache directory for the extracted text"""
+    cache_dir = str(tmp_path_factory.mktemp("extractions"))
+    monkeypatch.setattr(extractor_module, "EXTRACTION_CACHE", cache_dir)
+    return cache_dir
+
+
+@pytest.fixture
+def make_nerd(extraction_cache):
+    """
+    Return a function creating a TaxoNERD instance without model: a blank pipeline
+    tags the given patterns as LIVB entities.
+    """
+
+    def make_nerd(patterns=("bears",)):
+        nerd = TaxoNERD()
+        nerd.nlp = spacy.blank("en")
+        ruler = nerd.nlp.add_pipe("entity_ruler")
+        ruler.add_patterns([{"label": "LIVB", "pattern": p} for p in patterns])
+        return nerd
+
+    return make_nerd
+
+
+@pytest.fixture
+def nerd(make_nerd):
+    """A TaxoNERD instance tagging "bears" as LIVB entities"""
+    return make_nerd()
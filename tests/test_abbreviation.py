@@ -0,0 +1,112 @@
+import pytest
+import random
+import spacy
+from itertools import compress
+from spacy.tokens import Span
+from taxonerd.abbreviation import (
+    TaxonomicAbbreviationDetector,
+    remove_overlapping_spans,
+)
+
+
+@pytest.fixture(scope="module")
+def detector():
+    return TaxonomicAbbreviationDetector(spacy.blank("en"))
+
+
+def annotate(text, entities):
+    nlp = spacy.blank("en")
+    doc = nlp(text)
+    ents = []
+    for entity in entities:
+        start = text.index(entity, ents[-1].end_char if ents else 0)
+        ents.append(doc.char_span(start, start + len(entity), "LIVB"))
+    doc.set_ents(ents)
+    return doc
+
+
+def long_forms(doc):
+    return [
+        (ent.text, ent._.long_form.text if ent._.long_form else None)
+        for ent in doc.ents
+    ]
+
+
+def test_find_abbreviated_scientific_names(detector):
+    doc = annotate(
+        "Q. robur, Quercus robur and Quercus petraea. Q. robur and Q. petraea.",
+        ["Q. robur", "Quercus robur", "Quercus petraea", "Q. robur", "Q. petraea"],
+    )
+    doc = detector.find_abbreviated_scientific_names(doc)
+    # The long form must precede the first occurrence of the abbreviated name
+    assert long_forms(doc) == [
+        ("Q. robur", None),
+        ("Quercus robur", "Quercus robur"),
+        ("Quercus petraea", "Quercus petraea"),
+        ("Q. robur", None),
+        ("Q. petraea", "Quercus petraea"),
+    ]
+
+
+def test_closest_long_form_is_chosen(detector):
+    doc = annotate(
+        "Quercus robur and Quillaja robur, then Q. robur and Ursus arctos",
+        ["Quercus robur", "Quillaja robur", "Q. robur", "Ursus arctos"],
+    )
+    doc = detector.find_abbreviated_scientific_names(doc)
+    assert long_forms(doc)[2:] == [
+        ("Q. robur", "Quillaja robur"),
+        ("Ursus arctos", "Ursus arctos"),
+    ]
+
+
+def reference_remove_overlapping_spans(spans):
+    """The original, pairwise implementation of remove_overlapping_spans"""
+    keep = [True] * len(spans)
+    for i in range(len(spans)):
+        if keep[i]:
+            for j in range(i + 1, len(spans)):
+                span_i = spans[i]
+                span_j = spans[j]
+                if not (span_i.start > span_j.end or span_i.end < span_j.start):
+                    if len(span_i) <= len(span_j):
+                        keep[i] = False
+                    else:
+                        keep[j] = False
+    return list(compress(spans, keep))
+
+
+def test_remove_overlapping_spans():
+    doc = spacy.blank("en")(" ".join(["word"] * 50))
+    rng = random.Random(0)
+    for _ in range(2000):
+        spans = []
+        for _ in range(rng.randint(0, 12)):
+            start = rng.randrange(50)
+            spans.append(doc[start : min(50, start + rng.randint(1, 4))])
+        assert remove_overlapping_spans(spans) == reference_remove_overlapping_spans(
+            spans
+        )
+
+
+def test_add_abbreviations(detector):
+    doc = annotate(
+        "Brown bears (BB) and Ursus arctos (UA BB) live with Ursus arctos",
+        ["Brown bears", "Ursus arctos", "Ursus arctos"],
+    )
+    ents = list(doc.ents)
+    abbreviations = [doc[3:4], doc[9:10], doc[9:11], doc[10:11], doc[13:14]]
+    for abrv, long_form in zip(abbreviations, [0, 1, 1, 0, 2]):
+        abrv._.long_form = ents[long_form]
+    # Abbreviations whose long form is not an entity are ignored
+    abbreviations[0]._.long_form = doc[0:1]
+    doc._.abbreviations = abbreviations
+    ents = detector.add_abbreviations(doc, ents)
+    # BB is ignored, UA BB is longer than UA and BB, and "with" touches an entity
+    assert [ent.text for ent in ents] == [
+        "Brown bears",
+        "Ursus arctos",
+        "UA BB",
+        "Ursus arctos",
+    ]
+    assert ents[2]._.long_form.text == "Ursus arctos"
@@ -0,0 +1,107 @@
+import pytest
+import asyncio
+from taxonerd.aio import AsyncTaxoNERD
+
+
+def test_find_in_text(nerd):
+    texts = ["{} bears".format(" ".join(["word"] * i)) for i in range(20)]
+    batches = []
+    pipe = nerd.pipe
+
+    def recording_pipe(texts, *args, **kwargs):
+        batches.append(len(texts))
+        return pipe(texts, *args, **kwargs)
+
+    nerd.pipe = recording_pipe
+
+    async def main():
+        async with AsyncTaxoNERD(nerd, max_batch_size=8) as anerd:
+            return await asyncio.gather(*[anerd.find_in_text(t) for t in texts])
+
+    results = asyncio.run(main())
+    assert [df.to_dict() for df in results] == [
+        nerd.find_in_text(text).to_dict() for text in texts
+    ]
+    # Concurrent requests are processed in batches
+    assert sum(batches) == 20
+    assert max(batches) == 8 and len(batches) < 20
+
+
+def test_errors(nerd):
+    pipe = nerd.pipe
+
+    def failing_pipe(texts, *args, **kwargs):
+        if "fail" in texts:
+            raise RuntimeError("Inference failed")
+        return pipe(texts, *args, **kwargs)
+
+    nerd.pipe = failing_pipe
+
+    async def main():
+        async with AsyncTaxoNERD(nerd) as anerd:
+            return await asyncio.gather(
+                anerd.find_in_text("bears"),
+                anerd.find_in_text("fail"),
+                anerd.find_in_text("more bears"),
+                return_exceptions=True,
+            )
+
+    results = asyncio.run(main())
+    # Only the failing request fails, not the whole batch
+    assert isinstance(results[1], RuntimeError)
+    assert [len(results[0]), len(results[2])] == [1, 1]
+
+
+def test_close(nerd):
+    async def main():
+        anerd = AsyncTaxoNERD(nerd, max_wait=60)
+        request = asyncio.ensure_future(anerd.find_in_text("bears"))
+        await asyncio.sleep(0.1)
+        # The request waits for more texts in the batcher
+        await anerd.close()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(request, 1)
+
+    asyncio.run(main())
+
+
+def test_batcher_errors(nerd):
+    async def failing_acquire():
+        raise RuntimeError("Batching failed")
+
+    async def main():
+        async with AsyncTaxoNERD(nerd) as anerd:
+            anerd._start()
+            anerd._workers.acquire = failing_acquire
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(anerd.find_in_text("bears"), 1)
+            # Later requests fail too, instead of waiting forever
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(anerd.find_in_text("bears"), 1)
+
+    asyncio.run(main())
+
+
+def test_find_in_file_and_corpus(nerd, tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for i in range(10):
+        (input_dir / "doc{}.txt".format(i)).write_text("{} bears".format(i))
+    output_dir = tmp_path / "output"
+
+    async def main():
+        async with AsyncTaxoNERD(nerd, max_batch_size=4) as anerd:
+            df = await anerd.find_in_file(str(input_dir / "doc0.txt"))
+            ann = await anerd.find_in_file(
+                str(input_dir / "doc1.txt"), output_dir=str(output_dir)
+            )
+            corpus = await anerd.find_in_corpus(str(input_dir))
+            return df, ann, corpus
+
+    df, ann, corpus = asyncio.run(main())
+    assert df.to_dict() == nerd.find_in_file(str(input_dir / "doc0.txt")).to_dict()
+    assert ann == str(output_dir / "doc1.ann")
+    assert (output_dir / "doc1.ann").read_text() == "T0\tLIVB 2 7\tbears\n"
+    expected = nerd.find_in_corpus(str(input_dir))
+    assert list(corpus) == list(expected)
+    assert all(corpus[name].to_dict() == expected[name].to_dict() for name in corpus)
@@ -0,0 +1,86 @@
+import random
+from taxonerd.batching import estimate_tokens, process_by_length, token_budget_batches
+
+
+def test_token_budget_batches():
+    rng = random.Random(0)
+    lengths = [rng.choice([5, 20, 100, 3000]) for _ in range(200)]
+    batches = token_budget_batches(lengths, max_tokens=1000, max_batch_size=16)
+    assert sorted(i for batch in batches for i in batch) == list(range(200))
+    for batch in batches:
+        padded = len(batch) * max(lengths[i] for i in batch)
+        assert len(batch) <= 16
+        assert padded <= 1000 or len(batch) == 1
+    # Documents of similar lengths are batched together
+    assert all(len(set(lengths[i] for i in batch)) <= 2 for batch in batches)
+    assert token_budget_batches([], 1000) == []
+
+
+def test_process_by_length():
+    texts = [" ".join(["word"] * n) for n in [50, 1, 400, 3, 3, 50, 2]]
+    batches = []
+
+    def process(batch):
+        batches.append(batch)
+        return [text.upper() for text in batch]
+
+    results = list(process_by_length(process, iter(texts), 100, window_size=4))
+    assert results == [text.upper() for text in texts]
+    assert [len(batch) for batch in batches] == [2, 1, 1, 2, 1]
+    assert estimate_tokens("Brown bears\neat salmon") == 4
+
+
+def test_process_by_length_streams_results():
+    read = []
+
+    def items():
+        for i in range(2000):
+            read.append(i)
+            yield " ".join(["word"] * 10)
+
+    results = process_by_length(lambda batch: batch, items(), 100)
+    next(results)
+    # Windows hold enough tokens for a few batches, not a fixed number of items
+    assert len(read) == 40
+    results = process_by_length(lambda batch: batch, items(), 1000, max_batch_size=2)
+    read.clear()
+    next(results)
+    assert len(read) == 8
+
+
+def test_pipe_by_length(nerd, tmp_path):
+    texts = ["{} bears".format(" ".join(["word"] * (i * 37 % 100))) for i in range(50)]
+    contexts = list(range(50))
+    docs = list(nerd.pipe(zip(texts, contexts), as_tuples=True, max_tokens=200))
+    assert [context for _, context in docs] == contexts
+    assert [doc.text for doc, _ in docs] == texts
+    assert all(len(doc.ents) == 1 for doc, _ in docs)
+
+    for i, text in enumerate(texts[:10]):
+        (tmp_path / "doc{}.txt".format(i)).write_text(text)
+    results = nerd.iter_corpus(str(tmp_path), batch_size=4, max_tokens=100)
+    assert [name for name, _ in results] == ["doc{}.txt".format(i) for i in range(10)]
+
+
+def test_find_in_corpus_batch_sizes(nerd, tmp_path):
+    for i in range(10):
+        (tmp_path / "doc{}.txt".format(i)).write_text("Brown bears")
+    batch_sizes = []
+    pipe = nerd.nlp.pipe
+
+    def recording_pipe(texts, batch_size=None, **kwargs):
+        if kwargs.get("as_tuples"):  # Not the inner call of spaCy
+            batch_sizes.append(batch_size)
+        return pipe(texts, batch_size=batch_size, **kwargs)
+
+    nerd.nlp.pipe = recording_pipe
+    # Documents are processed one at a time by default
+    assert len(nerd.find_in_corpus(str(tmp_path))) == 10
+    assert batch_sizes == [1]
+    # With a token budget, batches are only limited by the budget
+    batch_sizes.clear()
+    assert len(nerd.find_in_corpus(str(tmp_path), max_tokens=1000)) == 10
+    assert batch_sizes == [10]
+    batch_sizes.clear()
+    assert len(nerd.find_in_corpus(str(tmp_path), batch_size=4, max_tokens=1000)) == 10
+    assert batch_sizes == [4, 4, 2]
@@ -1,6 +1,9 @@
 import pytest
+import io
+import json
 from click.testing import CliRunner
 from taxonerd import cli
+from taxonerd.cli import annotate_jsonl
 
 
 @pytest.fixture
@@ -23,3 +26,29 @@ def test_cli_with_string(runner):
     result = runner.invoke(cli, ["ask", query])
     assert result.exit_code == 0
     assert not result.exception
+
+
+def test_annotate_jsonl(make_nerd):
+    nerd = make_nerd(["Ursus arctos"])
+    lines = [
+        json.dumps({"id": "a", "text": "Brown bears (Ursus arctos)"}),
+        "",
+        "not json",
+        json.dumps({"text": "No taxon"}),
+        json.dumps({"id": "b", "body": "No text field"}),
+        json.dumps({"id": "c", "text": None}),
+        json.dumps({"id": "d", "text": 42}),
+        json.dumps(["not", "an", "object"]),
+        json.dumps({"id": "e", "text": "Ursus arctos"}),
+    ]
+    output = io.StringIO()
+    annotate_jsonl(nerd, io.StringIO("\n".join(lines)), output, batch_size=2)
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [result["id"] for result in results] == ["a", 2, 3, "b", "c", "d", 7, "e"]
+    assert results[0]["entities"] == [
+        {"id": "T0", "offsets": "LIVB 13 25", "text": "Ursus arctos"}
+    ]
+    assert "error" in results[1] and results[2]["entities"] == []
+    # Invalid records are reported, and do not stop the stream
+    assert all("error" in result for result in results[3:7])
+    assert results[7]["entities"][0]["text"] == "Ursus arctos"
@@ -0,0 +1,256 @@
+import pytest
+import os
+import io
+import gzip
+import json
+import tarfile
+import zipfile
+from click.testing import CliRunner
+from taxonerd import cli
+from taxonerd.writers import get_writer
+from taxonerd.corpus import (
+    doc_ids,
+    in_shard,
+    iter_collection,
+    list_files,
+    merge_outputs,
+    normalize_doc_id,
+    parse_shard,
+)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    for name in ["a.txt", "b.txt", "sub/c.txt", "sub/deeper/d.txt", "sub/e.txt"]:
+        os.makedirs(os.path.dirname(tmp_path / name), exist_ok=True)
+        (tmp_path / name).write_text("Some text about Ursus arctos")
+    return tmp_path
+
+
+@pytest.fixture
+def taxonerd(make_nerd):
+    return make_nerd(["Ursus arctos"])
+
+
+def test_list_files(corpus):
+    assert [os.path.relpath(f, corpus) for f in list_files(str(corpus))] == [
+        "a.txt",
+        "b.txt",
+    ]
+    assert len(list_files(str(corpus), recursive=True)) == 5
+    (corpus / "files.txt").write_text("sub/c.txt\n\na.txt\n")
+    assert list_files(str(corpus), file_list=str(corpus / "files.txt")) == [
+        os.path.join(str(corpus), "sub/c.txt"),
+        os.path.join(str(corpus), "a.txt"),
+    ]
+
+
+def test_doc_ids(tmp_path):
+    paths = [str(tmp_path / name) for name in ["p.pdf", "p.docx", "q.pdf", "s/q.pdf"]]
+    assert doc_ids(paths, str(tmp_path)) == ["p.pdf", "p.docx", "q", "s/q"]
+
+
+def test_parse_shard():
+    assert parse_shard("1/4") == (1, 4)
+    assert parse_shard(None) == (0, 1)
+    for shard in ["4/4", "-1/2", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+
+def test_shards_are_stable():
+    paths = ["doc{}.pdf".format(i) for i in range(1000)]
+    shards = {path: [i for i in range(4) if in_shard(path, i, 4)] for path in paths}
+    # Each document belongs to exactly one shard, and the shards are balanced
+    assert all(len(s) == 1 for s in shards.values())
+    sizes = [sum(s == [i] for s in shards.values()) for i in range(4)]
+    assert min(sizes) > 200
+    # The shard of a document only depends on its path
+    assert all(in_shard(path, shards[path][0], 4) for path in reversed(paths))
+
+
+def test_sharded_corpus(taxonerd, corpus, tmp_path_factory):
+    shard_dirs = [str(tmp_path_factory.mktemp("shard")) for _ in range(3)]
+    names = []
+    for i, shard_dir in enumerate(shard_dirs):
+        results = taxonerd.find_in_corpus(
+            str(corpus), shard_dir, recursive=True, shard="{}/3".format(i)
+        )
+        names.extend(results)
+    assert sorted(names) == [
+        "a.txt",
+        "b.txt",
+        "sub/c.txt",
+        "sub/deeper/d.txt",
+        "sub/e.txt",
+    ]
+
+    output_dir = str(tmp_path_factory.mktemp("merged"))
+    merged = merge_outputs(shard_dirs, output_dir)
+    assert sorted(os.path.relpath(path, output_dir) for path in merged) == [
+        "a.ann",
+        "b.ann",
+        "sub/c.ann",
+        "sub/deeper/d.ann",
+        "sub/e.ann",
+    ]
+    assert open(os.path.join(output_dir, "sub/c.ann")).read().startswith("T0\tLIVB")
+    with pytest.raises(FileExistsError):
+        merge_outputs(shard_dirs[:1], output_dir)
+
+
+@pytest.mark.parametrize("output_format", ["jsonl", "parquet"])
+def test_merge_bulk_outputs(taxonerd, corpus, tmp_path_factory, output_format, caplog):
+    if output_format == "parquet":
+        pytest.importorskip("pyarrow")
+    shard_dirs = [str(tmp_path_factory.mktemp("shard")) for _ in range(2)]
+    for i, shard_dir in enumerate(shard_dirs):
+        writer = get_writer(output_format, shard_dir, shard=(i, 2))
+        with writer:
+            taxonerd.find_in_corpus(
+                str(corpus), recursive=True, shard="{}/2".format(i), writer=writer
+            )
+    open(os.path.join(shard_dirs[0], "notes.txt"), "w").close()
+    output_dir = str(tmp_path_factory.mktemp("merged"))
+    merged = merge_outputs(shard_dirs, output_dir)
+    assert sorted(os.path.relpath(path, output_dir) for path in merged) == [
+        "entities-00000-of-00002." + output_format,
+        "entities-00001-of-00002." + output_format,
+    ]
+    assert "notes.txt is not an output file" in caplog.text
+    if output_format == "jsonl":
+        ids = [json.loads(line)["id"] for path in merged for line in open(path)]
+    else:
+        import pandas as pd
+
+        ids = pd.concat(pd.read_parquet(path) for path in merged)["doc_id"]
+    assert sorted(ids) == [
+        "a",
+        "b",
+        "sub/c",
+        "sub/deeper/d",
+        "sub/e",
+    ]
+
+
+def test_cli_shard():
+    result = CliRunner().invoke(cli, ["ask", "-i", ".", "--shard", "2/2"])
+    assert result.exit_code != 0
+    assert "Invalid shard" in result.output
+    result = CliRunner().invoke(cli, ["merge", "--help"])
+    assert result.exit_code == 0
+
+
+DOCUMENTS = {
+    "papers/p1": "Brown bears (Ursus arctos) eat salmon",
+    "papers/p2": "No taxon here",
+    "p3": "Ursus arctos again",
+}
+
+
+@pytest.fixture
+def collections(tmp_path):
+    with tarfile.open(tmp_path / "corpus.tar.gz", "w:gz") as tar:
+        for doc_id, text in DOCUMENTS.items():
+            data = text.encode("utf-8")
+            member = tarfile.TarInfo("./" + doc_id + ".txt")
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+        member = tarfile.TarInfo("figure.png")
+        tar.addfile(member, io.BytesIO(b""))
+    with zipfile.ZipFile(tmp_path / "corpus.zip", "w") as archive:
+        for doc_id, text in DOCUMENTS.items():
+            archive.writestr(doc_id + ".txt", text)
+    with gzip.open(tmp_path / "corpus.jsonl.gz", "wt") as f:
+        for doc_id, text in DOCUMENTS.items():
+            f.write(json.dumps({"pmid": doc_id, "body": text}) + "\n")
+    return tmp_path
+
+
+@pytest.mark.parametrize("filename", ["corpus.tar.gz", "corpus.zip", "corpus.jsonl.gz"])
+def test_iter_collection(collections, filename):
+    documents = iter_collection(
+        str(collections / filename), text_key="body", id_key="pmid"
+    )
+    assert dict(documents) == DOCUMENTS
+
+
+def test_iter_jsonl_skips_invalid_records(tmp_path, caplog):
+    path = tmp_path / "corpus.jsonl"
+    lines = [
+        {"id": "valid", "text": "Ursus arctos"},
+        '{"id": "truncated", "te',
+        {"id": "no_text", "body": "Ursus arctos"},
+        ["not", "an", "object"],
+        {"id": "null_text", "text": None},
+    ]
+    path.write_text(
+        "\n".join(r if isinstance(r, str) else json.dumps(r) for r in lines) + "\n"
+    )
+    assert list(iter_collection(str(path))) == [("valid", "Ursus arctos")]
+    errors = [r.getMessage() for r in caplog.records if r.levelname == "ERROR"]
+    assert len(errors) == 4
+    assert errors[0].startswith("Invalid record on line 2 of {}".format(path))
+    assert "line 3" in errors[1] and "text is missing" in errors[1]
+    assert "line 4" in errors[2] and "not an object" in errors[2]
+    assert "line 5" in errors[3] and "text is not a string" in errors[3]
+
+
+def test_normalize_doc_id():
+    assert normalize_doc_id("./a/b") == "a/b"
+    assert normalize_doc_id("/../../etc/passwd") == "etc/passwd"
+    assert normalize_doc_id("../x") == "_/x"
+    assert normalize_doc_id("10.1000/182") == "10.1000/182"
+
+
+def test_find_in_collection(taxonerd, collections, tmp_path_factory):
+    output_dir = str(tmp_path_factory.mktemp("ann"))
+    results = taxonerd.find_in_corpus(str(collections / "corpus.tar.gz"), output_dir)
+    assert sorted(results) == sorted(doc_id + ".txt" for doc_id in DOCUMENTS)
+    assert results["p3.txt"] == os.path.join(output_dir, "p3.ann")
+    assert open(results["papers/p1.txt"]).read() == "T0\tLIVB 13 25\tUrsus arctos\n"
+
+    shards = [
+        taxonerd.find_in_corpus(
+            str(collections / "corpus.jsonl.gz"),
+            shard="{}/2".format(i),
+            text_key="body",
+            id_key="pmid",
+        )
+        for i in range(2)
+    ]
+    assert sorted(list(shards[0]) + list(shards[1])) == sorted(
+        doc_id + ".txt" for doc_id in DOCUMENTS
+    )
+
+
+def test_find_in_directory_of_collections(taxonerd, collections, tmp_path):
+    corpus_dir = tmp_path / "bundles"
+    os.makedirs(corpus_dir)
+    os.rename(collections / "corpus.zip", corpus_dir / "bundle.zip")
+    (corpus_dir / "a.txt").write_text("Ursus arctos")
+    results = taxonerd.find_in_corpus(str(corpus_dir))
+    assert sorted(results) == sorted(
+        ["a.txt"] + ["bundle/" + doc_id + ".txt" for doc_id in DOCUMENTS]
+    )
+
+
+def test_duplicate_doc_ids(taxonerd, tmp_path):
+    corpus_dir = tmp_path / "corpus"
+    os.makedirs(corpus_dir / "bundle")
+    (corpus_dir / "bundle" / "a.txt").write_text("Ursus arctos")
+    with open(corpus_dir / "bundle.jsonl", "w") as f:
+        for doc_id in ["a", "A", "", None, "./"]:
+            f.write(json.dumps({"id": doc_id, "text": "Ursus arctos"}) + "\n")
+    output_dir = str(tmp_path / "ann")
+    results = taxonerd.find_in_corpus(str(corpus_dir), output_dir, recursive=True)
+    # Each document is written to its own annotation file
+    assert sorted(results) == [
+        "bundle/2.txt",
+        "bundle/3.txt",
+        "bundle/4.txt",
+        "bundle/A_3.txt",
+        "bundle/a.txt",
+        "bundle/a_2.txt",
+    ]
+    assert len(set(results.values())) == 6
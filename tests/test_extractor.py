@@ -0,0 +1,243 @@
+import pytest
+import os
+import re
+import time
+import random
+import subprocess
+import threading
+from taxonerd import extractor as extractor_module
+from taxonerd.extractor import TextExtractor, clean_text, iter_clean_text
+
+
+class FakeExtractor(TextExtractor):
+    """Extract the text of fake documents, whose name tells how to behave"""
+
+    def process(self, path):
+        name = os.path.basename(path)
+        if name.startswith("fail"):
+            raise ValueError("Cannot extract text")
+        if name.startswith("hang"):
+            subprocess.run(["sleep", "60"])
+        if name.startswith("slow"):
+            time.sleep(1)
+        if name.startswith("pid"):
+            return str(os.getpid())
+        return open(path).read()
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(extraction_cache):
+    return extraction_cache
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    for name in ["doc1.pdf", "fail.pdf", "hang.pdf", "doc2.docx", "text.txt"]:
+        (tmp_path / name).write_text("Text of " + name)
+    return tmp_path
+
+
+def test_sequential_extraction(corpus, cache_dir):
+    extractor = FakeExtractor()
+    paths = [str(corpus / name) for name in ["doc1.pdf", "fail.pdf", "text.txt"]]
+    outputs = extractor.extract_from_files(paths)
+    assert outputs[0].startswith(cache_dir)
+    assert outputs[1:] == [None, str(corpus / "text.txt")]
+    assert open(outputs[0]).read() == "Text of doc1.pdf"
+    assert sorted(os.listdir(corpus)) == sorted(
+        ["doc1.pdf", "fail.pdf", "hang.pdf", "doc2.docx", "text.txt"]
+    )
+
+
+def test_extraction_cache(corpus, monkeypatch):
+    path = str(corpus / "doc1.pdf")
+    output_path = FakeExtractor().extract_from_file(path)
+    monkeypatch.setattr(FakeExtractor, "process", pytest.fail)
+    assert FakeExtractor().extract_from_file(path) == output_path
+    # Modified documents are extracted again
+    (corpus / "doc1.pdf").write_text("New text of doc1.pdf")
+    monkeypatch.undo()
+    new_output_path = FakeExtractor().extract_from_file(path)
+    assert new_output_path != output_path
+    assert open(new_output_path).read() == "New text of doc1.pdf"
+    # A copy of the document is not extracted again, whatever its name
+    (corpus / "copy.docx").write_text("New text of doc1.pdf")
+    assert FakeExtractor().get_output_path(str(corpus / "copy.docx")) == new_output_path
+    # Extractors with other settings do not share the cached text
+    assert TextExtractor().get_output_path(path) != new_output_path
+    # Unchanged documents are not hashed again by later runs
+    monkeypatch.setattr(extractor_module, "sha256", pytest.fail)
+    assert FakeExtractor().get_output_path(path) == new_output_path
+
+
+def test_source_index_is_compacted(corpus, cache_dir):
+    path = str(corpus / "doc1.pdf")
+    extractors = [FakeExtractor(), TextExtractor()]
+    for i in range(3):
+        (corpus / "doc1.pdf").write_text("Text {} of doc1.pdf".format(i))
+        os.utime(path, ns=(i, i))
+        output_path, _ = [e.get_output_path(path) for e in extractors]
+    index_path = os.path.join(cache_dir, extractor_module.SOURCE_INDEX)
+    with open(index_path, "a") as f:
+        f.write('["partial line"')
+    assert len(open(index_path).readlines()) == 7
+    # The last entry of the document is kept for each extractor
+    assert FakeExtractor().get_output_path(path) == output_path
+    assert len(open(index_path).readlines()) == 2
+
+
+def test_parallel_extraction_with_timeout(corpus):
+    extractor = FakeExtractor(n_jobs=2, timeout=2)
+    names = ["doc1.pdf", "fail.pdf", "hang.pdf", "doc2.docx", "text.txt"]
+    start = time.monotonic()
+    outputs = extractor.extract_from_files([str(corpus / name) for name in names])
+    assert time.monotonic() - start < 10
+    assert outputs[1:3] == [None, None]
+    assert outputs[4] == str(corpus / "text.txt")
+    assert open(outputs[3]).read() == "Text of doc2.docx"
+    # The subprocess spawned by the hanging extraction was killed
+    assert subprocess.run(["pgrep", "-f", "^sleep 60$"]).returncode != 0
+
+
+def test_parallel_extraction_is_faster(tmp_path):
+    paths = []
+    for i in range(4):
+        (tmp_path / f"slow{i}.pdf").write_text(f"Document {i}")
+        paths.append(str(tmp_path / f"slow{i}.pdf"))
+    start = time.monotonic()
+    outputs = FakeExtractor(n_jobs=4).extract_from_files(paths)
+    assert time.monotonic() - start < 3
+    assert [open(path).read() for path in outputs] == [
+        f"Document {i}" for i in range(4)
+    ]
+
+
+def test_extraction_workers(tmp_path):
+    paths = []
+    for i in range(6):
+        (tmp_path / f"pid{i}.pdf").write_text(f"Document {i}")
+        paths.append(str(tmp_path / f"pid{i}.pdf"))
+    extractor = FakeExtractor(n_jobs=2)
+    # The workers do not receive the state of the extractor (e.g. a loaded model)
+    extractor.model = threading.Lock()
+    outputs = extractor.extract_from_files(paths)
+    pids = {open(path).read() for path in outputs}
+    # The documents are extracted by a pool of 2 workers
+    assert len(pids) <= 2 and str(os.getpid()) not in pids
+
+
+def test_cache_is_checked_on_dispatch(corpus):
+    extractor = FakeExtractor(n_jobs=2)
+    paths = [str(corpus / name) for name in ["doc1.pdf", "doc2.docx", "text.txt"]]
+    output_paths = extractor.extract_from_files(paths)
+    calls = []
+    get_output_path = extractor.get_output_path
+    extractor.get_output_path = lambda path: calls.append(path) or get_output_path(path)
+    extraction = extractor.iter_extract_in_processes(paths)
+    # The first cached document is returned before the others are hashed
+    assert next(extraction) == (0, output_paths[0])
+    assert calls == paths[:1]
+    assert list(extraction) == [(1, output_paths[1]), (2, paths[2])]
+    assert calls == paths[:2]
+
+
+def test_iter_extract(tmp_path):
+    paths = []
+    for name in ["slow.pdf", "fast1.pdf", "fast2.pdf"]:
+        (tmp_path / name).write_text(name)
+        paths.append(str(tmp_path / name))
+    extractor = FakeExtractor(n_jobs=3)
+    results = list(extractor.iter_extract(paths))
+    assert sorted(results) == sorted(zip(paths, extractor.extract_from_files(paths)))
+    # The slow document does not hold back the others
+    assert results[-1][0] == paths[0]
+
+
+def test_iter_extract_stops_early(tmp_path):
+    paths = []
+    for i in range(8):
+        (tmp_path / f"slow{i}.pdf").write_text(f"Document {i}")
+        paths.append(str(tmp_path / f"slow{i}.pdf"))
+    start = time.monotonic()
+    for path, output_path in FakeExtractor(n_jobs=2).iter_extract(paths):
+        break
+    assert time.monotonic() - start < 3
+
+
+def test_iter_extract_stops_hanging_extraction(corpus):
+    paths = [str(corpus / "doc1.pdf"), str(corpus / "hang.pdf")]
+    start = time.monotonic()
+    for path, output_path in FakeExtractor(n_jobs=2).iter_extract(paths):
+        assert path == paths[0]
+        break
+    assert time.monotonic() - start < 10
+    # The subprocess spawned by the hanging extraction was killed
+    assert subprocess.run(["pgrep", "-f", "^sleep 60$"]).returncode != 0
+
+
+def test_iter_corpus(corpus, make_nerd):
+    taxonerd = make_nerd(["Text"])
+    taxonerd.extractor = FakeExtractor(n_jobs=2, timeout=2)
+    (corpus / "doc1.txt").write_text("Text file of the user")
+    (corpus / "doc2.pdf").write_text("Text of doc2.pdf")
+    results = dict(taxonerd.iter_corpus(str(corpus)))
+    # Text files sharing a name with another document are annotated too
+    assert sorted(results) == [
+        "doc1.pdf.txt",
+        "doc1.txt.txt",
+        "doc2.docx.txt",
+        "doc2.pdf.txt",
+        "text.txt",
+    ]
+    assert all(df["text"].tolist() == ["Text"] for df in results.values())
+    assert (corpus / "doc1.txt").read_text() == "Text file of the user"
+
+
+def reference_clean_text(text):
+    """The original, multi-pass implementation of clean_text"""
+    text = text.encode("ascii", "ignore").decode()
+    text = re.sub("\t+", " ", text)
+    text = re.sub("-\n", "", text)
+    text = re.sub("(?<!\n)\n(?!\n)", " ", text)
+    text = re.sub(" +", " ", text)
+    text = text.strip(" \n")
+    text = re.sub(r"^([^\w\s\(\)]\s*)*", "", text)
+    return text
+
+
+def test_clean_text(monkeypatch):
+    for filename in ["test1.txt", "test2.txt"]:
+        text = open(os.path.join("tests/test_data/test_txt", filename)).read()
+        assert clean_text(text) == reference_clean_text(text)
+        monkeypatch.setattr(extractor_module, "CLEAN_CHUNK_SIZE", 10)
+        assert clean_text(text) == reference_clean_text(text)
+        monkeypatch.undo()
+    rng = random.Random(0)
+    alphabet = ["a", "Z", "_", "-", "-", " ", "  ", "\t", "\n", "\n", "\r", "\x1c"]
+    alphabet += [".", "(", ")", "*", "é", "\u00a0", "\u2014", "7"]
+    for _ in range(5000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        assert clean_text(text) == reference_clean_text(text), repr(text)
+
+
+def test_iter_clean_text():
+    rng = random.Random(0)
+    alphabet = ["a", "-", "-", " ", "\n", "\n", "\n", "\x1c", ".", "(", "*", "é"]
+    for _ in range(5000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        cuts = sorted(rng.randint(0, len(text)) for _ in range(rng.randint(0, 5)))
+        chunks = [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+        cleaned = "".join(iter_clean_text(chunks))
+        assert cleaned == reference_clean_text(text), repr(chunks)
+    # The paragraphs are yielded once complete
+    parts = iter_clean_text(iter(["* First para-", "\ngraph\n", "\nSecond"]))
+    assert next(parts) == "First paragraph"
+    assert list(parts) == ["\n\nSecond"]
+
+
+def test_clean_txt(tmp_path):
+    (tmp_path / "raw.txt").write_text("- Brown  bears\n(Ursus arc-\ntos)\n\nEnd")
+    path = str(tmp_path / "raw.txt")
+    assert TextExtractor().extract_from_file(path) == path
+    output_path = TextExtractor(clean_txt=True).extract_from_file(path)
+    assert open(output_path).read() == "Brown bears (Ursus arctos)\n\nEnd"
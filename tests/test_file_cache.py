@@ -0,0 +1,217 @@
+import pytest
+import os
+import re
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from hashlib import sha256
+from taxonerd.linking import file_cache
+from taxonerd.linking.file_cache import (
+    CACHE_INDEX,
+    cached_path,
+    find_in_cache,
+    prefetch,
+    read_cache_index,
+    update_cache_index,
+    url_to_filename,
+)
+
+
+class FileServer(ThreadingHTTPServer):
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), FileHandler)
+        self.files = files
+        self.requests = []
+        # Paths whose next full download stalls after the first 1000 bytes
+        self.stalled = set()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+
+def etag(content):
+    return '"{}"'.format(sha256(content).hexdigest())
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    def send_file_headers(self):
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return None
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(content) - 1)
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(content))
+            )
+            content = content[start : end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag(self.server.files[self.path]))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        return content
+
+    def do_HEAD(self):
+        self.server.requests.append(("HEAD", self.path, self.headers.get("Range")))
+        self.send_file_headers()
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, self.headers.get("Range")))
+        content = self.send_file_headers()
+        if content is not None and self.path in self.server.stalled:
+            self.server.stalled.remove(self.path)
+            self.wfile.write(content[:1000])
+            self.wfile.flush()
+            time.sleep(2)
+        elif content is not None:
+            self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    content = b"".join(
+        json.dumps({"concept_id": i}).encode() + b"\n" for i in range(1000)
+    )
+    server = FileServer({"/kb.jsonl": b'{"concept_id": 0}\n', "/large.jsonl": content})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_cached_file_is_resolved_offline(server, tmp_path):
+    url = server.url + "/kb.jsonl"
+    path = cached_path((url, "kb"), cache_dir=str(tmp_path))
+    assert open(path, "rb").read() == server.files["/kb.jsonl"]
+    assert ("GET", "/kb.jsonl", None) in server.requests
+    checksum = sha256(server.files["/kb.jsonl"]).hexdigest()
+    assert json.load(open(path + ".json"))["sha256"] == checksum
+
+    server.requests.clear()
+    assert cached_path((url, "kb"), cache_dir=str(tmp_path)) == path
+    assert server.requests == []
+
+    # Revalidation falls back to the cached file when the network is not available
+    server.shutdown()
+    server.server_close()
+    assert cached_path((url, "kb"), str(tmp_path), revalidate=True) == path
+
+
+def test_legacy_cache_entries(server, tmp_path):
+    url = server.url + "/kb.jsonl"
+    path = cached_path((url, "kb"), cache_dir=str(tmp_path))
+    os.remove(tmp_path / CACHE_INDEX)
+    server.requests.clear()
+    assert find_in_cache(url, "kb", str(tmp_path)) == path
+    assert cached_path((url, "kb"), cache_dir=str(tmp_path)) == path
+    assert server.requests == []
+    assert os.path.exists(tmp_path / CACHE_INDEX)
+
+
+def test_revalidate(server, tmp_path):
+    url = server.url + "/kb.jsonl"
+    (path,) = prefetch([(url, "kb")], cache_dir=str(tmp_path))
+    server.files["/kb.jsonl"] = b'{"concept_id": 1}\n'
+    assert cached_path((url, "kb"), cache_dir=str(tmp_path)) == path
+    (new_path,) = prefetch([(url, "kb")], cache_dir=str(tmp_path), revalidate=True)
+    assert new_path != path
+    assert open(new_path, "rb").read() == server.files["/kb.jsonl"]
+    assert cached_path((url, "kb"), cache_dir=str(tmp_path)) == new_path
+
+
+def test_offline(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(file_cache, "OFFLINE", True)
+    with pytest.raises(FileNotFoundError):
+        cached_path((server.url + "/kb.jsonl", "kb"), cache_dir=str(tmp_path))
+    assert server.requests == []
+
+
+def test_resume_download(server, tmp_path):
+    url = server.url + "/large.jsonl"
+    content = server.files["/large.jsonl"]
+    cache_path = tmp_path / url_to_filename(url + "/large", etag(content))
+    with open(str(cache_path) + ".part", "wb") as part_file:
+        part_file.write(content[:1000])
+    path = cached_path((url, "large"), cache_dir=str(tmp_path))
+    assert path == str(cache_path)
+    assert ("GET", "/large.jsonl", "bytes=1000-") in server.requests
+    assert open(path, "rb").read() == content
+    assert not os.path.exists(path + ".part")
+
+
+def test_download_timeout(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(file_cache, "DOWNLOAD_TIMEOUT", 0.5)
+    monkeypatch.setattr(file_cache, "CHUNK_SIZE", 100)
+    url = server.url + "/large.jsonl"
+    server.stalled.add("/large.jsonl")
+    path = cached_path(url, cache_dir=str(tmp_path))
+    assert open(path, "rb").read() == server.files["/large.jsonl"]
+    # The stalled download is resumed
+    assert [r for r in server.requests if r[0] == "GET"] == [
+        ("GET", "/large.jsonl", None),
+        ("GET", "/large.jsonl", "bytes=1000-"),
+    ]
+
+
+def test_concurrent_index_updates(tmp_path):
+    threads = [
+        threading.Thread(
+            target=update_cache_index,
+            args=("http://example.com/{}".format(i), None, str(i), None, str(tmp_path)),
+        )
+        for i in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(read_cache_index(str(tmp_path))) == 20
+
+
+def test_checksum(server, tmp_path):
+    url = server.url + "/kb.jsonl"
+    with pytest.raises(IOError):
+        cached_path((url, "kb", "0" * 64), cache_dir=str(tmp_path))
+    assert find_in_cache(url, "kb", str(tmp_path)) is None
+    checksum = sha256(server.files["/kb.jsonl"]).hexdigest()
+    path = cached_path((url, "kb", checksum), cache_dir=str(tmp_path))
+    assert open(path, "rb").read() == server.files["/kb.jsonl"]
+
+
+def test_concurrent_downloads(server, tmp_path):
+    url = server.url + "/large.jsonl"
+    paths = []
+    threads = [
+        threading.Thread(
+            target=lambda: paths.append(cached_path(url, cache_dir=str(tmp_path)))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(paths)) == 1 and len(paths) == 4
+    assert [r for r in server.requests if r[0] == "GET"] == [
+        ("GET", "/large.jsonl", None)
+    ]
+
+
+def test_parallel_download(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(file_cache, "PARALLEL_DOWNLOAD_MIN_SIZE", 1024)
+    url = server.url + "/large.jsonl"
+    path = cached_path(url, cache_dir=str(tmp_path), workers=4)
+    assert open(path, "rb").read() == server.files["/large.jsonl"]
+    ranges = [r[2] for r in server.requests if r[0] == "GET"]
+    assert len(ranges) == 4 and all(ranges)
@@ -0,0 +1,91 @@
+import pytest
+import json
+import os
+import spacy
+from spacy.tokens import Span
+
+pytest.importorskip("ahocorasick")
+
+from taxonerd.linking.gazetteer import (
+    Gazetteer,
+    build_automaton,
+    find_aliases,
+    load_automaton,
+)
+
+
+def write_kb(concepts, kb_path):
+    with open(kb_path, "w") as f:
+        for i, (name, aliases) in enumerate(concepts):
+            concept = {"concept_id": i, "canonical_name": name, "aliases": aliases}
+            f.write(json.dumps(concept) + "\n")
+
+
+@pytest.fixture(scope="module")
+def kb_dir(tmp_path_factory):
+    kb_dir = tmp_path_factory.mktemp("kb", numbered=False)
+    write_kb(
+        [
+            ("Ursus arctos", ["Ursus arctos", "brown bear"]),
+            ("Ursus", ["Ursus"]),
+            ("Vulpes vulpes", ["Vulpes vulpes", "red fox"]),
+            ("Ursus americanus", ["Ursus americanus"]),
+        ],
+        kb_dir / "test_kb.jsonl",
+    )
+    return str(kb_dir)
+
+
+@pytest.fixture
+def nlp():
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns([{"label": "LIVB", "pattern": "bears"}])
+    return nlp
+
+
+def test_find_aliases():
+    automaton = build_automaton(
+        [("Ursus", ["U:1"]), ("Ursus arctos", ["U:0"]), ("fox", ["V:0"])]
+    )
+    doc = spacy.blank("en")("Ursus arctos, Ursusarctos and a foxtrot.")
+    matches = find_aliases(doc, automaton)
+    # The longest match only, and no match inside words
+    assert [(span.text, alias, cuis) for span, alias, cuis in matches] == [
+        ("Ursus arctos", "Ursus arctos", ("U:0",))
+    ]
+    automaton = build_automaton([("Red fox", ["V:0"]), ("red fox", ["V:1"])], True)
+    doc = spacy.blank("en")("A RED FOX.")
+    ((span, _, cuis),) = find_aliases(doc, automaton, lowercase=True)
+    assert span.text == "RED FOX"
+    assert cuis == ("V:0", "V:1")
+
+
+def test_load_automaton(kb_dir):
+    automaton = load_automaton(kb_dir)
+    assert os.path.exists(os.path.join(kb_dir, "test_kb.automaton"))
+    assert load_automaton(kb_dir) is automaton
+    assert automaton.get("brown bear") == (10, "brown bear", ("KB:0",))
+    with pytest.raises(ValueError):
+        load_automaton(os.path.join(kb_dir, "missing"))
+
+
+def test_gazetteer(nlp, kb_dir):
+    text = "Brown bears, Ursus arctos, and red foxes (Vulpes vulpes) were seen."
+    nlp.add_pipe("taxo_gazetteer", config={"linker_name": kb_dir})
+    doc = nlp(text)
+    assert [ent.text for ent in doc.ents] == ["bears", "Ursus arctos", "Vulpes vulpes"]
+    assert doc.ents[0]._.kb_ents == []
+    assert doc.ents[1]._.kb_ents == [("KB:0", "Ursus arctos", 1.0)]
+    assert doc.ents[2]._.kb_ents == [("KB:2", "Vulpes vulpes", 1.0)]
+
+    nlp.remove_pipe("taxo_gazetteer")
+    nlp.add_pipe(
+        "taxo_gazetteer",
+        config={"linker_name": kb_dir, "mode": "standalone", "lowercase": True},
+    )
+    doc = nlp(text)
+    assert [ent.text for ent in doc.ents] == ["Ursus arctos", "Vulpes vulpes"]
+
+    with pytest.raises(ValueError):
+        Gazetteer(nlp, linker_name=kb_dir, mode="intersection")
@@ -0,0 +1,307 @@
+import pytest
+import json
+import random
+import scipy
+import numpy
+import spacy
+from spacy.tokens import Span
+from taxonerd.linking.linking_utils import KnowledgeBase
+from taxonerd.linking.candidate_generation import (
+    CandidateGenerator,
+    LinkerPathsFactory,
+    create_tfidf_ann_index,
+    load_approximate_nearest_neighbours_index,
+    quantize_tfidf_vectors,
+)
+from taxonerd.linking.mmap_utils import load_sparse_matrix, load_string_array
+from taxonerd.linking.linking import EntityLinker, prefetch_candidate_generator
+
+SYLLABLES = ["ar", "bo", "ca", "de", "fi", "lu", "mo", "ne", "ra", "si", "to", "us"]
+
+
+def random_name(rng):
+    genus = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    species = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    return "{} {}".format(genus.capitalize(), species)
+
+
+@pytest.fixture(scope="module")
+def aliases():
+    rng = random.Random(0)
+    return sorted(set(random_name(rng) for _ in range(1500)))
+
+
+def write_kb(aliases, kb_path):
+    with open(kb_path, "w") as f:
+        for i, alias in enumerate(aliases):
+            concept = {"concept_id": i, "canonical_name": alias, "aliases": [alias]}
+            f.write(json.dumps(concept) + "\n")
+
+
+@pytest.fixture(scope="module")
+def kb(aliases, tmp_path_factory):
+    kb_path = tmp_path_factory.mktemp("kb") / "test_kb.jsonl"
+    write_kb(aliases, kb_path)
+    return KnowledgeBase(file_path=str(kb_path), prefix="TEST")
+
+
+@pytest.fixture(scope="module")
+def linker_dir(aliases, kb, tmp_path_factory):
+    out_path = tmp_path_factory.mktemp("test")
+    write_kb(aliases, out_path / "test_kb.jsonl")
+    create_tfidf_ann_index(str(out_path), kb)
+    return str(out_path)
+
+
+@pytest.fixture(scope="module")
+def mentions(aliases):
+    rng = random.Random(1)
+    # Misspelled aliases, so that the nearest neighbours are not exact matches
+    mentions = []
+    for alias in rng.sample(aliases, 200):
+        i = rng.randrange(len(alias))
+        mentions.append(alias[:i] + rng.choice("aeiou") + alias[i + 1 :])
+    return mentions
+
+
+def build_linker(kb, tmp_path_factory, dtype):
+    out_path = tmp_path_factory.mktemp(dtype)
+    _, vectorizer, _ = create_tfidf_ann_index(str(out_path), kb, vectors_dtype=dtype)
+    linker_paths = LinkerPathsFactory().get_linker_paths(str(out_path))
+    return vectorizer, load_approximate_nearest_neighbours_index(linker_paths)
+
+
+def test_quantize_tfidf_vectors():
+    vectors = scipy.sparse.csr_matrix(
+        numpy.array([[0.1, 0.0, 0.7], [0.0, 0.5, 0.5]], dtype=numpy.float32)
+    )
+    assert quantize_tfidf_vectors(vectors, "float16").dtype == numpy.float16
+    quantized = quantize_tfidf_vectors(vectors, "uint8")
+    assert quantized.dtype == numpy.uint8
+    assert quantized.toarray().max(axis=1).tolist() == [255, 255]
+    with pytest.raises(ValueError):
+        quantize_tfidf_vectors(vectors, "int4")
+
+
+@pytest.mark.parametrize("dtype", ["float16", "uint8"])
+def test_quantized_vectors_recall(kb, mentions, tmp_path_factory, dtype):
+    vectorizer, reference_index = build_linker(kb, tmp_path_factory, "float32")
+    _, quantized_index = build_linker(kb, tmp_path_factory, dtype)
+    queries = vectorizer.transform(mentions)
+    reference = reference_index.knnQueryBatch(queries, k=5)
+    quantized = quantized_index.knnQueryBatch(queries, k=5)
+    top1 = numpy.mean([r[0][0] == q[0][0] for r, q in zip(reference, quantized)])
+    top5 = numpy.mean(
+        [len(set(r[0]) & set(q[0])) / len(r[0]) for r, q in zip(reference, quantized)]
+    )
+    assert top1 >= 0.95
+    assert top5 >= 0.9
+
+
+def test_string_array(tmp_path):
+    strings = ["Ursus arctos", "", "Cervus nippon", "Salmo salar été"]
+    json_path = tmp_path / "aliases.json"
+    json.dump(strings, open(json_path, "w"))
+    array = load_string_array(str(json_path))
+    assert len(array) == len(strings)
+    assert list(array) == strings
+    assert array[numpy.int32(2)] == strings[2]
+    assert array[-1] == strings[-1]
+    with pytest.raises(IndexError):
+        array[len(strings)]
+
+
+def test_load_sparse_matrix(tmp_path):
+    matrix = scipy.sparse.random(50, 20, density=0.1, format="csr", random_state=0)
+    npz_path = str(tmp_path / "vectors.npz")
+    scipy.sparse.save_npz(npz_path, matrix)
+    for _ in range(2):  # Create, then reuse the memory-mappable files
+        mapped = load_sparse_matrix(npz_path)
+        assert not mapped.data.flags.writeable
+        assert (mapped != matrix).nnz == 0
+
+
+def test_mmap_kb(aliases, tmp_path):
+    kb_path = tmp_path / "test_kb.jsonl"
+    write_kb(aliases, kb_path)
+    kb = KnowledgeBase(file_path=str(kb_path), prefix="TEST")
+    mmap_kb = KnowledgeBase(file_path=str(kb_path), prefix="TEST", mmap=True)
+    assert len(mmap_kb.cui_to_entity) == len(kb.cui_to_entity)
+    assert mmap_kb.cui_to_entity[3] == kb.cui_to_entity[3]
+    assert mmap_kb.alias_to_cuis[aliases[3]] == kb.alias_to_cuis[aliases[3]]
+    assert 3 in mmap_kb.cui_to_entity and -1 not in mmap_kb.cui_to_entity
+    assert mmap_kb.get_cuis_from_aliases(aliases[:10]) == kb.get_cuis_from_aliases(
+        aliases[:10]
+    )
+
+
+def test_mmap_candidate_generator(linker_dir, mentions):
+    candidate_generator = CandidateGenerator(name_or_path=linker_dir)
+    mmap_candidate_generator = CandidateGenerator(name_or_path=linker_dir, mmap=True)
+    # Neighbours with equal distances may be returned in any order
+    for candidates, mmap_candidates in zip(
+        candidate_generator(mentions, 5), mmap_candidate_generator(mentions, 5)
+    ):
+        assert sorted(candidates) == sorted(mmap_candidates)
+
+
+def test_prefetched_candidate_generator(linker_dir):
+    future = prefetch_candidate_generator(linker_dir)
+    assert prefetch_candidate_generator(linker_dir) is future
+    linker = EntityLinker(linker_name=linker_dir, resolve_abbreviations=False)
+    assert linker.candidate_generator is future.result()
+    # The prefetched candidate generator is only used once
+    assert prefetch_candidate_generator(linker_dir) is not future
+
+
+def test_prefetched_candidate_generator_load_error(linker_dir):
+    from taxonerd import TaxoNERD
+    from taxonerd.linking import linking
+
+    linking.discard_prefetched_candidate_generator(linker_dir)
+    with pytest.raises(OSError):
+        TaxoNERD().load("no_such_model", linker=linker_dir)
+    # The linker data prefetched for the failed load is released
+    assert (linker_dir, False) not in linking._prefetched
+
+
+def test_linker_in_background(linker_dir, aliases):
+    linker = EntityLinker(
+        linker_name=linker_dir,
+        resolve_abbreviations=False,
+        filter_for_definitions=False,
+        background=True,
+    )
+    doc = spacy.blank("en")("We observed {} in the field.".format(aliases[0]))
+    for token in doc:
+        token.lemma_ = token.text.lower()
+    doc.set_ents([Span(doc, 2, 4, "LIVB")])
+    doc = linker(doc)  # Blocks until the linker is loaded
+    assert linker.ready
+    assert doc.ents[0]._.kb_ents[0][0] == "TEST0:0"
+
+
+def test_link_keys(linker_dir, aliases):
+    from spacy.lookups import Lookups
+
+    genus, species = aliases[0].split(" ")
+    text = "We observed {}i {} in the field.".format(genus, species)
+    lookups = Lookups()
+    lookups.add_table("lemma_lookup", {genus + "i": genus})
+    nlp = spacy.blank("en")
+    lemmatizer = nlp.add_pipe("lemmatizer", config={"mode": "lookup"})
+    lemmatizer.initialize(lookups=lookups)
+    nlp.add_pipe("lower_case_lemmas")
+
+    def link(link_key, disable=[]):
+        linker = EntityLinker(
+            nlp,
+            linker_name=linker_dir,
+            resolve_abbreviations=False,
+            filter_for_definitions=False,
+            link_key=link_key,
+        )
+        with nlp.select_pipes(disable=disable):
+            doc = nlp(text)
+        doc.set_ents([Span(doc, 2, 4, "LIVB")])
+        return linker.mention_string(doc.ents[0]), linker(doc)
+
+    mention, doc = link("lemma")
+    assert mention == aliases[0].lower()
+    assert doc.ents[0]._.kb_ents[0][0] == "TEST0:0"
+    # Only the entity tokens are lemmatized, with the same result
+    lemmatized = []
+    lemmatize = lemmatizer.lemmatize
+    lemmatizer.lemmatize = lambda token: lemmatized.append(token.text) or lemmatize(
+        token
+    )
+    entity_mention, doc = link("entity_lemma", ["lemmatizer", "lower_case_lemmas"])
+    assert entity_mention == mention
+    assert lemmatized == [genus + "i", species]
+    assert doc.ents[0]._.kb_ents[0][0] == "TEST0:0"
+    assert link("text", ["lemmatizer"])[0] == "{}i {}".format(genus, species).lower()
+    with pytest.raises(ValueError):
+        EntityLinker(nlp, linker_name=linker_dir, link_key="stem")
+
+
+def test_linker_skips_linked_entities(linker_dir, aliases):
+    # Entities already linked, e.g. by the gazetteer, are not linked again
+    nlp = spacy.blank("en")
+    linker = EntityLinker(
+        nlp,
+        linker_name=linker_dir,
+        resolve_abbreviations=False,
+        filter_for_definitions=False,
+        link_key="text",
+    )
+    doc = nlp("{} and {}".format(aliases[0], aliases[1]))
+    doc.set_ents([Span(doc, 0, 2, "LIVB"), Span(doc, 3, 5, "LIVB")])
+    doc.ents[1]._.kb_ents = [("TEST0:1", aliases[1], 1.0)]
+    doc = linker(doc)
+    assert doc.ents[0]._.kb_ents[0][0] == "TEST0:0"
+    assert doc.ents[1]._.kb_ents == [("TEST0:1", aliases[1], 1.0)]
+
+
+def test_standalone_gazetteer_with_linker(linker_dir, aliases, tmp_path):
+    from taxonerd import TaxoNERD
+
+    pytest.importorskip("ahocorasick")
+    spacy.blank("en").to_disk(tmp_path / "model")
+    nerd = TaxoNERD()
+    # The lemmas looked up by default are not available without the lemmatizer
+    nerd.load(
+        str(tmp_path / "model"),
+        exclude=["taxo_abbrev_detector"],
+        linker=linker_dir,
+        gazetteer=linker_dir,
+        gazetteer_mode="standalone",
+    )
+    assert "lower_case_lemmas" not in nerd.nlp.pipe_names
+    doc = nerd.ner("We observed {}.".format(aliases[0]))
+    assert [ent.text for ent in doc.ents] == [aliases[0]]
+    assert doc.ents[0]._.kb_ents == [("TEST0:0", aliases[0], 1.0)]
+
+
+def test_kb_connections_per_thread(linker_dir):
+    import sqlite3
+    from concurrent.futures import ThreadPoolExecutor
+    from taxonerd.linking.linking_utils import KnowledgeBaseFactory
+
+    kb = KnowledgeBaseFactory().get_kb(linker_dir, mmap=True)
+    aliases = list(kb.alias_to_cuis)[:50]
+    expected = kb.get_cuis_from_aliases(aliases)
+    main_conn = kb.conn
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        conns = list(executor.map(lambda _: kb.conn, range(4)))
+        results = list(
+            executor.map(lambda alias: kb.get_cuis_from_aliases([alias]), aliases)
+        )
+    assert all(conn is not main_conn for conn in conns)
+    assert results == [{alias: expected[alias]} for alias in aliases]
+    with pytest.raises(sqlite3.OperationalError):
+        kb.conn.execute("DELETE FROM alias_to_cuis;")
+
+
+def test_find_in_text_threads(linker_dir, aliases, make_nerd):
+    from concurrent.futures import ThreadPoolExecutor
+
+    nerd = make_nerd(aliases)
+    nerd.nlp.add_pipe(
+        "taxo_linker",
+        config={
+            "linker_name": linker_dir,
+            "resolve_abbreviations": False,
+            "filter_for_definitions": False,
+            "link_key": "text",
+        },
+    )
+    nerd.linker = True
+    texts = [
+        "We observed {} and {}.".format(aliases[i], aliases[i + 1])
+        for i in range(0, 200, 2)
+    ]
+    expected = [nerd.find_in_text(text).to_dict() for text in texts]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(nerd.find_in_text, texts))
+    assert [df.to_dict() for df in results] == expected
+    assert all(len(df) == 2 for df in results)
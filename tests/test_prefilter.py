@@ -0,0 +1,114 @@
+import pytest
+import json
+import random
+import spacy
+from spacy.tokens import Doc, Span
+from taxonerd.prefilter import (
+    ParagraphFilter,
+    genera_from_aliases,
+    load_genera,
+    merge_docs,
+)
+
+TEXT = (
+    "Samples were dried at 60 degrees.\n"
+    "We observed Ursus arctos near the river.\n"
+    "The bears fed on salmon.\n"
+    "\n"
+    "Statistics were computed with R.\n"
+    "Brown bears were seldom seen.\n"
+    "References\n"
+    "Smith J. (2001) Diet of U. arctos.\n"
+)
+
+
+@pytest.fixture
+def nerd(make_nerd):
+    return make_nerd(["bears", "Ursus arctos", "U. arctos"])
+
+
+def test_is_candidate():
+    paragraph_filter = ParagraphFilter()
+    assert paragraph_filter.is_candidate("We observed Ursus arctos.")
+    assert paragraph_filter.is_candidate("Daphnia (Ctenodaphnia) magna was reared.")
+    assert paragraph_filter.is_candidate("Carex spp. dominate the plots.")
+    assert paragraph_filter.is_candidate("Diet of U. arctos.")
+    assert not paragraph_filter.is_candidate("The bears fed on salmon.")
+    assert not paragraph_filter.is_candidate("These data were analysed.")
+    assert not paragraph_filter.is_candidate("Human intervention in ecosystems.")
+    assert not paragraph_filter.is_candidate("Statistics were computed with R.")
+    assert ParagraphFilter({"Ursus"}).is_candidate("Ursus is a genus.")
+
+
+def test_split():
+    runs = ParagraphFilter(context=0).split(TEXT)
+    assert "".join(TEXT[start:end] for start, end, _ in runs) == TEXT
+    assert [TEXT[start:end] for start, end, candidate in runs if candidate] == [
+        "We observed Ursus arctos near the river.\n",
+        "Smith J. (2001) Diet of U. arctos.\n",
+    ]
+    runs = ParagraphFilter(context=1).split(TEXT)
+    assert "".join(TEXT[start:end] for start, end, _ in runs) == TEXT
+    assert [candidate for _, _, candidate in runs] == [True, False, True]
+    assert ParagraphFilter().split("") == [(0, 0, False)]
+
+
+def test_merge_docs():
+    if not Span.has_extension("long_form"):
+        Span.set_extension("long_form", default=None)
+    if not Doc.has_extension("abbreviations"):
+        Doc.set_extension("abbreviations", default=[])
+    nlp = spacy.blank("en")
+    first = nlp("Ursus arctos (U. arctos)\n")
+    first.set_ents([Span(first, 0, 2, "LIVB"), Span(first, 3, 5, "LIVB")])
+    first.ents[1]._.long_form = first.ents[0]
+    first._.abbreviations = [first[3:5]]
+    second = nlp.make_doc("Nothing here.\n")
+    third = nlp("U. arctos")
+    third._.abbreviations = [third[0:2]]
+    doc = merge_docs([first, second, third])
+    assert doc.text == first.text + second.text + third.text
+    assert [ent.text for ent in doc.ents] == ["Ursus arctos", "U. arctos"]
+    long_form = doc.ents[1]._.long_form
+    assert long_form.doc is doc and long_form.text == "Ursus arctos"
+    assert [(span.start_char, span.text) for span in doc._.abbreviations] == [
+        (14, "U. arctos"),
+        (len(first.text + second.text), "U. arctos"),
+    ]
+
+
+def test_prefilter(nerd):
+    full = [(ent.start_char, ent.text) for ent in nerd.ner(TEXT).ents]
+    nerd.prefilter = ParagraphFilter()
+    doc = nerd.ner(TEXT)
+    assert doc.text == TEXT
+    found = [(ent.start_char, ent.text) for ent in doc.ents]
+    # "Brown bears" has no taxon-like name nearby
+    assert found == [
+        (start, text) for start, text in full if start != TEXT.index("bears were")
+    ]
+
+    rng = random.Random(0)
+    lines = TEXT.splitlines(keepends=True)
+    texts = ["".join(rng.sample(lines, rng.randint(0, len(lines)))) for _ in range(50)]
+    docs = list(nerd.pipe(zip(texts, range(50)), batch_size=4, as_tuples=True))
+    assert [context for _, context in docs] == list(range(50))
+    assert [doc.text for doc, _ in docs] == texts
+    for doc, i in docs:
+        expected = [(ent.start_char, ent.text) for ent in nerd.ner(texts[i]).ents]
+        assert [(ent.start_char, ent.text) for ent in doc.ents] == expected
+    docs = nerd.pipe(texts, batch_size=4, max_tokens=20)
+    assert [doc.text for doc in docs] == texts
+
+
+def test_load_genera(tmp_path):
+    assert genera_from_aliases(
+        ["Ursus arctos", "Ursus", "brown bear", "Vulpes vulpes", "Red fox"]
+    ) == {"Ursus", "Vulpes"}
+    with open(tmp_path / "test_kb.jsonl", "w") as f:
+        for i, alias in enumerate(["Ursus arctos", "Vulpes vulpes", "red fox"]):
+            concept = {"concept_id": i, "canonical_name": alias, "aliases": [alias]}
+            f.write(json.dumps(concept) + "\n")
+    assert load_genera(str(tmp_path)) == {"Ursus", "Vulpes"}
+    assert (tmp_path / "test_kb.genera").exists()
+    assert load_genera(str(tmp_path)) == {"Ursus", "Vulpes"}
@@ -0,0 +1,81 @@
+import pytest
+import re
+import spacy
+from spacy.tokens import Span
+from taxonerd.segmentation import (
+    paragraph_bounds,
+    set_sentence_ids,
+    set_sentence_ids_lazily,
+)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def sent_id():
+    if not Span.has_extension("sent_id"):
+        Span.set_extension("sent_id", default=None)
+
+
+def texts():
+    text = "\n\n".join(
+        open("tests/test_data/test_txt/{}".format(name)).read()
+        for name in ["test1.txt", "test2.txt"]
+    )
+    return [text, "Ursus arctos. Brown bears eat salmon", ""]
+
+
+def annotate(nlp, text):
+    """Tag the capitalized pairs of words as entities"""
+    doc = nlp(text)
+    ents = [
+        doc.char_span(*match.span(), "LIVB")
+        for match in re.finditer(r"[A-Z][a-z]+ [a-z]+", text)
+    ]
+    doc.set_ents([span for span in ents if span is not None])
+    return doc
+
+
+def test_set_sentence_ids():
+    from scispacy.custom_sentence_segmenter import pysbd_sentencizer
+
+    for component in ["pysbd_sentencizer", "sentencizer"]:
+        nlp = spacy.blank("en")
+        nlp.add_pipe(component)
+        for text in texts():
+            doc = annotate(nlp, text)
+            ents = list(doc.ents)
+            set_sentence_ids(doc, ents)
+            sentences = {sent: i for i, sent in enumerate(doc.sents)}
+            assert [ent._.sent_id for ent in ents] == [
+                sentences[ent.sent] for ent in ents
+            ]
+
+
+def test_set_sentence_ids_lazily():
+    from scispacy.custom_sentence_segmenter import pysbd_sentencizer
+
+    nlp = spacy.blank("en")
+    nlp.add_pipe("pysbd_sentencizer")
+    for text in texts():
+        doc = annotate(nlp, text)
+        ents = list(doc.ents)
+        set_sentence_ids(doc, ents)
+        expected = [ent._.sent_id for ent in ents]
+        set_sentence_ids_lazily(doc, ents)
+        lazy = [ent._.sent_id for ent in ents]
+        # The entities of a sentence share an id, and ids increase along the document
+        assert lazy == sorted(lazy)
+        assert [a == b for a, b in zip(lazy, lazy[1:])] == [
+            a == b for a, b in zip(expected, expected[1:])
+        ]
+
+
+def test_paragraph_bounds():
+    assert paragraph_bounds("One.\n\nTwo.\n \n\nThree.") == [0, 6, 14]
+
+
+def test_lazy_segmenter(nerd):
+    nerd.senten = "lazy"
+    doc = nerd.ner("No entity here.\n\nBrown bears. Black bears.\n\nOther bears")
+    assert [ent._.sent_id for ent in doc.ents] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        nerd.load("en_core_web_sm", segmenter="fast")
@@ -0,0 +1,24 @@
+import pytest
+
+
+def test_find_in_texts(nerd):
+    texts = ["bears and bears", "no entity", "bears"]
+    df = nerd.find_in_texts(texts, ids=["a", "b", "c"], batch_size=2)
+    assert list(df.columns) == ["doc_id", "id", "offsets", "text"]
+    assert df[["doc_id", "id", "offsets"]].values.tolist() == [
+        ["a", "T0", "LIVB 0 5"],
+        ["a", "T1", "LIVB 10 15"],
+        ["c", "T0", "LIVB 0 5"],
+    ]
+    assert nerd.find_in_texts(texts)["doc_id"].tolist() == [0, 0, 2]
+    assert nerd.find_in_texts(["no entity"]).empty
+    results = list(nerd.iter_texts(iter(texts), max_tokens=10))
+    assert [doc_id for doc_id, _ in results] == [0, 1, 2]
+    assert [len(df) for _, df in results] == [2, 0, 1]
+    with pytest.raises(ValueError):
+        nerd.find_in_texts(texts, ids=["a"])
+    # Iterators of different lengths are not truncated
+    with pytest.raises(ValueError):
+        nerd.find_in_texts(iter(texts), ids=iter(["a", "b"]))
+    with pytest.raises(ValueError):
+        nerd.find_in_texts(iter(texts[:2]), ids=iter(["a", "b", "c"]))
@@ -0,0 +1,53 @@
+import pytest
+import random
+import numpy
+from sklearn.feature_extraction.text import TfidfVectorizer
+from taxonerd.linking.vectorizer import TrigramVectorizer
+
+CHARS = "abcdeéfghiklmnoprstuxyzAÉBCQ.-'( \t\n"
+
+
+def random_text(rng):
+    return "".join(rng.choice(CHARS) for _ in range(rng.randint(0, 30)))
+
+
+@pytest.fixture(scope="module")
+def tfidf_vectorizer():
+    rng = random.Random(0)
+    vectorizer = TfidfVectorizer(
+        analyzer="char_wb", ngram_range=(3, 3), min_df=2, dtype=numpy.float32
+    )
+    vectorizer.fit([random_text(rng) for _ in range(2000)])
+    return vectorizer
+
+
+@pytest.fixture
+def mentions():
+    rng = random.Random(1)
+    return [random_text(rng) for _ in range(500)] + [
+        "",
+        "  ",
+        "Ursus arctos",
+        "B. xylophilus",
+        "ω",
+        "Quercus   robur (L.)",
+    ]
+
+
+def test_same_output_as_sklearn(tfidf_vectorizer, mentions):
+    expected = tfidf_vectorizer.transform(mentions)
+    output = TrigramVectorizer.from_tfidf_vectorizer(tfidf_vectorizer).transform(
+        mentions
+    )
+    assert output.shape == expected.shape
+    assert output.dtype == expected.dtype
+    assert (output.indptr == expected.indptr).all()
+    assert (output.indices == expected.indices).all()
+    assert numpy.allclose(output.data, expected.data, atol=1e-6)
+
+
+def test_unsupported_vectorizer():
+    vectorizer = TfidfVectorizer(analyzer="word").fit(["Ursus arctos"])
+    assert not TrigramVectorizer.is_supported(vectorizer)
+    with pytest.raises(ValueError):
+        TrigramVectorizer.from_tfidf_vectorizer(vectorizer)
@@ -0,0 +1,150 @@
+import pytest
+import io
+import os
+import json
+import pandas as pd
+from taxonerd.writers import (
+    BratWriter,
+    DocBinWriter,
+    JsonlWriter,
+    ParquetWriter,
+    entities_to_records,
+    get_writer,
+)
+
+
+@pytest.fixture
+def entities():
+    return pd.DataFrame(
+        [
+            {"offsets": "LIVB 0 5", "text": "Ursus", "sent": 0},
+            {"offsets": "LIVB 10 16", "text": "arctos", "sent": 1},
+        ]
+    ).rename("T{}".format)
+
+
+def test_entities_to_records(entities):
+    assert entities_to_records(entities) == [
+        {"id": "T0", "offsets": "LIVB 0 5", "text": "Ursus", "sent": 0},
+        {"id": "T1", "offsets": "LIVB 10 16", "text": "arctos", "sent": 1},
+    ]
+    assert entities_to_records(pd.DataFrame()) == []
+
+
+def test_brat_writer(tmp_path, entities):
+    path = BratWriter(str(tmp_path)).write("sub/doc", entities)
+    assert path == str(tmp_path / "sub" / "doc.ann")
+    assert open(path).read().splitlines()[0] == "T0\tLIVB 0 5\tUrsus\t0"
+
+
+def test_jsonl_writer(entities):
+    stream = io.StringIO()
+    writer = JsonlWriter(stream, buffer_size=2)
+    writer.write("doc1", entities)
+    assert stream.getvalue() == ""
+    writer.write("doc2", pd.DataFrame())
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [r["id"] for r in records] == ["doc1", "doc2"]
+    assert records[0]["entities"] == entities_to_records(entities)
+    with writer:
+        writer.write("doc3", entities)
+    assert len(stream.getvalue().splitlines()) == 3
+
+
+def test_jsonl_writer_overwrites_file(tmp_path, entities):
+    path = str(tmp_path / "entities.jsonl")
+    for _ in range(2):
+        with JsonlWriter(path) as writer:
+            writer.write("doc1", entities)
+    assert len(open(path).read().splitlines()) == 1
+
+
+def test_parquet_writer(tmp_path, entities):
+    pq = pytest.importorskip("pyarrow.parquet")
+    with ParquetWriter(str(tmp_path), shard=(1, 4), row_group_size=3) as writer:
+        for i in range(3):
+            path = writer.write("doc{}".format(i), entities)
+    assert path == str(tmp_path / "entities-00001-of-00004.parquet")
+    table = pq.read_table(path)
+    assert table.num_rows == 6
+    assert pq.ParquetFile(path).num_row_groups == 2
+    assert (
+        table.column("doc_id").to_pylist() == ["doc0"] * 2 + ["doc1"] * 2 + ["doc2"] * 2
+    )
+    assert table.column("start").to_pylist()[:2] == [0, 10]
+    assert table.column("entity").to_pylist()[0] is None
+    # Linked entities, with the (concept id, alias, score) triples of the linker
+    linked = entities.assign(
+        entity=[[("NCBI:9644", "ursus", 0.9), ("NCBI:9643", "ursidae", 0.75)], []]
+    )
+    with ParquetWriter(str(tmp_path / "linked")) as writer:
+        path = writer.write("doc", linked)
+    assert pq.read_table(path).column("entity").to_pylist() == [
+        [
+            {"id": "NCBI:9644", "alias": "ursus", "score": 0.9},
+            {"id": "NCBI:9643", "alias": "ursidae", "score": 0.75},
+        ],
+        [],
+    ]
+    # A shard without entities still produces a file
+    with ParquetWriter(str(tmp_path), shard=(0, 4)) as writer:
+        writer.write("doc", pd.DataFrame())
+    assert pq.read_table(tmp_path / "entities-00000-of-00004.parquet").num_rows == 0
+
+
+def test_get_writer(tmp_path):
+    assert isinstance(get_writer("brat", str(tmp_path)), BratWriter)
+    writer = get_writer("jsonl", str(tmp_path), shard=(0, 2))
+    assert writer.path == str(tmp_path / "entities-00000-of-00002.jsonl")
+    writer.close()
+    with pytest.raises(ValueError):
+        get_writer("brat")
+    with pytest.raises(ValueError):
+        get_writer("csv", str(tmp_path))
+
+
+def test_find_in_corpus_with_writer(tmp_path, nerd):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    (corpus / "doc1.txt").write_text("Brown bears")
+    (corpus / "doc2.txt").write_text("No entity")
+    output_path = str(tmp_path / "entities.jsonl")
+    with JsonlWriter(output_path) as writer:
+        results = nerd.find_in_corpus(str(corpus), writer=writer)
+    assert results == {"doc1.txt": output_path, "doc2.txt": output_path}
+    records = [json.loads(line) for line in open(output_path)]
+    assert [(r["id"], len(r["entities"])) for r in records] == [
+        ("doc1", 1),
+        ("doc2", 0),
+    ]
+    assert not os.path.exists(str(corpus / "doc1.ann"))
+
+
+def test_docbin_writer(tmp_path, nerd):
+    from spacy.tokens import Span
+
+    if not Span.has_extension("long_form"):
+        Span.set_extension("long_form", default=None)
+    if not Span.has_extension("kb_ents"):
+        Span.set_extension("kb_ents", default=[])
+    doc = nerd.ner("Brown bears and black bears")
+    doc.ents[0]._.kb_ents = [("NCBI:9644", "bears", 0.9), ("NCBI:9643", "bear", 0.8)]
+    doc.ents[1]._.long_form = doc.ents[0]
+    user_data = dict(doc.user_data)
+    with DocBinWriter(str(tmp_path), shard=(0, 2), docs_per_file=2) as writer:
+        paths = [writer.write("doc{}".format(i), None, doc) for i in range(3)]
+    assert doc.user_data == user_data
+    assert paths == [str(tmp_path / "docs-00000-of-00002-00000.spacy")] * 2 + [
+        str(tmp_path / "docs-00000-of-00002-00001.spacy")
+    ]
+    docs = list(nerd.load_docs(str(tmp_path)))
+    assert [doc_id for doc_id, _ in docs] == ["doc0", "doc1", "doc2"]
+    restored = docs[0][1]
+    assert restored.text == doc.text
+    assert [ent.text for ent in restored.ents] == ["bears", "bears"]
+    assert restored.ents[0]._.kb_ents == doc.ents[0]._.kb_ents
+    long_form = restored.ents[1]._.long_form
+    assert (long_form.start, long_form.end, long_form.label_) == (1, 2, "LIVB")
+    assert nerd.doc_to_df(restored).equals(nerd.doc_to_df(doc))
+    with pytest.raises(ValueError):
+        DocBinWriter(str(tmp_path)).write("doc", pd.DataFrame())